@@ -9,6 +9,7 @@ __init__ file for pynams main package
 from __future__ import print_function
 from .samples import Sample
 from .spectra import Spectrum
+from .spectrastore import SpectraStore
 from .profiles import Profile
 from .blocks import Block
 from . import styles
@@ -0,0 +1,497 @@
+"""
+Code for fitting diffusivities to *many* Profiles and Blocks at once.
+
+The main function is fitD_many, which takes a list of jobs, each either
+a Profile or Block or a (Profile or Block, dictionary of fitD keywords)
+pair, e.g.,
+    jobs = [(profile1, {'peak_idx': 0}),
+            (profile1, {'peak_idx': 1}),
+            (block1, {'vary_initial': True})]
+    results = fitD_many(jobs)
+
+The fits are spread out over a pool of processes. Before the jobs are
+sent out, the arrays of all of their spectra are copied into a single
+block of shared memory, so each process only gets a lightweight copy of
+the Profile or Block that points back into that block rather than its
+own copy of every spectrum.
+
+The results come back as a pandas DataFrame with one row per fit
+diffusivity (three rows for Blocks) and columns for the diffusivity,
+initial and final values, and time, along with their errors.
+
+fit_arrhenius_many takes the same kind of list of jobs, all at 
+different temperatures, and fits activation energies and D0 values 
+directly to all of their data at once.
+
+@author Elizabeth Ferriss
+"""
+from __future__ import print_function, division, absolute_import
+import numpy as np
+import pandas as pd
+import copy
+import os
+from concurrent import futures
+from pynams.diffusion import models
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# Spectrum attributes that are moved into shared memory
+ARRAY_ATTRIBUTES = ['wn_full', 'abs_raw', 'abs_full_cm', 'base_wn',
+                    'base_abs', 'abs_nobase_cm']
+
+RESULT_COLUMNS = ['job', 'kind', 'name', 'peak_idx', 'direction',
+                  'log10D_m2s', 'log10D_m2s_error',
+                  'initial', 'initial_error', 'final', 'final_error',
+                  'minutes', 'minutes_error', 'problem']
+
+ARRHENIUS_COLUMNS = ['orientation', 'Ea_kJmol', 'Ea_kJmol_error',
+                     'log10D0_m2s', 'log10D0_m2s_error']
+
+# failures of the fits themselves that are recorded as a problem in the
+# results instead of stopping the other fits
+FIT_ERRORS = (ArithmeticError, ValueError, np.linalg.LinAlgError)
+
+EXPERIMENT_COLUMNS = ['job', 'kind', 'name', 'peak_idx', 'direction',
+                      'log10D_m2s', 'initial', 'final', 'rss', 'npoints']
+
+
+class SharedArray():
+    """
+    Stands in for a numpy array of a given shape and dtype that starts
+    offset bytes into a block of shared memory.
+    """
+    def __init__(self, offset, shape, dtype):
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+
+
+    def attach(self, buffer):
+        """Returns the array as a view into buffer"""
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=buffer,
+                          offset=self.offset)
+
+
+def get_profiles(item):
+    """
+    Returns a list of all Profiles in a Profile or Block, including any
+    initial profiles.
+    """
+    try:
+        profiles = list(item.profiles)
+    except AttributeError:
+        profiles = [item]
+    for prof in list(profiles):
+        initial = getattr(prof, 'initial_profile', None)
+        if (initial is not None) and (initial not in profiles):
+            profiles.append(initial)
+    return profiles
+
+
+def get_spectra(item):
+    """Returns a list of all spectra in a Profile or Block"""
+    spectra = []
+    for prof in get_profiles(item):
+        for spec in getattr(prof, 'spectra', None) or []:
+            if spec not in spectra:
+                spectra.append(spec)
+    return spectra
+
+
+def share_jobs(items):
+    """
+    Copies the spectra arrays of a list of Profiles and Blocks into a
+    single block of shared memory.
+
+    Returns copies of the items in which those arrays are replaced by
+    SharedArray placeholders, and the SharedMemory, which should be
+    closed and unlinked when the fitting is done.
+    """
+    arrays = []
+    seen = set()
+    for item in items:
+        for spec in get_spectra(item):
+            for attribute in ARRAY_ATTRIBUTES:
+                array = getattr(spec, attribute, None)
+                if (isinstance(array, np.ndarray) and
+                    (array.dtype != object) and (id(array) not in seen)):
+                    seen.add(id(array))
+                    arrays.append(array)
+
+    nbytes = 0
+    offsets = []
+    for array in arrays:
+        # keep each array 8-byte aligned
+        nbytes = int(np.ceil(nbytes / 8.) * 8)
+        offsets.append(nbytes)
+        nbytes = nbytes + array.nbytes
+
+    shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+
+    # copying with the arrays already in the memo leaves the placeholders
+    # in their places and copies everything else
+    memo = {}
+    for array, offset in zip(arrays, offsets):
+        placeholder = SharedArray(offset, array.shape, array.dtype)
+        placeholder.attach(shm.buf)[...] = array
+        memo[id(array)] = placeholder
+
+    memo.update(store_memo(items))
+    memo[id(memo)] = list(arrays)
+    shared_items = copy.deepcopy(items, memo)
+    return shared_items, shm
+
+
+def store_memo(items):
+    """
+    Returns a memo for copy.deepcopy that leaves out the SpectraStores
+    of a list of Profiles and Blocks, which aren't needed for fitting.
+    """
+    memo = {}
+    for item in items:
+        for thing in [item] + get_profiles(item):
+            store = getattr(thing, 'store', None)
+            if store is not None:
+                memo[id(store)] = None
+    return memo
+
+
+def unshare_item(item, buffer):
+    """
+    Replaces SharedArray placeholders in the spectra of a Profile or Block
+    with views into buffer.
+    """
+    for spec in get_spectra(item):
+        for attribute in ARRAY_ATTRIBUTES:
+            placeholder = getattr(spec, attribute, None)
+            if isinstance(placeholder, SharedArray):
+                setattr(spec, attribute, placeholder.attach(buffer))
+
+
+def fit_item(item, options):
+    """
+    Runs fitD on a Profile or Block with the keywords in options and
+    returns a list of result rows, one for each diffusivity. Numerical
+    failures of the fit (FIT_ERRORS) are recorded in the problem column;
+    any other errors are raised.
+    """
+    options = dict(options)
+    options.setdefault('show_plot', False)
+    peak_idx = options.get('peak_idx', None)
+    name = getattr(item, 'name', None)
+
+    rows = []
+    def add_row(kind, direction, D, init, fin, minutes, problem=None):
+        row = dict((column, None) for column in RESULT_COLUMNS)
+        row.update({'kind': kind, 'name': name, 'peak_idx': peak_idx,
+                    'direction': direction, 'problem': problem})
+        for key, value in [('log10D_m2s', D), ('initial', init),
+                           ('final', fin), ('minutes', minutes)]:
+            if value is None:
+                continue
+            try:
+                row[key] = value.n
+                row[key+'_error'] = value.s
+            except AttributeError:
+                row[key] = value
+                row[key+'_error'] = 0.
+        rows.append(row)
+
+    if hasattr(item, 'profiles'):
+        kind = 'Block'
+        directions = getattr(item, 'directions', None) or ['a', 'b', 'c']
+        try:
+            output = item.fitD(**options)
+        except FIT_ERRORS as err:
+            output = None
+            problem = repr(err)
+        else:
+            problem = 'fit returned nothing'
+        if output is None:
+            for direction in directions:
+                add_row(kind, direction, None, None, None, None, problem)
+            return rows
+        init, fin, Ds = output
+        time_seconds = item.time_seconds
+        if time_seconds is None:
+            minutes = None
+        else:
+            minutes = time_seconds / 60.
+        for direction, D in zip(directions, Ds):
+            add_row(kind, direction, D, init, fin, minutes)
+    else:
+        kind = 'Profile'
+        direction = getattr(item, 'direction', None)
+        try:
+            output = item.fitD(**options)
+        except FIT_ERRORS as err:
+            output = None
+            problem = repr(err)
+        else:
+            problem = 'fit returned nothing'
+        if output is None:
+            add_row(kind, direction, None, None, None, None, problem)
+            return rows
+        init, fin, D, minutes = output
+        add_row(kind, direction, D, init, fin, minutes)
+    return rows
+
+
+def fit_shared_job(item, options, shm_name):
+    """
+    Attaches to the shared memory called shm_name, restores the arrays of
+    a shared Profile or Block, and fits it. Runs in the worker processes.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        unshare_item(item, shm.buf)
+        rows = fit_item(item, options)
+    finally:
+        # the arrays have to be gone before the memory can be closed
+        del item
+        try:
+            shm.close()
+        except BufferError as err:
+            print('Shared memory', shm_name, 'is still in use in process',
+                  os.getpid(), '-', err)
+    return rows
+
+
+def fitD_many(jobs, processes=None, share_memory=True):
+    """
+    Fits diffusivities to many Profiles and Blocks in parallel.
+
+    jobs is a list in which each job is either a Profile or Block or a
+    (Profile or Block, dictionary of keywords for fitD) pair. The plots
+    are turned off unless the keywords say otherwise.
+
+    The jobs are spread over a pool of processes (default: one for each
+    CPU). Set processes=1 to run them one after another here instead.
+    Either way, only copies of the Profiles and Blocks are fit, so the
+    originals are left as they are, and the results are only in the
+    DataFrame.
+    If share_memory is True (default), the spectra arrays are passed
+    to the processes through shared memory (see share_jobs); otherwise
+    every job is copied over in full.
+
+    Returns a pandas DataFrame with one row for each diffusivity fit, so
+    three rows for Blocks, with columns:
+        job: index of the job in the list
+        kind: 'Profile' or 'Block'
+        name, peak_idx, and direction
+        log10D_m2s, initial, final, and minutes and their errors
+            (e.g., log10D_m2s_error)
+        problem: description of anything that went wrong, otherwise None
+    """
+    items = []
+    options = []
+    for job in jobs:
+        if isinstance(job, (tuple, list)):
+            item, option = job
+        else:
+            item, option = job, {}
+        items.append(item)
+        options.append(option or {})
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(int(processes), len(items)))
+
+    results = [None] * len(items)
+    if processes == 1:
+        # fit copies, just like the processes do
+        for idx, (item, option) in enumerate(zip(items, options)):
+            item = copy.deepcopy(item, store_memo([item]))
+            results[idx] = fit_item(item, option)
+
+    elif (share_memory is True) and (shared_memory is not None):
+        shared_items, shm = share_jobs(items)
+        try:
+            with futures.ProcessPoolExecutor(processes) as pool:
+                running = {}
+                for idx, (item, option) in enumerate(zip(shared_items,
+                                                         options)):
+                    future = pool.submit(fit_shared_job, item, option,
+                                         shm.name)
+                    running[future] = idx
+                for future in futures.as_completed(running):
+                    results[running[future]] = future.result()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    else:
+        with futures.ProcessPoolExecutor(processes) as pool:
+            running = {}
+            for idx, (item, option) in enumerate(zip(items, options)):
+                running[pool.submit(fit_item, item, option)] = idx
+            for future in futures.as_completed(running):
+                results[running[future]] = future.result()
+
+    rows = []
+    for idx, job_rows in enumerate(results):
+        for row in job_rows:
+            row['job'] = idx
+            rows.append(row)
+    return pd.DataFrame(rows, columns=RESULT_COLUMNS)
+
+
+def arrhenius_dataset(item, options):
+    """
+    Collects the data from a Profile or Block for models.fit_arrhenius.
+    
+    The options are a dictionary that can include celsius and 
+    time_seconds or temperature_path, which otherwise come from the 
+    item's celsius and time_seconds attributes, as well as the fitD 
+    keywords peak_idx, heights_instead, wholeblock (Profiles, default 
+    False) or wholeblock_data (Blocks, default True), symmetric 
+    (Profiles), init and fin, and vary_initial and vary_final. 
+    As in fitD, data that are not whole-block ratios are scaled so the 
+    highest value is 1, and init and fin are on the same scale as the 
+    data.
+
+    Returns the dataset dictionary, or a description of what is missing.
+    """
+    options = dict(options)
+    peak_idx = options.get('peak_idx', None)
+    heights_instead = options.get('heights_instead', False)
+
+    if hasattr(item, 'profiles'):
+        wholeblock = options.get('wholeblock_data', True)
+        # need raypaths for the whole-block model; Block.__init__ takes
+        # them from the profiles
+        if item.raypaths is None:
+            item.raypaths = [prof.raypath for prof in item.profiles]
+        if None in item.raypaths:
+            return 'needs a raypath for every profile'
+        x, y = item.xy_picker(peak_idx=peak_idx, wholeblock=wholeblock,
+                              heights_instead=heights_instead, 
+                              centered=False)
+        dataset = {'x_microns': x, 'y': y, 
+                   'lengths_microns': item.lengths,
+                   'orientations': item.directions,
+                   'raypaths': item.raypaths}
+    else:
+        wholeblock = options.get('wholeblock', False)
+        y = item.y_data_picker(wholeblock, heights_instead, peak_idx)
+        dataset = {'x_microns': [item.positions_microns], 'y': [y], 
+                   'lengths_microns': [item.length_microns],
+                   'orientations': [item.direction],
+                   'symmetric': options.get('symmetric', True)}
+        # fitD scales profiles to their highest value
+        wholeblock = False
+
+    scale = 1.
+    if wholeblock is False:
+        scale = max([max(yk) for yk in dataset['y']])
+        dataset['y'] = [np.asarray(yk, dtype=float) / scale 
+                        for yk in dataset['y']]
+    dataset['initial'] = options.get('init', 1.) / scale
+    dataset['final'] = options.get('fin', 0.) / scale
+    dataset['vary_initial'] = options.get('vary_initial', False)
+    dataset['vary_final'] = options.get('vary_final', False)
+    dataset['scale'] = scale
+
+    path = options.get('temperature_path', None)
+    if path is None:
+        celsius = options.get('celsius', getattr(item, 'celsius', None))
+        time_seconds = options.get('time_seconds', 
+                                   getattr(item, 'time_seconds', None))
+        if (celsius is None) or (time_seconds is None):
+            return 'needs celsius and time_seconds or temperature_path'
+        path = ([0., time_seconds], [celsius, celsius])
+    dataset['temperature_path'] = path
+    return dataset
+
+
+def fit_arrhenius_many(jobs, Ea_kJmol=300., log10D0s_m2s=None, 
+                       vary_Ea=True, common_Ea=False, points=50, 
+                       jacobian=True):
+    """
+    Fits activation energies and D0 values for each orientation directly
+    to the data from many Profiles and Blocks from experiments at 
+    different temperatures, all at once, rather than fitting each one
+    and then fitting a line through the diffusivities.
+    
+    jobs is a list like the one for fitD_many, with the temperature 
+    given by the Block's celsius attribute or in the dictionary of 
+    keywords as celsius or a temperature-time path (see 
+    arrhenius_dataset). Profiles are fit with their direction's Ea and
+    D0 and Blocks with all three. The other keywords are as in 
+    models.fit_arrhenius, which does the fitting with one sparse 
+    Jacobian for all of the data.
+
+    Returns two pandas DataFrames:
+        one with a row for each orientation and columns for Ea_kJmol 
+            and log10D0_m2s and their errors
+        one with a row for each diffusivity in each job (three for 
+            Blocks) and columns for the job's index in the list, kind, 
+            name, peak_idx, direction, equivalent isothermal log10D_m2s,
+            initial and final values, and the sum of squared residuals
+            (rss) and number of data points (npoints) for the whole job
+    """
+    items = []
+    datasets = []
+    for job in jobs:
+        if isinstance(job, (tuple, list)):
+            item, option = job
+        else:
+            item, option = job, {}
+        dataset = arrhenius_dataset(item, option or {})
+        if isinstance(dataset, str):
+            print('job', len(items), getattr(item, 'name', ''), dataset)
+            return
+        items.append((item, option or {}))
+        datasets.append(dataset)
+
+    fit = models.fit_arrhenius(datasets, Ea_kJmol=Ea_kJmol, 
+                               log10D0s_m2s=log10D0s_m2s, vary_Ea=vary_Ea,
+                               common_Ea=common_Ea, points=points, 
+                               jacobian=jacobian)
+    if fit is None:
+        return
+    values, errors, misfits = fit
+
+    orientations = []
+    for dataset in datasets:
+        for orientation in dataset['orientations']:
+            if orientation not in orientations:
+                orientations.append(orientation)
+    rows = []
+    for orientation in orientations:
+        if common_Ea is True:
+            Ea_name = 'Ea_kJmol'
+        else:
+            Ea_name = 'Ea_kJmol_' + orientation
+        D0_name = 'log10D0_m2s_' + orientation
+        rows.append({'orientation': orientation, 
+                     'Ea_kJmol': values[Ea_name], 
+                     'Ea_kJmol_error': errors[Ea_name],
+                     'log10D0_m2s': values[D0_name],
+                     'log10D0_m2s_error': errors[D0_name]})
+    arrhenius = pd.DataFrame(rows, columns=ARRHENIUS_COLUMNS)
+
+    rows = []
+    for idx, ((item, option), dataset, misfit) in enumerate(zip(items, 
+                                                                datasets,
+                                                                misfits)):
+        if hasattr(item, 'profiles'):
+            kind = 'Block'
+        else:
+            kind = 'Profile'
+        initial = values.get('initial_' + str(idx), dataset['initial'])
+        final = values.get('final_' + str(idx), dataset['final'])
+        for direction, log10D in zip(dataset['orientations'], 
+                                     misfit['log10Ds_m2s']):
+            rows.append({'job': idx, 'kind': kind, 
+                         'name': getattr(item, 'name', None),
+                         'peak_idx': option.get('peak_idx', None),
+                         'direction': direction, 'log10D_m2s': log10D,
+                         'initial': initial * dataset['scale'],
+                         'final': final * dataset['scale'],
+                         'rss': misfit['rss'], 
+                         'npoints': misfit['npoints']})
+    experiments = pd.DataFrame(rows, columns=EXPERIMENT_COLUMNS)
+    return arrhenius, experiments
@@ -4,10 +4,14 @@ Code for grouping 3 orthogonal Profiles into a single Block object.
 from __future__ import print_function, division, absolute_import
 import pynams.styles as styles
 from pynams.diffusion import models
+from pynams.diffusion import diffusivities
 from pynams import Spectrum
+from pynams import spectra as spectramodule
+from pynams import pynams
 import numpy as np
 import matplotlib.pyplot as plt
 import lmfit
+from uncertainties import ufloat
 
 class Block():
     def __init__(self,profiles=[], folder='', name='', get_peakfit=False, 
@@ -102,6 +106,25 @@ class Block():
             prof.get_peakfits(peak_ending=peak_ending)
 
 
+    def make_peakfits(self, warm_start=False, from_center=False, 
+                      wholeblock=True, **kwargs):
+        """
+        Fit peaks for all spectra in all profiles. Keywords, e.g., 
+        warm_start=True and from_center=True to warm-start along each 
+        profile from the center out, are passed on to 
+        profile.make_peakfits(). 
+        
+        If wholeblock is True (default), the peak-specific whole-block 
+        areas and heights are made afterwards for every profile.
+        """
+        for prof in self.profiles:
+            prof.make_peakfits(warm_start=warm_start, from_center=from_center,
+                               **kwargs)
+        if wholeblock is True:
+            for prof in self.profiles:
+                prof.make_wholeblock(peakfit=True)
+
+
     def get_baselines(self, initial_too=True, folder=None, delim=',', 
                       baseline_ending='-baseline.CSV',
                       print_confirmation=False):
@@ -138,13 +161,71 @@ class Block():
 
             
     def make_areas(self, show_plot=False, printout_area=False, peak=None):
-        """Make list of areas from all profiles, including whole-block areas."""
+        """
+        Make list of areas from all profiles, including whole-block areas.
+        
+        If all spectra in the Block share the same wavenumbers and 
+        baseline wavenumbers, self.area_integrator is set to an
+        AreaIntegrator for all of the spectra, going through the profiles
+        in order, for getting areas over other wavenumber ranges quickly.
+        Otherwise self.area_integrator is None.
+        """
         self.areas = []
         self.wb_areas = []
+        spectra = []
         for idx, prof in enumerate(self.profiles):
             prof.make_wholeblock()
             self.areas.append(prof.areas)
             self.wb_areas.append(prof.wb_areas)            
+            spectra = spectra + prof.spectra
+        
+        # the baselines were already subtracted while making the areas
+        self.area_integrator = None
+        try:
+            base_wn = spectra[0].base_wn
+            for spec in spectra:
+                if ((len(spec.base_wn) != len(base_wn)) or
+                    (len(spec.abs_nobase_cm) != len(base_wn)) or
+                    (np.allclose(spec.base_wn, base_wn) is False)):
+                    return
+        except (AttributeError, IndexError, TypeError):
+            return
+        abs_nobase = np.vstack([spec.abs_nobase_cm for spec in spectra])
+        self.area_integrator = spectramodule.AreaIntegrator(base_wn, 
+                                                            abs_nobase)
+
+
+    def make_peakareas(self, wholeblock=True):
+        """
+        Make Gaussian peak areas for all spectra in the Block and in any
+        initial profiles in one go using pynams.spectra.make_peakareas,
+        and pull the peak information into each profile.
+
+        If wholeblock is True (default), the peak-specific whole-block
+        areas (profile.peak_wb_areas) are then made for every profile.
+
+        Returns the peak areas as a 2D array (number of spectra x
+        number of peaks), going through the profiles in order.
+        """
+        profiles = []
+        for prof in self.profiles:
+            profiles.append(prof)
+            initial = prof.initial_profile
+            if (initial is not None) and (initial not in profiles):
+                profiles.append(initial)
+
+        spectra = []
+        for prof in profiles:
+            spectra = spectra + prof.spectra
+        peak_areas = spectramodule.make_peakareas(spectra)
+
+        for prof in profiles:
+            prof.get_peak_info()
+
+        if wholeblock is True:
+            for prof in self.profiles:
+                prof.make_wholeblock(peakfit=True, heights_or_areas='areas')
+        return peak_areas
 
 
     def average_spectra(self):
@@ -510,16 +591,50 @@ class Block():
                       abs_low=None,
                       abs_smear_high=0, 
                       abs_smear_low=0,
-                      store_baseline=True
+                      store_baseline=True,
+                      wn_mid=3550,
+                      batch=True
                       ):
         """
         Make spectra baselines for all spectra the Block. 
         
         Keywords are similar to spectrum.make_baseline()
+        
+        If all spectra in the Block share the same wavenumbers, line and 
+        polynomial baselines are made for all of them at once 
+        (batch=True). Either way, the baselines are returned as a 2D 
+        array with one row per spectrum, going through the profiles in 
+        order, or None if any baseline could not be made or they don't
+        all have the same length.
         """  
         for prof in self.profiles:
-            prof.make_baselines(raw_data=raw_data, wn_low=wn_low, 
-                               wn_high=wn_high, linetype=linetype, 
+            for spectrum in prof.spectra:
+                spectrum.base_high_wn = wn_high
+                spectrum.base_low_wn = wn_low
+
+        if ((batch is True) and (linetype in ['line', 'polynomial']) and 
+            (show_plot is False) and (show_fit_values is False)):
+            spectra = []
+            for prof in self.profiles:
+                spectra = spectra + prof.spectra
+            base_wn, base_abs = spectramodule.make_baselines(spectra, 
+                                   raw_data=raw_data, wn_low=wn_low, 
+                                   wn_high=wn_high, wn_mid=wn_mid, 
+                                   linetype=linetype, curvature=curvature,
+                                   force_through_wn=force_through_wn,
+                                   polynomial_order=polynomial_order,
+                                   abs_high=abs_high, abs_low=abs_low, 
+                                   abs_smear_high=abs_smear_high,
+                                   abs_smear_low=abs_smear_low,
+                                   store_baseline=store_baseline)
+            if base_abs is not None:
+                return base_abs
+
+        baselines = []
+        for prof in self.profiles:
+            base_abs = prof.make_baselines(raw_data=raw_data, wn_low=wn_low, 
+                               wn_high=wn_high, wn_mid=wn_mid, 
+                               batch=batch, linetype=linetype, 
                                spline_kind=spline_kind,
                                spline_wn_high=spline_wn_high,
                                spline_wn_low=spline_wn_low,                               
@@ -532,6 +647,11 @@ class Block():
                                abs_smear_high=abs_smear_high,
                                abs_smear_low=abs_smear_low,
                                store_baseline=store_baseline)
+            if base_abs is None:
+                baselines.append(None)
+            else:
+                baselines.extend(base_abs)
+        return spectramodule.vstack_baselines(baselines)
 
 
     def save_baselines(self, initial_too=True, 
@@ -676,7 +796,10 @@ class Block():
                            erf_or_sum='erf', 
                            points=50, 
                            heights_instead=False, 
-                           approximation1D=False):
+                           approximation1D=False,
+                           solver='analytical',
+                           initial_matrix=None,
+                           timesteps=100):
         """
 		Calculate diffusion profiles in the Block
 
@@ -696,6 +819,11 @@ class Block():
         	  value (wholeblock_data=False) as opposed to normalized
         	  (wholeblock_data=True). This matters for determining the 
         	  maximum and minimum values
+        	* Uses the analytical solutions (solver='analytical'). Set 
+        	  solver='adi' to use the finite-difference solution, which 
+        	  can start from a 3D matrix of unit values passed in as 
+        	  initial_matrix, e.g., from models.diffusion3D_stages 
+        	  (see models.adi3D)
 
         Returns lmfit parameters, x-data, and y-data for 3-dimensional 
         diffusion in a block.        
@@ -754,7 +882,21 @@ class Block():
         params = models.params_setup3D(L3, D3, time_seconds, 
                                        init_unit, fin_unit)
 
-        if wholeblock_diffusion is True:
+        if solver == 'adi':
+            v = models.diffusion3D_numerical_params(params, 
+                                                initial_matrix=initial_matrix,
+                                                points=points, 
+                                                timesteps=timesteps)
+            if v is None:
+                return False, False, False
+            xdiff = [np.linspace(0., float(length), int(points)) 
+                     for length in L3]
+            if wholeblock_diffusion is True:
+                ydiff = models.wholeblock_from_matrix(v, self.raypaths)
+            else:
+                mid = int(points/2)
+                ydiff = [v[:, mid, mid], v[mid, :, mid], v[mid, mid, :]]
+        elif wholeblock_diffusion is True:
             xdiff, ydiff = models.diffusion3Dwb_params(params, 
                                                    raypaths=self.raypaths, 
                                                    erf_or_sum=erf_or_sum,
@@ -807,6 +949,9 @@ class Block():
                        style_data=styles.style_points,
                        style_diffusion=styles.style_1,
                        show_line_at_1=True,
+                       solver='analytical',
+                       initial_matrix=None,
+                       timesteps=100,
                        ):
         """
         Plot 3D diffusion profiles for Block.
@@ -837,6 +982,11 @@ class Block():
             To change the x positions, pass *a list of x-values* into labelDx.
         
         Change the maximum y value with the top keyword.
+        
+        To start from a non-uniform block, e.g., for the second step of 
+        a multi-stage experiment, set solver='adi' and pass in the 3D 
+        matrix of unit values at the start as initial_matrix 
+        (see diffusion_profiles).
         """        
         D3 = models.D_checker(log10D_m2s)
         hinstead = heights_instead
@@ -850,7 +1000,10 @@ class Block():
                                                    points=points,
                                                    heights_instead=hinstead,
                                                    init=init, fin=fin,
-                                                   approximation1D=approx)
+                                                   approximation1D=approx,
+                                                   solver=solver,
+                                                   initial_matrix=initial_matrix,
+                                                   timesteps=timesteps)
 
         if params is False:
             return False, False
@@ -909,6 +1062,59 @@ class Block():
             pass
 
        
+    def misfit_map(self, log10Dx, log10Dy, log10Dz, peak_idx=None,
+                   init=1., fin=0., heights_instead=False, 
+                   wholeblock_data=True, points=50, lookup=False, 
+                   processes=1):
+        """
+        Brute-force search for the three diffusivities that best match the
+        whole-block data. The data are scaled the same way as in fitD and 
+        compared with whole-block diffusion models for every combination 
+        of the diffusivities in the arrays log10Dx, log10Dy, and log10Dz 
+        at the block's time_seconds.
+        
+        Set processes to spread the work over more than one process and 
+        lookup=True to use precomputed tables 
+        (see models.misfit_grid3Dwb).
+        
+        Returns the misfit (sum of squared residuals) with shape 
+        (len(log10Dx), len(log10Dy), len(log10Dz)) and a list of the
+        best three diffusivities, which make good starting values for fitD.
+        """
+        if self.time_seconds is None:
+            print('Need to set block attribute time_seconds')
+            return
+        if self.raypaths is None:
+            self.setupWB()
+
+        # positions from one edge, as in the models and fitD
+        try:
+            x, y = self.xy_picker(peak_idx=peak_idx, 
+                                  wholeblock=wholeblock_data, 
+                                  heights_instead=heights_instead,
+                                  centered=False)
+        except AttributeError:
+            print('problem in block.xy_picker getting x and y data')
+            return
+
+        if wholeblock_data is False:
+            maxy = max([max(areas) for areas in y])
+            y = [np.array(areas) / maxy for areas in y]
+            init = init / maxy
+            fin = fin / maxy
+
+        rss = models.misfit_grid3Dwb(x, y, self.lengths, log10Dx, log10Dy,
+                                     log10Dz, self.time_seconds, 
+                                     self.raypaths, init=init, fin=fin,
+                                     points=points, lookup=lookup,
+                                     processes=processes)
+        if rss is None:
+            return
+        best, best_rss = models.grid_minimum(rss, log10Dx, log10Dy, log10Dz)
+        print('best log10D m2/s:', best)
+        return rss, best
+
+
     def fitD(self, peak_idx=None, 
     		 init=1., 
     		 fin=0.,
@@ -926,7 +1132,20 @@ class Block():
              style_initial=None,
              style_final={'color':'red'}, 
              points=50, 
-             top=1.2):
+             top=1.2,
+             method='lmfit',
+             jacobian=True,
+             starts=1,
+             start_range=(-16., -8.),
+             processes=None,
+             seed=None,
+             solver='analytical',
+             initial_matrix=None,
+             timesteps=100,
+             temperature_path=None,
+             Ea_kJmol=None,
+             log10D0s_m2s=None,
+             vary_Ea=False):
         """
         Fit 3D diffusion curves to Block data.
         
@@ -951,14 +1170,53 @@ class Block():
         diffusivities in through log10Ds_m2s (default=[-13, -13, -13]) 
         and what to hold constant (vary_diffusivities=[True, True, True]
         by default) 
+        
+        The fit is done with lmfit by default (method='lmfit'). Set 
+        method='least_squares' to skip lmfit and fit directly with 
+        scipy.optimize.least_squares, which has less overhead.
+        Either way, the fit uses the analytical derivatives of the 
+        whole-block model (see models.wholeblock_jacobian) unless 
+        jacobian=False, which switches to finite differences.
+        
+        To look for the best of several minima, set starts to the number
+        of fits to run from starting diffusivities spread over 
+        start_range (log10 m2/s) in a Latin hypercube. These fits use 
+        least_squares and run in parallel over processes (default: one 
+        for each CPU). Pass seed to get the same starts every time. All 
+        of the different solutions found are saved, best first, as 
+        self.fitD_solutions (see models.fit_diffusion3Dwb_multistart), 
+        and the best one is returned.
+        
+        For blocks that didn't start out uniform, e.g., that were 
+        hydrated before being dehydrated, set solver='adi' to fit with 
+        the finite-difference model models.diffusion3Dwb_numerical_params
+        starting from the 3D matrix of unit values passed in as 
+        initial_matrix (see models.diffusion3D_stages). These fits always
+        use lmfit with finite differences and take much longer, so try 
+        fewer points and timesteps first.
+        
+        For experiments that weren't isothermal, pass the 
+        temperature-time path as temperature_path=(times in seconds, 
+        temperatures in celsius) and the activation energy Ea_kJmol, 
+        either one for all three directions or a list of 3, to fit 
+        log10D0s_m2s (vary_diffusivities) and, with vary_Ea=True, Ea 
+        directly (see models.diffusion3Dwb_path_params). The starting 
+        log10D0s_m2s default to the ones that give log10Ds_m2s over the 
+        path. The diffusivities returned are the equivalent isothermal 
+        ones over the total time of the path, with only the errors on 
+        log10D0. The best-fit Ea and log10D0 values are saved as 
+        self.fitD_arrhenius. These fits always use lmfit with finite 
+        differences and work with either solver.
         """        
 
-        # x and y are the data that we will fit to, centered for fitting
+        # x and y are the data that we will fit to; the models all put
+        # the positions from one edge (0) to the other (length), so the
+        # data positions are not centered, whatever the solver
         try:
             x, y = self.xy_picker(peak_idx=peak_idx, 
                                   wholeblock=wholeblock_data, 
                                   heights_instead=heights_instead, 
-                                  centered=True)
+                                  centered=False)
         except AttributeError:
             print('problem in block.xy_picker getting x and y data')
             return
@@ -973,10 +1231,15 @@ class Block():
             fin_unit = fin
 
 
+        # along a temperature-time path, the time is the total time
+        time_seconds = self.time_seconds
+        if temperature_path is not None:
+            time_seconds = temperature_path[0][-1] - temperature_path[0][0]
+
         # set up fitting parameters in the required format
         params = models.params_setup3D(microns3=self.lengths, 
                  log10D3=log10Ds_m2s,
-                 time_seconds=self.time_seconds, 
+                 time_seconds=time_seconds, 
                  initial=init_unit, final=fin_unit,
                  vinit=vary_initial, vfin=vary_final,
                  vD=vary_diffusivities)
@@ -992,13 +1255,158 @@ class Block():
             dict_fitting['raypaths'] = self.raypaths
             dict_fitting['show_plot'] = False
             
-            x = np.array(x)
-            y = np.array(y)
+            x = [np.array(xk) for xk in x]
+            y = [np.array(yk) for yk in y]
+        else:
+            print('Only whole-block diffusion (wholeblock_diffusion=True)')
+            print('is set up for fitting so far')
+            return
+
+        if temperature_path is not None:
+            if Ea_kJmol is None:
+                print('Need Ea_kJmol to go along with temperature_path')
+                return
+            times_seconds, celsius = temperature_path
+            if np.ndim(Ea_kJmol) == 0:
+                Ea3 = [Ea_kJmol] * 3
+            else:
+                Ea3 = Ea_kJmol
+            if log10D0s_m2s is None:
+                log10D0s_m2s = []
+                for log10D, Ea in zip(log10Ds_m2s, Ea3):
+                    shift = diffusivities.effective_log10D(Ea, 1., 
+                                                           times_seconds,
+                                                           celsius)
+                    log10D0s_m2s.append(log10D - shift)
+            params = models.params_setup3D_path(self.lengths, Ea_kJmol,
+                                                log10D0s_m2s,
+                                                initial=init_unit,
+                                                final=fin_unit, vEa=vary_Ea,
+                                                vD0=vary_diffusivities,
+                                                vinit=vary_initial, 
+                                                vfin=vary_final)
+            dict_fitting['temperature_path'] = temperature_path
+            if solver == 'adi':
+                dict_fitting['model'] = models.diffusion3Dwb_numerical_params
+                dict_fitting['initial_matrix'] = initial_matrix
+                dict_fitting['timesteps'] = timesteps
+            elif solver != 'analytical':
+                print("solver must be 'analytical' or 'adi'")
+                return
+            result = lmfit.minimize(models.diffusion3Dwb_path_params, 
+                                    params, args=(x, y), kws=dict_fitting)
+            params = getattr(result, 'params', params)
+            values = {}
+            errors = {}
+            for name in params:
+                values[name] = params[name].value
+                errors[name] = params[name].stderr
+            isothermal = models.isothermal_params3D(params, temperature_path)
+            self.fitD_arrhenius = {}
+            for direction in ['x', 'y', 'z']:
+                values['log10D' + direction] = isothermal['log10D' + 
+                                                          direction].value
+                errors['log10D' + direction] = errors['log10D0' + direction]
+                for name in ['Ea' + direction + '_kJmol', 
+                             'log10D0' + direction]:
+                    stderr = errors[name]
+                    if stderr is None:
+                        stderr = 0.
+                    self.fitD_arrhenius[name] = ufloat(values[name], stderr)
+            print('Ea kJ/mol:', ', '.join('{:.1f}'.format(
+                  self.fitD_arrhenius['Ea' + direction + '_kJmol']) 
+                  for direction in ['x', 'y', 'z']))
+            print('log10D0 m2/s:', ', '.join('{:.2f}'.format(
+                  self.fitD_arrhenius['log10D0' + direction]) 
+                  for direction in ['x', 'y', 'z']))
+        elif solver == 'adi':
+            dict_fitting['initial_matrix'] = initial_matrix
+            dict_fitting['timesteps'] = timesteps
+            result = lmfit.minimize(models.diffusion3Dwb_numerical_params, 
+                                    params, args=(x, y), kws=dict_fitting)
+            params = getattr(result, 'params', params)
+            values = {}
+            errors = {}
+            for name in params:
+                values[name] = params[name].value
+                errors[name] = params[name].stderr
+        elif solver != 'analytical':
+            print("solver must be 'analytical' or 'adi'")
+            return
+        elif starts > 1:
+            solutions = models.fit_diffusion3Dwb_multistart(x, y, 
+                                            self.lengths, log10Ds_m2s, 
+                                            self.time_seconds, self.raypaths,
+                                            starts=starts, 
+                                            start_range=start_range,
+                                            initial=init_unit, 
+                                            final=fin_unit,
+                                            vD=vary_diffusivities,
+                                            vinit=vary_initial, 
+                                            vfin=vary_final, points=points,
+                                            jacobian=jacobian, 
+                                            processes=processes, seed=seed)
+            self.fitD_solutions = solutions
+            print(len(solutions), 'solutions from', starts, 'starts')
+            for solution in solutions:
+                Ds = [solution['values'][name] for name in 
+                      ['log10Dx', 'log10Dy', 'log10Dz']]
+                print('log10D m2/s:', 
+                      ', '.join('{:.2f}'.format(D) for D in Ds),
+                      ' misfit: {:.3g}'.format(solution['rss']), 
+                      ' starts:', solution['starts'])
+            values = solutions[0]['values']
+            errors = solutions[0]['errors']
+        elif method == 'least_squares':
+            values, errors = models.fit_diffusion3Dwb(x, y, self.lengths, 
+                                              log10Ds_m2s, self.time_seconds,
+                                              self.raypaths, 
+                                              initial=init_unit, 
+                                              final=fin_unit,
+                                              vD=vary_diffusivities,
+                                              vinit=vary_initial, 
+                                              vfin=vary_final, points=points,
+                                              jacobian=jacobian)
+        elif method == 'lmfit':
+            fit_kws = {}
+            if jacobian is True:
+                fit_kws['Dfun'] = models.diffusion3Dwb_params_jacobian
             # run the minimizer
-            lmfit.minimize(models.diffusion3Dwb_params, 
-                           params, args=(x, y), 
-                           kws=dict_fitting
-                           )
+            result = lmfit.minimize(models.diffusion3Dwb_params, 
+                                    params, args=(x, y), 
+                                    kws=dict_fitting, **fit_kws
+                                    )
+            # newer versions of lmfit leave params alone and return new ones
+            params = getattr(result, 'params', params)
+            values = {}
+            errors = {}
+            for name in params:
+                values[name] = params[name].value
+                errors[name] = params[name].stderr
+        else:
+            print("method must be 'lmfit' or 'least_squares'")
+            return
+            
+        best = []
+        for name in ['initial_unit_value', 'final_unit_value', 
+                     'log10Dx', 'log10Dy', 'log10Dz']:
+            stderr = errors[name]
+            if stderr is None:
+                stderr = 0.
+            best.append(ufloat(values[name], stderr))
+
+        if wholeblock_data is False:
+            best_init = best[0] * maxy
+            best_fin = best[1] * maxy
+        else:
+            best_init = best[0]
+            best_fin = best[1]
+        best_Ds = best[2:]
+
+        print('initial:', '{:.2f}'.format(best_init))
+        print('final:', '{:.2f}'.format(best_fin))
+        print('log10D m2/s:', ', '.join('{:.2f}'.format(D) for D in best_Ds))
+        return best_init, best_fin, best_Ds
 
 
     def invert(self, grid_xyz, symmetry_constraint=True, 
@@ -1038,9 +1446,9 @@ class Block():
             for peak in (peaks):
                 heights = []
                 for spec in prof.spectra:
-                    idx = np.abs(peak - spec.base_wn).argmin()
+                    idx = spec.index_nearest(peak, base=True)
                     height_base = spec.base_abs[idx]
-                    idx = np.abs(peak - spec.wn_full).argmin()
+                    idx = spec.index_nearest(peak)
                     height_abs = spec.abs_full_cm[idx]                        
                     height = height_abs - height_base
                     heights.append(height)
@@ -16,6 +16,7 @@ the expected diffusivity at a given temperature.
 from __future__ import print_function, division, absolute_import
 from pynams import styles
 import numpy as np
+import scipy.special
 import matplotlib.pyplot as plt
 import matplotlib.lines as mlines
 from mpl_toolkits.axes_grid1.parasite_axes import SubplotHost
@@ -105,6 +106,116 @@ def whatIsD(Ea, D0, celsius, printout=True):
     return D
 
 
+def integrate_Dt(Ea, D0, times_seconds, celsius):
+    """
+    Takes activation energy in kJ/mol, D0 in m2/s, and a temperature-time
+    path as lists of times in seconds and temperatures in celsius, with
+    the temperature changing linearly between them, e.g., 
+    times_seconds=[0, 600, 4200, 4260] and celsius=[25, 1000, 1000, 25] 
+    for a 10 minute ramp up, 1 hour at 1000 C, and a 1 minute quench.
+    
+    Returns the integral of D over time in m2, which takes the place of
+    D*t in the isothermal diffusion equations. Ea and D0 can be arrays,
+    in which case the result is an array of the same shape.
+    
+    Along a linear ramp from T1 to T2 in kelvin, the integral of 
+    exp(-a/T) dt with a = Ea/R is (F(T2) - F(T1)) dt / (T2 - T1), where 
+    F(T) = T exp(-a/T) - a E1(a/T) and E1 is the exponential integral, 
+    so there's no need to step through the path.
+    """
+    try:
+        Ea = Ea.n
+    except AttributeError:
+        pass
+    try:
+        D0 = D0.n
+    except AttributeError:
+        pass
+
+    t = np.asarray(times_seconds, dtype=float)
+    T = np.asarray(celsius, dtype=float) + 273.15
+    if (t.ndim != 1) or (np.shape(t) != np.shape(T)) or (len(t) < 2):
+        print('Need lists of at least 2 times and temperatures of the '
+              'same length')
+        return
+    if np.any(np.diff(t) < 0):
+        print('Times must not go backwards')
+        return
+
+    a = np.asarray(Ea, dtype=float)[..., np.newaxis] / GAS_CONSTANT
+    dt = np.diff(t)
+    dT = np.diff(T)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        F = (T * np.exp(-a / T)) - (a * scipy.special.exp1(a / T))
+        ramps = dt * np.diff(F, axis=-1) / dT
+        # treat nearly flat segments as isothermal to avoid dividing
+        # tiny differences by tiny differences
+        flat = dt * np.exp(-a / ((T[1:] + T[:-1]) / 2.))
+    isothermal = (np.abs(dT) < 1e-3) | (a == 0.)
+    segments = np.where(isothermal, flat, ramps)
+    Dt = np.asarray(D0, dtype=float) * np.sum(segments, axis=-1)
+    return Dt[()]
+
+
+def effective_log10D(Ea, D0, times_seconds, celsius):
+    """
+    Takes activation energy in kJ/mol, D0 in m2/s, and a temperature-time
+    path (see integrate_Dt). Returns the log10 diffusivity in m2/s that 
+    would give the same diffusion over the total time of the path at a 
+    single temperature. Use it with the total time, 
+    times_seconds[-1] - times_seconds[0], in any of the isothermal 
+    diffusion models.
+    """
+    Dt = integrate_Dt(Ea, D0, times_seconds, celsius)
+    if Dt is None:
+        return
+    total_time = times_seconds[-1] - times_seconds[0]
+    if total_time <= 0:
+        print('The temperature-time path needs to take some time')
+        return
+    with np.errstate(divide='ignore'):
+        return np.log10(Dt / total_time)
+
+
+def effective_log10D_slope(Ea, times_seconds, celsius):
+    """
+    Takes activation energy in kJ/mol and a temperature-time path (see 
+    integrate_Dt). Returns the derivative of effective_log10D with 
+    respect to Ea in per kJ/mol, which does not depend on D0:
+        d log10Deff / dEa = -integral(D/RT dt) / (ln(10) integral(D dt))
+    Ea can be an array.
+    
+    Along a linear ramp, the integral of exp(-a/T) / T dt is 
+    (E1(a/T2) - E1(a/T1)) dt / (T2 - T1), since the derivative of 
+    E1(a/T) with respect to T is exp(-a/T) / T.
+    """
+    try:
+        Ea = Ea.n
+    except AttributeError:
+        pass
+
+    t = np.asarray(times_seconds, dtype=float)
+    T = np.asarray(celsius, dtype=float) + 273.15
+    Dt = integrate_Dt(Ea, 1., times_seconds, celsius)
+    if Dt is None:
+        return
+
+    a = np.asarray(Ea, dtype=float)[..., np.newaxis] / GAS_CONSTANT
+    dt = np.diff(t)
+    dT = np.diff(T)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        G = scipy.special.exp1(a / T)
+        ramps = dt * np.diff(G, axis=-1) / dT
+        Tmid = (T[1:] + T[:-1]) / 2.
+        flat = dt * np.exp(-a / Tmid) / Tmid
+    isothermal = (np.abs(dT) < 1e-3) | (a == 0.)
+    segments = np.where(isothermal, flat, ramps)
+    DRt = np.sum(segments, axis=-1) / GAS_CONSTANT
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = -DRt / (np.log(10.) * Dt)
+    return slope[()]
+
+
 class Diffusivities():
     def __init__(self, 
                 description=None, 
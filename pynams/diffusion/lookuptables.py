@@ -0,0 +1,327 @@
+"""
+Precomputed dimensionless lookup tables for diffusion models.
+
+Every 1D diffusion profile in a plane sheet depends only on the
+dimensionless position x/L and the Fourier number F = D*t/L**2, where L
+is the length (thickness) of the sheet, and the 3D models are products
+of 1D profiles. The tables here hold:
+    erf: unit 1D profiles (initial=1, final=0) from the error function
+        solution used by default in models.diffusion1D_array
+    infsum: unit 1D profiles from the fully converged infinite sum
+    slab: C/C0 for diffusion out of a thin slab (Crank Eq. 4.18), as in
+        models.diffusionThinSlab
+on a grid of log10(F) and w = s / (s + sqrt(F)), where s is the
+distance from the nearest edge divided by L. Near the edges, the
+profiles change over distances of about sqrt(F), so in terms of w they
+look nearly the same for all F, and the table resolves them equally
+well for short and long times.
+
+The evaluators (unit_profile, thin_slab, diffusion1D, unit_profiles3D)
+interpolate linearly in the tables and broadcast over arrays of
+positions, diffusivities, times, and lengths, so very large grids of
+models are just table lookups. Fourier numbers outside of the tables
+are calculated directly instead. With the default grid, the
+interpolated profiles are within about 1e-4 of the exact solutions.
+
+The tables are saved in a versioned .npz file (TABLE_FILE) next to this
+module. If the file is missing or out of date, it is rebuilt the first
+time it is needed, which takes a few seconds. To build it ahead of time,
+run
+    python -m pynams.diffusion.lookuptables
+
+@author Elizabeth Ferriss
+"""
+from __future__ import print_function, division, absolute_import
+import numpy as np
+import os
+import scipy.special
+
+TABLE_VERSION = 1
+TABLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'diffusion_tables_v{}.npz'.format(TABLE_VERSION))
+
+# default grid
+LOG10F_MIN = -7.
+LOG10F_MAX = 1.
+FOURIER_STEPS = 801
+EDGE_POINTS = 401
+
+# tables once loaded
+tables = None
+
+
+def erf_profile(xi, fourier):
+    """
+    Unit 1D profile from the error function solution at dimensionless
+    positions xi = x/L (centered) and Fourier numbers F = D*t/L**2
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        twice_root = 2. * np.sqrt(fourier)
+        profile = (scipy.special.erf((0.5 + xi) / twice_root) +
+                   scipy.special.erf((0.5 - xi) / twice_root) - 1.)
+    return np.where(np.isfinite(profile), profile, 1.)
+
+
+def infsum_profile(xi, fourier, tolerance=np.finfo(float).eps):
+    """
+    Unit 1D profile from the infinite sum solution at dimensionless
+    positions xi = x/L (centered) and Fourier numbers F = D*t/L**2 for a
+    1D array of fourier numbers. Every Fourier number gets as many terms
+    as it needs to converge, so this is slow for very small F.
+
+    Returns an array with one row per Fourier number and one column per
+    position.
+    """
+    xi = np.asarray(xi, dtype=float)
+    fourier = np.atleast_1d(np.asarray(fourier, dtype=float))
+    profiles = np.zeros((len(fourier), len(xi)))
+    for idx, F in enumerate(fourier):
+        if F <= 0:
+            profiles[idx] = 1.
+            continue
+        nterms = int(np.ceil((np.sqrt(-np.log(tolerance) /
+                                      (F * np.pi**2)) - 1.) / 2.)) + 1
+        n = np.arange(nterms)
+        odd = (2.*n) + 1.
+        coefficients = (((-1.)**n) / odd) * np.exp(-(odd**2) * (np.pi**2) * F)
+        profiles[idx] = (np.dot(coefficients, np.cos(np.outer(odd, np.pi*xi)))
+                         * 4. / np.pi)
+    return profiles
+
+
+def slab_series(fourier):
+    """
+    C/C0 for diffusion out of a thin slab (Crank Eq. 4.18) with Fourier
+    number F = D*t/thickness**2, summed to convergence.
+    """
+    fourier = np.asarray(fourier, dtype=float)
+    cc = np.zeros_like(fourier)
+    nterms = int(np.ceil((np.sqrt(-np.log(np.finfo(float).eps) /
+                                  (np.min(fourier) * np.pi**2)) - 1.) / 2.)) + 1
+    for n in range(nterms):
+        odd2 = (((2.*n) + 1.)**2) * (np.pi**2)
+        cc = cc + (8. / odd2) * np.exp(-odd2 * fourier)
+    return cc
+
+
+def build_tables(filename=None, log10F_min=LOG10F_MIN, log10F_max=LOG10F_MAX,
+                 fourier_steps=FOURIER_STEPS, edge_points=EDGE_POINTS,
+                 save=True):
+    """
+    Calculates the lookup tables on a grid of fourier_steps values of
+    log10(F) from log10F_min to log10F_max and edge_points distances from
+    the edge and saves them to filename (default TABLE_FILE) unless
+    save=False.
+
+    Returns a dictionary of the tables and grids.
+    """
+    log10F = np.linspace(log10F_min, log10F_max, fourier_steps)
+    fourier = 10.**log10F
+    # scaled distance from the edge; past the middle it stays at the middle
+    w = np.linspace(0., 1., edge_points)
+    with np.errstate(divide='ignore'):
+        s = np.sqrt(fourier)[:, np.newaxis] * (w / (1. - w))[np.newaxis, :]
+    xi = 0.5 - np.clip(s, 0., 0.5)
+
+    infsum = np.empty_like(xi)
+    for j in range(fourier_steps):
+        infsum[j] = infsum_profile(xi[j], fourier[j])[0]
+
+    built = {'version' : np.array(TABLE_VERSION),
+             'log10F' : log10F,
+             'w' : w,
+             'erf' : erf_profile(xi, fourier[:, np.newaxis]),
+             'infsum' : infsum,
+             'slab' : slab_series(fourier)}
+
+    if save is True:
+        if filename is None:
+            filename = TABLE_FILE
+        try:
+            np.savez(filename, **built)
+        except (IOError, OSError):
+            print('Could not save diffusion lookup tables to', filename)
+    return built
+
+
+def load_tables(filename=None, rebuild=False):
+    """
+    Returns the lookup tables from filename (default TABLE_FILE),
+    building and saving them first if the file is missing or from an
+    older version or if rebuild=True. The tables are kept in memory
+    after the first time.
+    """
+    global tables
+    if (tables is not None) and (filename is None) and (rebuild is False):
+        return tables
+
+    if filename is None:
+        filename = TABLE_FILE
+
+    loaded = None
+    if (rebuild is False) and os.path.isfile(filename):
+        try:
+            with np.load(filename) as data:
+                if int(data['version']) == TABLE_VERSION:
+                    loaded = dict((key, data[key]) for key in data.files)
+        except (IOError, OSError, ValueError, KeyError):
+            loaded = None
+
+    if loaded is None:
+        print('Building diffusion lookup tables. This only happens once.')
+        loaded = build_tables(filename)
+
+    tables = loaded
+    return tables
+
+
+def interpolate_table(table, log10F, s):
+    """
+    Interpolates linearly in a 2D table (or 1D if s is None) at
+    log10(F) and distances s from the nearest edge, divided by the 
+    length, which are broadcast against each other. Values must be 
+    within the table's range.
+    """
+    grids = load_tables()
+    log10F_grid = grids['log10F']
+    step = log10F_grid[1] - log10F_grid[0]
+    j = (log10F - log10F_grid[0]) / step
+    j0 = np.clip(np.floor(j).astype(int), 0, len(log10F_grid) - 2)
+    wj = j - j0
+
+    if s is None:
+        return ((1. - wj) * table[j0]) + (wj * table[j0 + 1])
+
+    w_grid = grids['w']
+    w = s / (s + np.sqrt(10.**log10F))
+    k = (w - w_grid[0]) / (w_grid[1] - w_grid[0])
+    k0 = np.clip(np.floor(k).astype(int), 0, len(w_grid) - 2)
+    wk = k - k0
+
+    low = ((1. - wk) * table[j0, k0]) + (wk * table[j0, k0 + 1])
+    high = ((1. - wk) * table[j0 + 1, k0]) + (wk * table[j0 + 1, k0 + 1])
+    return ((1. - wj) * low) + (wj * high)
+
+
+def unit_profile(xi, fourier, erf_or_sum='erf'):
+    """
+    Looks up unit 1D diffusion profiles (initial=1, final=0) at
+    dimensionless positions xi = x/L, centered, from -0.5 to 0.5, and
+    Fourier numbers F = D*t/L**2, which are broadcast against each other.
+
+    erf_or_sum is 'erf' (default) for the error function solution or
+    'infsum' for the infinite sum solution. Returns None if erf_or_sum is
+    not recognized.
+    """
+    if erf_or_sum not in ['erf', 'infsum']:
+        print('erf_or_sum must be "erf" or "infsum"')
+        return
+    grids = load_tables()
+    xi, fourier = np.broadcast_arrays(np.asarray(xi, dtype=float),
+                                      np.asarray(fourier, dtype=float))
+    s = 0.5 - np.abs(xi)
+    with np.errstate(divide='ignore'):
+        log10F = np.log10(fourier)
+
+    inside = ((log10F >= grids['log10F'][0]) &
+              (log10F <= grids['log10F'][-1]))
+    profile = np.empty(xi.shape)
+    profile[inside] = interpolate_table(grids[erf_or_sum], log10F[inside],
+                                        s[inside])
+
+    # Outside the table. The two solutions are the same for small F, and
+    # only the first term of the sum is left for large F.
+    outside = ~inside
+    if erf_or_sum == 'erf':
+        profile[outside] = erf_profile(xi[outside], fourier[outside])
+    else:
+        small = outside & (log10F < grids['log10F'][0])
+        large = outside & (log10F > grids['log10F'][-1])
+        profile[small] = erf_profile(xi[small], fourier[small])
+        profile[large] = ((4. / np.pi) * np.cos(np.pi * xi[large]) *
+                          np.exp(-(np.pi**2) * fourier[large]))
+    return profile
+
+
+def thin_slab(fourier):
+    """
+    Looks up C/C0 for diffusion out of a thin slab (Crank Eq. 4.18) with
+    Fourier numbers F = D*t/thickness**2. Outside of the table, the
+    short-time and long-time limits are used instead.
+    """
+    grids = load_tables()
+    fourier = np.asarray(fourier, dtype=float)
+    with np.errstate(divide='ignore'):
+        log10F = np.log10(fourier)
+    small = log10F < grids['log10F'][0]
+    large = log10F > grids['log10F'][-1]
+    inside = ~(small | large)
+
+    cc = np.empty(fourier.shape)
+    cc[inside] = interpolate_table(grids['slab'], log10F[inside], None)
+    cc[small] = 1. - 4. * np.sqrt(fourier[small] / np.pi)
+    cc[large] = (8. / np.pi**2) * np.exp(-(np.pi**2) * fourier[large])
+    return cc
+
+
+def diffusion1D(x_meters, length_meters, D_m2s, time_seconds, init=1.,
+                fin=0., erf_or_sum='erf', symmetric=True):
+    """
+    Table version of models.diffusion1D_array. Takes positions x_meters
+    centered on the middle of the profile, the profile length in meters,
+    the diffusivity in m2/s, and the time in seconds.
+
+    length_meters, D_m2s, and time_seconds can also be arrays, which are
+    broadcast against each other, in which case one profile is returned
+    for each, in an array with shape (broadcast shape, len(x_meters)).
+
+    Returns None if any times are negative or erf_or_sum is not
+    recognized.
+    """
+    x = np.asarray(x_meters, dtype=float)
+    length, D, t = np.broadcast_arrays(np.asarray(length_meters, dtype=float),
+                                       np.asarray(D_m2s, dtype=float),
+                                       np.asarray(time_seconds, dtype=float))
+    if np.any(t < 0):
+        return
+
+    fourier = D * t / length**2
+    if (erf_or_sum == 'erf') and (symmetric is False):
+        # the error function is for twice the length
+        fourier = fourier / 4.
+    xi = x / length[..., np.newaxis]
+
+    unit = unit_profile(xi, fourier[..., np.newaxis], erf_or_sum=erf_or_sum)
+    if unit is None:
+        return
+    return fin + (unit * (init - fin))
+
+
+def unit_profiles3D(lengths_microns, log10Ds_m2s, time_seconds, points=50):
+    """
+    Table version of models.unit_profiles3D_array, which takes the same
+    input and returns lists of the positions (centered, in microns) and
+    values of the three 1D unit profiles from the error function
+    solution. Returns None if the time is negative.
+    """
+    if time_seconds < 0:
+        print('time must not be negative')
+        return
+    xprofiles = []
+    yprofiles = []
+    xi = np.linspace(-0.5, 0.5, points)
+    for microns, log10D in zip(lengths_microns, log10Ds_m2s):
+        L_meters = float(microns) / 1e6
+        fourier = (10.**log10D) * time_seconds / L_meters**2
+        xprofiles.append(xi * float(microns))
+        yprofiles.append(unit_profile(xi, fourier))
+    return xprofiles, yprofiles
+
+
+if __name__ == '__main__':
+    built = load_tables(rebuild=True)
+    print('Saved diffusion lookup tables version', TABLE_VERSION, 'to')
+    print(TABLE_FILE)
+    print('log10(D*t/L**2) from', built['log10F'][0], 'to',
+          built['log10F'][-1], 'in', len(built['log10F']), 'steps')
+    print(len(built['w']), 'distances from the edge')
@@ -0,0 +1,171 @@
+"""
+Memory cache for the diffusion models in pynams.diffusion.models.
+
+Replotting the same diffusion curves over and over again, e.g., with
+Profile.plot_diffusion and Block.plot_diffusion, makes the same 1D
+profiles, 3D matrices, and whole-block profiles over and over again.
+diffusion1D_params, diffusion3Dnpi_params, and diffusion3Dwb_params
+(and so diffusion1D, diffusion3Dnpi, and diffusion3Dwb) save what they
+make in a single least-recently-used cache, keyed on their inputs
+rounded to 12 significant figures, and hand back copies the next time
+they are asked for the same thing. Fitting to data always recalculates.
+
+The cache keeps at most maxsize models and max_megabytes of arrays and
+drops the least recently used models to make room. Check how it is
+doing with pynams.diffusion.modelcache.cache.stats().
+
+To turn the cache off everywhere, set
+pynams.diffusion.modelcache.enabled = False.
+
+@author Elizabeth Ferriss
+"""
+from __future__ import print_function, division, absolute_import
+import numpy as np
+import copy
+from collections import OrderedDict
+
+enabled = True
+SIGNIFICANT_FIGURES = 12
+
+
+def round_value(value):
+    """
+    Returns a hashable version of value for use in cache keys with all
+    numbers rounded to SIGNIFICANT_FIGURES. Handles numbers, strings,
+    None, lists, tuples, dictionaries, and numpy arrays and dtypes.
+    """
+    if isinstance(value, (bool, np.bool_)) or value is None:
+        return value
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return float('{:.{}g}'.format(float(value), SIGNIFICANT_FIGURES))
+    if isinstance(value, (str, bytes)):
+        return value
+    if isinstance(value, dict):
+        return tuple((key, round_value(value[key])) for key in value)
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(round_value(item) for item in value)
+    if isinstance(value, (type, np.dtype)):
+        return str(np.dtype(value))
+    return repr(value)
+
+
+def make_key(name, *args, **kwargs):
+    """
+    Returns a cache key for the model called name made with the
+    positional and keyword arguments args and kwargs
+    """
+    options = tuple((key, round_value(kwargs[key])) for key in
+                    sorted(kwargs))
+    return (name, round_value(args), options)
+
+
+def result_nbytes(result):
+    """Returns the number of bytes in all of the arrays in result"""
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    if isinstance(result, (list, tuple)):
+        return sum(result_nbytes(item) for item in result)
+    return 0
+
+
+class ModelCache():
+    """
+    Least-recently-used cache of diffusion models holding up to maxsize
+    models and up to max_megabytes of arrays. Keeps track of hits
+    (models found in the cache), misses, and evictions.
+    """
+    def __init__(self, maxsize=64, max_megabytes=256.):
+        self.maxsize = maxsize
+        self.max_megabytes = max_megabytes
+        self.models = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, key):
+        """
+        Returns a copy of the model saved under key, or None if it
+        isn't in the cache.
+        """
+        try:
+            result, nbytes = self.models.pop(key)
+        except KeyError:
+            self.misses = self.misses + 1
+            return
+        # put it back at the most recently used end
+        self.models[key] = (result, nbytes)
+        self.hits = self.hits + 1
+        return copy.deepcopy(result)
+
+
+    def put(self, key, result):
+        """
+        Saves a copy of result under key, dropping the least recently
+        used models if there are too many or they take up too much
+        memory. Results bigger than max_megabytes are not saved.
+        """
+        nbytes = result_nbytes(result)
+        if nbytes > self.max_megabytes * 1e6:
+            return
+        if key in self.models:
+            self.nbytes = self.nbytes - self.models.pop(key)[1]
+        self.models[key] = (copy.deepcopy(result), nbytes)
+        self.nbytes = self.nbytes + nbytes
+        while ((len(self.models) > self.maxsize) or
+               (self.nbytes > self.max_megabytes * 1e6)):
+            old_result, old_nbytes = self.models.popitem(last=False)[1]
+            self.nbytes = self.nbytes - old_nbytes
+            self.evictions = self.evictions + 1
+
+
+    def clear(self):
+        """Empties the cache and resets the statistics"""
+        self.models.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def stats(self):
+        """
+        Returns a dictionary with the number of hits, misses, evictions,
+        models in the cache, megabytes used, and the fraction of lookups
+        that were hits.
+        """
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            hit_rate = 0.
+        else:
+            hit_rate = self.hits / lookups
+        return {'hits' : self.hits,
+                'misses' : self.misses,
+                'evictions' : self.evictions,
+                'size' : len(self.models),
+                'megabytes' : self.nbytes / 1e6,
+                'hit_rate' : hit_rate}
+
+
+cache = ModelCache()
+
+
+def lookup(key):
+    """
+    Returns a copy of the model saved under key in the shared cache, or
+    None if it isn't there or the cache is turned off.
+    """
+    if enabled is False:
+        return
+    return cache.get(key)
+
+
+def store(key, result):
+    """
+    Saves result under key in the shared cache unless the cache is
+    turned off. Returns result.
+    """
+    if (enabled is True) and (result is not None):
+        cache.put(key, result)
+    return result
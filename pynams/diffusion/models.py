@@ -22,42 +22,102 @@ Simplest: diffusion3Dnpi(lengths, D's, time) to get a figure
     Step 2. Pass parameters into diffusion3Dwb(params)
     Requires raypath information, unlike 3Dnpi
 
+### Temperature-time paths ###
+For ramps and quenches, set up Arrhenius parameters (Ea and D0) with
+params_setup1D_path or params_setup3D_path and pass a temperature-time 
+path to diffusion1D_path_params or diffusion3Dwb_path_params.
+fit_arrhenius fits Ea and D0 to many experiments at once.
+
+### Finite-difference models for non-uniform starting conditions ###
+1D: crank_nicolson1D, or diffusion1D_numerical_params for fitting
+3D: adi3D, and diffusion3D_stages for multi-stage heating experiments
+    diffusion3Dwb_numerical_params for whole-block profiles and fitting
+
 """
 from __future__ import print_function, division, absolute_import
 import pynams.styles as styles
+from pynams.diffusion import modelcache
+from pynams.diffusion import lookuptables
+from pynams.diffusion import diffusivities
 import numpy as np
 import lmfit
 import scipy
+import scipy.special
+import scipy.linalg
+import scipy.sparse
+from scipy.optimize import least_squares
+from concurrent import futures
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1.parasite_axes import SubplotHost
 
 
 #%% 1D Diffusion in a thin slab; Eq 4.18 in Crank, 1975
 def diffusionThinSlab(log10D_m2s, thickness_microns, max_time_hours=2000, 
-                      infinity=200, timesteps=300):
+                      infinity=200, timesteps=300, lookup=False):
     """ 
     Eq 4.18 in Crank, 1975
     Takes log10 of the diffusivity D in m2/s, thickness in microns,
     and maximum time in hours, and returns time array in hours and 
     corresponding curve of C/C0, the concentration divided by the 
     initial concentration.
+    
+    log10D_m2s and thickness_microns can also be lists or arrays, which
+    are broadcast against each other, in which case C/C0 is returned as
+    a matrix with one row per diffusivity/thickness and one column per 
+    time. 
+    
+    The series is truncated separately for each diffusivity and time 
+    once the exponential term drops below machine epsilon, and each term
+    is only computed where it is needed, so infinity is only an upper 
+    limit on the number of terms. At time zero C/C0 is exactly 1.
+    
+    Set lookup=True to interpolate in a precomputed table instead of 
+    summing the series (see lookuptables), which is much faster for 
+    many diffusivities and thicknesses at once and good to about 1e-5.
     """
     t_hours = np.linspace(0., max_time_hours, timesteps)
     t_seconds = t_hours * 3600.
-    L_meters = thickness_microns / 2.E6
-    cc = np.zeros_like(t_seconds)
-    D_m2s = 10.**log10D_m2s
-
-    for idx in range(len(t_seconds)):
-        infsum = 0.
-        for n in range(infinity):
-            exponent_top = D_m2s * (((2.*n)+1.)**2.) * (np.pi**2.) * t_seconds[idx] 
-            exponent_bot = 4. * (L_meters**2)
-            exponent = np.exp(-1. * exponent_top / exponent_bot)
-            addme = 8. * (1. / ((((2.*n)+1)**2.) * (np.pi**2.))) * exponent
-            infsum = infsum + addme
-        cc[idx] = infsum
+    batch = (np.ndim(log10D_m2s) > 0) or (np.ndim(thickness_microns) > 0)
+    log10D, thickness = np.broadcast_arrays(np.atleast_1d(log10D_m2s),
+                                            np.atleast_1d(thickness_microns))
+    D_m2s = 10.**np.asarray(log10D, dtype=float)
+    L_meters = np.asarray(thickness, dtype=float) / 2.E6
+
+    # dimensionless time (Fourier number) for each D and time
+    fourier = (D_m2s / (4. * L_meters**2))[:, None] * t_seconds[None, :]
+    
+    if lookup is True:
+        cc = lookuptables.thin_slab(fourier)
+        if batch is False:
+            cc = cc[0]
+        return t_hours, cc
+
+    # number of terms needed before exp(-(2n+1)**2 pi**2 F) < epsilon
+    cutoff = -np.log(np.finfo(float).eps) / (np.pi**2)
+    with np.errstate(divide='ignore'):
+        nterms = np.ceil((np.sqrt(cutoff / fourier) - 1.) / 2.) + 1.
+    nterms = np.clip(nterms, 1, infinity)
     
+    # add up the series one term at a time, only for the entries that
+    # still need that term; sorting by the number of terms needed keeps 
+    # those entries together at the front
+    order = np.argsort(-nterms, axis=None, kind='mergesort')
+    fourier_sorted = fourier.ravel()[order]
+    needed = np.searchsorted(-nterms.ravel()[order], 
+                             -np.arange(1, int(np.max(nterms)) + 1), 
+                             side='right')
+    cc_sorted = np.zeros(fourier_sorted.shape)
+    for n, count in enumerate(needed):
+        odd2 = (((2.*n) + 1.)**2) * (np.pi**2)
+        cc_sorted[:count] += (8. / odd2) * np.exp(-odd2 * 
+                                                  fourier_sorted[:count])
+    cc = np.empty(fourier.size)
+    cc[order] = cc_sorted
+    cc = cc.reshape(fourier.shape)
+    cc[fourier == 0.] = 1.
+
+    if batch is False:
+        cc = cc[0]
     return t_hours, cc
     
 
@@ -80,6 +140,146 @@ def params_setup1D(microns, log10D_m2s, time_seconds, init=1., fin=0.,
     return params
 
 
+def infinite_sum1D(x_meters, D_m2s, time_seconds, length_meters, 
+                   infinity=100):
+    """
+    Infinite sum solution for diffusion out of a plane sheet of 
+    thickness length_meters with x_meters centered on the middle of the 
+    sheet. Returns unit concentrations (initial=1, final=0) at x_meters.
+    
+    All of the terms are evaluated at once as a matrix with one row for
+    each term and one column for each position. The series is cut off 
+    at the first term whose time component drops below machine epsilon,
+    or at infinity terms, whichever comes first.
+    """
+    x = np.asarray(x_meters, dtype=float)
+    n = np.arange(infinity)
+    odd = (2.*n) + 1.
+    # time component, which decreases with n
+    time_factor = np.exp(-D_m2s * (odd**2) * (np.pi**2) * time_seconds / 
+                         (length_meters**2))
+    nterms = max(1, np.count_nonzero(time_factor > np.finfo(float).eps))
+    odd = odd[:nterms]
+    # positive number that converges to 1 times the time component
+    coefficients = (((-1.)**n[:nterms]) / odd) * time_factor[:nterms]
+    # where the position values come in to create the profile
+    cosines = np.cos(np.outer(odd, np.pi * x.ravel() / length_meters))
+    xsum = np.dot(coefficients, cosines).reshape(x.shape)
+    return xsum * 4. / np.pi
+
+
+def diffusion1D_array(x_meters, length_meters, D_m2s, time_seconds, 
+                      init=1., fin=0., erf_or_sum='erf', symmetric=True,
+                      infinity=100):
+    """
+    Forward model for 1D diffusion that takes plain numbers and arrays 
+    instead of lmfit parameters, so it can be called over and over again
+    during fitting without any extra overhead.
+    
+    Requires positions x_meters centered on the middle of the profile,
+    the profile length in meters, diffusivity D in m2/s, and the time in 
+    seconds. Other keywords are as in diffusion1D_params.
+    
+    Returns the model values at x_meters, or None if the time is negative
+    or erf_or_sum is not recognized.
+    """
+    x = np.asarray(x_meters, dtype=float)
+    a_meters = length_meters / 2.
+    twoA = length_meters
+    t = time_seconds
+    D = D_m2s
+
+    if t < 0:
+        return
+
+    if init > fin:
+        going_out = True
+        solubility = init
+        minimum_value = fin
+    else:
+        going_out = False        
+        solubility = fin
+        minimum_value = init
+
+    # Make the infinite sum
+    if erf_or_sum == 'infsum':
+        model = infinite_sum1D(x, D, t, twoA, infinity=infinity)
+    
+    # or make the error function
+    elif erf_or_sum == 'erf':
+        if symmetric is False:
+            a_meters = a_meters*2
+            x = x*2
+            
+        sqrtDt = (D*t)**0.5
+        model = ((scipy.special.erf((a_meters+x)/(2*sqrtDt))) + 
+                   (scipy.special.erf((a_meters-x)/(2*sqrtDt))) - 1) 
+        
+    else:
+        print ('erf_or_sum must be set to either "erf" for python built-in ' +
+               'error function approximation (defaul) or "sum" for infinite ' +
+               'sum approximation with infinity=whatever, defaulting to ' + 
+               str(infinity))
+        return
+
+    if going_out is False:
+        model = np.ones_like(model) - model
+
+    concentration_range = solubility - minimum_value
+    model = (model * concentration_range) + minimum_value
+    return model
+
+
+def diffusion1D_jacobian(x_meters, length_meters, D_m2s, time_seconds, 
+                         init=1., fin=0., symmetric=True):
+    """
+    Analytical partial derivatives of the erf solution in 
+    diffusion1D_array at positions x_meters (centered), which saves the 
+    extra forward models that finite differences need during fitting. 
+    
+    The model is fin + u * (init - fin), where u is the unit erf profile,
+    so the derivatives with respect to init and fin are u and 1 - u. 
+    u depends on D and t only through D*t, and 
+    du/d(ln D) = t du/dt = -(z1 exp(-z1**2) + z2 exp(-z2**2)) / sqrt(pi)
+    with z1,2 = (a +/- x) / (2 sqrt(Dt)).
+    
+    Returns an array with one row per position and columns for the 
+    derivatives with respect to log10 D, time in seconds, and the initial 
+    and final unit values, or None if the time is negative. D, time, 
+    init, and fin can also be arrays that broadcast against x_meters, 
+    e.g., one row of each for many profiles at once, in which case the 
+    derivatives are along a new last axis.
+    """
+    x = np.asarray(x_meters, dtype=float)
+    a_meters = length_meters / 2.
+    t = time_seconds
+    if np.any(np.asarray(t) < 0):
+        return
+
+    if symmetric is False:
+        a_meters = a_meters*2
+        x = x*2
+
+    sqrtDt = (D_m2s*t)**0.5
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        z1 = (a_meters+x)/(2*sqrtDt)
+        z2 = (a_meters-x)/(2*sqrtDt)
+        unit = scipy.special.erf(z1) + scipy.special.erf(z2) - 1
+        slope = -(z1*np.exp(-z1**2) + z2*np.exp(-z2**2)) / np.sqrt(np.pi)
+        slope_time = slope / t
+    # At t=0 or far from the edges the profile doesn't change at all
+    slope = np.where(np.isfinite(slope), slope, 0.)
+    slope_time = np.where(np.isfinite(slope_time), slope_time, 0.)
+    unit = np.where(np.isfinite(unit), unit, 1.)
+
+    jacobian = np.empty(np.shape(unit) + (4,))
+    jacobian[..., 0] = (init - fin) * np.log(10.) * slope
+    jacobian[..., 1] = (init - fin) * slope_time
+    jacobian[..., 2] = unit
+    jacobian[..., 3] = 1. - unit
+    return jacobian
+
+
 def diffusion1D_params(params, 
                        data_x_microns=None, 
                        data_y_unit_areas=None, 
@@ -87,7 +287,8 @@ def diffusion1D_params(params,
                        centered=True, 
                        symmetric=True,
                        infinity=100, 
-                       points=50):
+                       points=50,
+                       lookup=False):
     """
     Function set up to follow lmfit fitting requirements.
     See https://lmfit.github.io/lmfit-py/parameters.html
@@ -108,9 +309,14 @@ def diffusion1D_params(params,
      - whether the profile is symmetric or not. If not, change is to the right.
      - points sets how many points to calculate in profile. Default is 50.
      - what 'infinity' is if using infinite sum approximation
+     - lookup=True interpolates the model in precomputed tables 
+       (see lookuptables) instead of calculating it. The infinite sum
+       is then always fully converged, whatever infinity is.
      
     If not including data, returns the x vector and model y values.
     With data, return the residual for use in fitting.
+    
+    The model itself is calculated by diffusion1D_array.
     """
 
     p = params.valuesdict()
@@ -119,18 +325,7 @@ def diffusion1D_params(params,
     D = 10.**p['log10D_m2s']
     initial_value = p['initial_unit_value']
     final_value = p['final_unit_value']
-
-    if initial_value > final_value:
-        going_out = True
-        solubility = initial_value
-        minimum_value = final_value
-    else:
-        going_out = False        
-        solubility = final_value
-        minimum_value = initial_value
-    
     a_meters = L_meters / 2.
-    twoA = L_meters
 
     if t < 0:
         return           
@@ -151,58 +346,388 @@ def diffusion1D_params(params,
         x = np.array(data_x_microns) / 1e6
         x = x - a_meters
     else:
+        # same model as last time? See modelcache
+        key = modelcache.make_key('diffusion1D', p, erf_or_sum=erf_or_sum,
+                                  centered=centered, symmetric=symmetric,
+                                  infinity=infinity, points=points,
+                                  lookup=lookup)
+        cached = modelcache.lookup(key)
+        if cached is not None:
+            return cached
         x = np.linspace(-a_meters, a_meters, points)
     
-    # Make the infinite sum
-    if erf_or_sum == 'infsum':
-        xsum = np.zeros_like(x)
-        for n in range(infinity):
-           # positive number that converges to 1
-            xadd1 = ((-1.)**n) / ((2.*n)+1.)        
-            # time conponent
-            xadd2 = np.exp(
-                            (-D * (((2.*n)+1.)**2.) * (np.pi**2.) * t) / 
-                            (twoA**2.) 
-                            )                        
-            # Where the position values come in to create the profile
-            xadd3 = np.cos(
-                            ((2.*n)+1.) * np.pi * x / twoA
-                            )        
-            xadd = xadd1 * xadd2 * xadd3
-            xsum = xsum + xadd
-            
-        model = xsum * 4. / np.pi
-    
-    # or make the error function
-    elif erf_or_sum == 'erf':
-        if symmetric is False:
-            a_meters = a_meters*2
+    if lookup is True:
+        model = lookuptables.diffusion1D(x, L_meters, D, t, 
+                                         init=initial_value, 
+                                         fin=final_value, 
+                                         erf_or_sum=erf_or_sum, 
+                                         symmetric=symmetric)
+    else:
+        model = diffusion1D_array(x, L_meters, D, t, init=initial_value, 
+                                  fin=final_value, erf_or_sum=erf_or_sum, 
+                                  symmetric=symmetric, infinity=infinity)
+    if model is None:
+        return False
+
+    # If not including data, just return the model values
+    # With data, return the residual for use in fitting.
+    if fitting is False:
+        if (erf_or_sum == 'erf') and (symmetric is False):
             x = x*2
-            
-        sqrtDt = (D*t)**0.5
-        model = ((scipy.special.erf((a_meters+x)/(2*sqrtDt))) + 
-                   (scipy.special.erf((a_meters-x)/(2*sqrtDt))) - 1) 
+        x_microns = x * 1e6
+        return modelcache.store(key, (x_microns, model))
+    return model - data_y_unit_areas
+
+
+def diffusion1D_params_jacobian(params, data_x_microns, data_y_unit_areas,
+                                erf_or_sum='erf', centered=True, 
+                                symmetric=True, infinity=100, points=50):
+    """
+    Jacobian of the residuals from diffusion1D_params with respect to the 
+    parameters that vary, in the form lmfit wants for its Dfun keyword:
+        lmfit.minimize(diffusion1D_params, params, args=(x, y),
+                       Dfun=diffusion1D_params_jacobian)
+                       
+    Only works for the error function solution (erf_or_sum='erf').
+    See diffusion1D_jacobian.
+    """
+    p = params.valuesdict()
+    L_meters = p['microns'] / 1e6
+    x = (np.array(data_x_microns, dtype=float) / 1e6) - (L_meters / 2.)
+    jacobian = diffusion1D_jacobian(x, L_meters, 10.**p['log10D_m2s'], 
+                                    p['time_seconds'],
+                                    init=p['initial_unit_value'], 
+                                    fin=p['final_unit_value'],
+                                    symmetric=symmetric)
+    names = ['log10D_m2s', 'time_seconds', 'initial_unit_value', 
+             'final_unit_value']
+    columns = [names.index(name) for name in params 
+               if (name in names) and params[name].vary and 
+               (params[name].expr is None)]
+    return jacobian[:, columns]
+
+
+def fit_least_squares(residuals, start, vary, lower=None, upper=None,
+                      jac='2-point', **kwargs):
+    """
+    Fits a model directly with scipy.optimize.least_squares, without
+    lmfit, for the forward models in this module.
+    
+    Requires:
+        residuals: function that takes an array of all of the parameter 
+            values and returns an array of the residuals
+        start: starting values for all parameters
+        vary: list of True or False for whether to vary each parameter
+    
+    Optional input:
+        lower and upper: bounds on all of the parameters (default: none)
+        jac: function that takes all of the parameter values and returns
+            the Jacobian of the residuals with respect to *all* of them
+            (only the columns for parameters that vary are used), or a 
+            finite difference method name. Default '2-point'.
+        Other keywords are passed on to least_squares.
         
+    Returns:
+        best-fit values for all parameters (fixed ones stay put),
+        standard errors (0 for fixed parameters, None if they can't be
+            estimated), 
+        the least_squares result (None if nothing varies)
+    
+    The standard errors are from the covariance matrix scaled by the 
+    reduced chi-square, the same way lmfit does it.
+    """
+    start = np.array(start, dtype=float)
+    vary = np.array(vary, dtype=bool)
+    if lower is None:
+        lower = -np.inf * np.ones_like(start)
+    if upper is None:
+        upper = np.inf * np.ones_like(start)
+    lower = np.array(lower, dtype=float)[vary]
+    upper = np.array(upper, dtype=float)[vary]
+    
+    def all_values(free):
+        values = start.copy()
+        values[vary] = free
+        return values
+    
+    def free_residuals(free):
+        return residuals(all_values(free))
+    
+    if callable(jac):
+        def free_jac(free):
+            return np.asarray(jac(all_values(free)))[:, vary]
     else:
-        print ('erf_or_sum must be set to either "erf" for python built-in ' +
-               'error function approximation (defaul) or "sum" for infinite ' +
-               'sum approximation with infinity=whatever, defaulting to ' + 
-               str(infinity))
-        return False
+        free_jac = jac
+    
+    if not vary.any():
+        return start, [0.] * len(start), None
 
-    if going_out is False:
-        model = np.ones_like(model) - model
+    free_start = np.clip(start[vary], lower, upper)
+    result = least_squares(free_residuals, free_start, jac=free_jac,
+                           bounds=(lower, upper), **kwargs)
+    best = all_values(result.x)
+    
+    errors = [0.] * len(start)
+    for idx in np.where(vary)[0]:
+        errors[idx] = None
+    nresiduals = len(result.fun)
+    nfree = len(result.x)
+    if nresiduals > nfree:
+        try:
+            covariance = np.linalg.inv(np.dot(result.jac.T, result.jac))
+            covariance = covariance * 2. * result.cost / (nresiduals - nfree)
+            free_errors = np.sqrt(np.diag(covariance))
+            for idx, error in zip(np.where(vary)[0], free_errors):
+                errors[idx] = error
+        except np.linalg.LinAlgError:
+            pass
+    return best, errors, result
 
-    concentration_range = solubility - minimum_value
-    model = (model * concentration_range) + minimum_value
 
-    x_microns = x * 1e6
+def fit_diffusion1D(x_microns, y, length_microns, log10D_m2s, time_seconds, 
+                    init=1., fin=0., vD=True, vinit=False, vfin=False, 
+                    vTime=False, erf_or_sum='erf', symmetric=True, 
+                    infinity=100, jacobian=True):
+    """
+    Fits 1D diffusion to data directly with least squares using
+    diffusion1D_array. Takes the data positions (x_microns, measured from 
+    one edge) and unit values y and the same information as 
+    params_setup1D for the starting values and what to vary.
     
-    # If not including data, just return the model values
-    # With data, return the residual for use in fitting.
-    if fitting is False:
-        return x_microns, model
-    return model- data_y_unit_areas
+    The error function solution is fit with its analytical Jacobian 
+    (diffusion1D_jacobian) unless jacobian=False, which switches to 
+    finite differences.
+    
+    Returns dictionaries of the best-fit values and the standard errors
+    (see fit_least_squares), with the same names as in params_setup1D
+    """
+    names = ['log10D_m2s', 'time_seconds', 'initial_unit_value', 
+             'final_unit_value']
+    start = [log10D_m2s, time_seconds, init, fin]
+    vary = [vD, vTime, vinit, vfin]
+    lower = [-np.inf, 0., -np.inf, -np.inf]
+    L_meters = length_microns / 1e6
+    x = (np.array(x_microns, dtype=float) / 1e6) - (L_meters / 2.)
+    y = np.array(y, dtype=float)
+
+    def residuals(values):
+        model = diffusion1D_array(x, L_meters, 10.**values[0], values[1], 
+                                  init=values[2], fin=values[3],
+                                  erf_or_sum=erf_or_sum, 
+                                  symmetric=symmetric, infinity=infinity)
+        return model - y
+
+    def analytical_jacobian(values):
+        return diffusion1D_jacobian(x, L_meters, 10.**values[0], values[1],
+                                    init=values[2], fin=values[3], 
+                                    symmetric=symmetric)
+
+    if (jacobian is True) and (erf_or_sum == 'erf'):
+        jac = analytical_jacobian
+    else:
+        jac = '2-point'
+
+    best, errors, result = fit_least_squares(residuals, start, vary, 
+                                             lower=lower, jac=jac)
+    return dict(zip(names, best)), dict(zip(names, errors))
+
+
+def fit_diffusion1D_batch(x_microns, y, length_microns, log10D_m2s, 
+                          time_seconds, init=1., fin=0., vD=True, 
+                          vinit=False, vfin=False, vTime=False, 
+                          symmetric=True, max_iterations=100, 
+                          tolerance=1e-10):
+    """
+    Fits the erf model for 1D diffusion to many versions of the same 
+    profile at once, e.g., Monte Carlo copies with perturbed data, with 
+    a Levenberg-Marquardt loop in which every step for every fit is 
+    done together in numpy arrays.
+    
+    x_microns and y are 2D arrays with one row per fit, with the 
+    positions from 0 to length_microns. The starting values and what to
+    vary are as in fit_diffusion1D; the starting values can also be 
+    arrays with one value per fit. Each fit keeps its own damping and 
+    stops when its misfit or steps stop changing by more than tolerance, 
+    or after max_iterations. Steps that would make the time negative 
+    are turned down.
+    
+    Returns a dictionary of arrays with one value per fit:
+        log10D_m2s, time_seconds, initial_unit_value, final_unit_value:
+            best-fit values
+        and the same names plus '_error': standard errors (0 for 
+            parameters held constant)
+        rss: sum of squared residuals
+        converged: whether the fit converged before max_iterations
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    nfits, npoints = y.shape
+    L_meters = length_microns / 1e6
+    x = (np.broadcast_to(np.asarray(x_microns, dtype=float), y.shape) / 
+         1e6) - (L_meters / 2.)
+    names = ['log10D_m2s', 'time_seconds', 'initial_unit_value', 
+             'final_unit_value']
+    values = np.empty((nfits, 4))
+    for k, start in enumerate([log10D_m2s, time_seconds, init, fin]):
+        values[:, k] = start
+    vary = np.array([vD, vTime, vinit, vfin], dtype=bool)
+    nfree = vary.sum()
+
+    def evaluate(values, idx):
+        """Residuals and Jacobian columns for fits idx"""
+        with np.errstate(all='ignore'):
+            jacobian = diffusion1D_jacobian(x[idx], L_meters, 
+                                            10.**values[:, 0:1], 
+                                            values[:, 1:2], 
+                                            init=values[:, 2:3], 
+                                            fin=values[:, 3:4], 
+                                            symmetric=symmetric)
+        unit = jacobian[..., 2]
+        model = values[:, 3:4] + (unit * (values[:, 2:3] - values[:, 3:4]))
+        return model - y[idx], jacobian[..., vary]
+
+    everything = np.arange(nfits)
+    residuals, jacobian = evaluate(values, everything)
+    rss = np.sum(residuals**2, axis=1)
+    damping = 1e-3 * np.ones(nfits)
+    active = np.ones(nfits, dtype=bool) & (nfree > 0)
+    converged = np.zeros(nfits, dtype=bool) | (nfree == 0)
+    for iteration in range(max_iterations):
+        idx = np.where(active)[0]
+        if len(idx) == 0:
+            break
+        # damped normal equations for all of the active fits at once
+        J = jacobian[idx]
+        A = np.einsum('kni,knj->kij', J, J)
+        g = np.einsum('kni,kn->ki', J, residuals[idx])
+        diagonal = np.einsum('kii->ki', A) + 1e-30
+        scaled = A + (damping[idx, None, None] * 
+                      (diagonal[:, :, None] * np.eye(nfree)))
+        steps = -np.einsum('kij,kj->ki', np.linalg.pinv(scaled), g)
+
+        trial = values[idx].copy()
+        trial[:, vary] = trial[:, vary] + steps
+        new_residuals, new_jacobian = evaluate(trial, idx)
+        new_rss = np.sum(new_residuals**2, axis=1)
+        better = ((new_rss <= rss[idx]) & np.isfinite(new_rss) & 
+                  (trial[:, 1] >= 0.))
+
+        accepted = idx[better]
+        change = np.abs(rss[accepted] - new_rss[better])
+        small_step = np.all(np.abs(steps[better]) <= 
+                            tolerance * (np.abs(trial[better][:, vary]) + 
+                                         tolerance), axis=1)
+        values[accepted] = trial[better]
+        residuals[accepted] = new_residuals[better]
+        jacobian[accepted] = new_jacobian[better]
+        rss[accepted] = new_rss[better]
+        damping[accepted] = np.maximum(damping[accepted] / 3., 1e-12)
+        rejected = idx[~better]
+        damping[rejected] = damping[rejected] * 4.
+
+        done = accepted[(change <= tolerance * (rss[accepted] + tolerance)) |
+                        small_step]
+        # no step makes it any better
+        stuck = rejected[damping[rejected] > 1e12]
+        for finished in [done, stuck]:
+            converged[finished] = True
+            active[finished] = False
+
+    results = {'rss' : rss, 'converged' : converged}
+    errors = np.zeros((nfits, 4))
+    if (npoints > nfree) and (nfree > 0):
+        A = np.einsum('kni,knj->kij', jacobian, jacobian)
+        with np.errstate(all='ignore'):
+            covariance = np.linalg.pinv(A)
+            variances = np.einsum('kii->ki', covariance)
+            free_errors = np.sqrt(variances * 
+                                  (rss / (npoints - nfree))[:, None])
+        errors[:, vary] = free_errors
+    for k, name in enumerate(names):
+        results[name] = values[:, k]
+        results[name + '_error'] = errors[:, k]
+    return results
+
+
+def grid_minimum(rss, *axes):
+    """
+    Takes a grid of misfits (sum of squared residuals) and the values 
+    along each of its axes, e.g., from misfit_grid1D, and returns a list
+    of the values at the best (lowest misfit) cell and the misfit there.
+    """
+    rss = np.asarray(rss, dtype=float)
+    if np.all(np.isnan(rss)):
+        print('No finite misfits in the grid')
+        return
+    best_idx = np.unravel_index(np.nanargmin(rss), rss.shape)
+    best = [np.atleast_1d(axis)[idx] for axis, idx in zip(axes, best_idx)]
+    return best, rss[best_idx]
+
+
+def misfit_grid1D(x_microns, y, length_microns, log10Ds_m2s, times_seconds,
+                  init=1., fin=0., erf_or_sum='erf', symmetric=True, 
+                  infinity=100, lookup=False, processes=1, 
+                  batch_size=100000):
+    """
+    Brute-force misfit map for 1D diffusion, for finding good starting 
+    values for fitting and seeing how well D and time can be told apart.
+    
+    Takes the data positions (x_microns, measured from one edge) and 
+    unit values y, the profile length, and arrays of log10 diffusivities
+    and times in seconds and returns the sum of squared residuals between
+    the data and diffusion1D_array's model for every combination, with 
+    one row per diffusivity and one column per time.
+    
+    The models are made in batches of up to batch_size values at a time.
+    Set lookup=True to interpolate them in precomputed tables (see 
+    lookuptables). With processes > 1, the diffusivities are split up 
+    over that many processes.
+    
+    Use grid_minimum to get the best cell.
+    """
+    log10Ds = np.atleast_1d(np.asarray(log10Ds_m2s, dtype=float))
+    times = np.atleast_1d(np.asarray(times_seconds, dtype=float))
+    if np.any(times < 0):
+        print('times must not be negative')
+        return
+    if erf_or_sum not in ['erf', 'infsum']:
+        print('erf_or_sum must be "erf" or "infsum"')
+        return
+
+    if (processes > 1) and (len(log10Ds) > 1):
+        chunks = np.array_split(log10Ds, min(processes, len(log10Ds)))
+        with futures.ProcessPoolExecutor(len(chunks)) as pool:
+            jobs = [pool.submit(misfit_grid1D, x_microns, y, length_microns,
+                                chunk, times, init, fin, erf_or_sum, 
+                                symmetric, infinity, lookup, 1, batch_size)
+                    for chunk in chunks]
+            return np.concatenate([job.result() for job in jobs], axis=0)
+
+    # dimensionless positions and Fourier numbers
+    L_meters = length_microns / 1e6
+    xi = (np.asarray(x_microns, dtype=float) / length_microns) - 0.5
+    y = np.asarray(y, dtype=float)
+    fourier = ((10.**log10Ds[:, np.newaxis]) * times[np.newaxis, :] / 
+               L_meters**2).ravel()
+    if (erf_or_sum == 'erf') and (symmetric is False):
+        # the error function is for twice the length
+        fourier = fourier / 4.
+
+    rss = np.empty(len(fourier))
+    rows = max(1, int(batch_size / max(1, len(xi))))
+    for start in range(0, len(fourier), rows):
+        F = fourier[start:start+rows, np.newaxis]
+        if lookup is True:
+            unit = lookuptables.unit_profile(xi[np.newaxis, :], F, 
+                                             erf_or_sum=erf_or_sum)
+        elif erf_or_sum == 'erf':
+            unit = lookuptables.erf_profile(xi[np.newaxis, :], F)
+        else:
+            unit = np.array([infinite_sum1D(xi, Fk, 1., 1., 
+                                            infinity=infinity) 
+                             for Fk in F[:, 0]])
+        model = fin + (unit * (init - fin))
+        rss[start:start+rows] = np.sum((model - y)**2, axis=1)
+    return rss.reshape(len(log10Ds), len(times))
 
 
 def diffusion1D(length_microns, log10D_m2s, time_seconds, init=1., fin=0.,
@@ -265,6 +790,189 @@ def diffusion1D(length_microns, log10D_m2s, time_seconds, init=1., fin=0.,
     return fig, ax, x_diffusion, y_diffusion
 
 
+#%% 1D finite-difference diffusion: any initial profile and D(C)
+def crank_nicolson1D(initial_values, length_meters, D_m2s, time_seconds,
+                     left=0., right=0., timesteps=100):
+    """
+    Implicit finite-difference (Crank-Nicolson) solution for 1D 
+    diffusion, dC/dt = d/dx (D dC/dx), for arbitrary starting profiles 
+    and concentration-dependent diffusivities.
+    
+    Requires:
+        initial_values: concentrations at evenly spaced points from one 
+            edge of the profile to the other at time zero
+        length_meters: length of the profile
+        D_m2s: diffusivity in m2/s, either a number or a function that 
+            takes an array of concentrations and returns the diffusivity 
+            at each one
+        time_seconds: how long diffusion goes on
+        
+    Optional input:
+        left and right: the boundary conditions, either a fixed 
+            concentration at that edge (default 0.) or None for no flux 
+            through that edge
+        timesteps: number of time steps (default 100)
+        
+    Each step is one tridiagonal (banded) solve. The first step is split
+    into two backward Euler half steps so sharp starting profiles don't 
+    set off oscillations. With D(C), each step is repeated once with D 
+    evaluated halfway through the step.
+    
+    Returns the concentrations at the same points at time_seconds, or 
+    None if something is wrong with the input.
+    """
+    C = np.array(initial_values, dtype=float)
+    npoints = len(C)
+    if npoints < 3:
+        print('Need at least 3 points in the initial profile')
+        return
+    if time_seconds < 0:
+        print('time must not be negative')
+        return
+    if time_seconds == 0:
+        return C
+    timesteps = max(1, int(timesteps))
+    dx2 = (length_meters / (npoints - 1))**2
+    dt = time_seconds / timesteps
+
+    def diagonals(C):
+        """Diagonals of the operator d/dx (D dC/dx) at concentrations C"""
+        if callable(D_m2s):
+            D = np.broadcast_to(np.asarray(D_m2s(C), dtype=float), C.shape)
+        else:
+            D = float(D_m2s) * np.ones(npoints)
+        faces = (D[:-1] + D[1:]) / (2. * dx2)
+        lower = np.zeros(npoints)
+        main = np.zeros(npoints)
+        upper = np.zeros(npoints)
+        lower[1:] = faces
+        upper[:-1] = faces
+        main[1:] = main[1:] - faces
+        main[:-1] = main[:-1] - faces
+        # no flux at the edges: mirror image across the edge
+        upper[0] = 2. * upper[0]
+        main[0] = 2. * main[0]
+        lower[-1] = 2. * lower[-1]
+        main[-1] = 2. * main[-1]
+        return lower, main, upper
+
+    def step(C, C_for_D, step_dt, theta):
+        """One theta-method step with D from C_for_D"""
+        lower, main, upper = diagonals(C_for_D)
+        change = main * C
+        change[:-1] = change[:-1] + (upper[:-1] * C[1:])
+        change[1:] = change[1:] + (lower[1:] * C[:-1])
+        rhs = C + ((1. - theta) * step_dt * change)
+        
+        banded = np.zeros((3, npoints))
+        banded[0, 1:] = -theta * step_dt * upper[:-1]
+        banded[1] = 1. - (theta * step_dt * main)
+        banded[2, :-1] = -theta * step_dt * lower[1:]
+        if left is not None:
+            banded[1, 0] = 1.
+            banded[0, 1] = 0.
+            rhs[0] = left
+        if right is not None:
+            banded[1, -1] = 1.
+            banded[2, -2] = 0.
+            rhs[-1] = right
+        return scipy.linalg.solve_banded((1, 1), banded, rhs)
+
+    def full_step(C, step_dt, theta):
+        new = step(C, C, step_dt, theta)
+        if callable(D_m2s):
+            new = step(C, (C + new) / 2., step_dt, theta)
+        return new
+
+    C = full_step(C, dt / 2., 1.)
+    C = full_step(C, dt / 2., 1.)
+    for n in range(timesteps - 1):
+        C = full_step(C, dt, 0.5)
+    return C
+
+
+def diffusion1D_numerical_params(params, 
+                                 data_x_microns=None, 
+                                 data_y_unit_areas=None, 
+                                 initial_profile=None,
+                                 D_function=None,
+                                 centered=True, 
+                                 symmetric=True,
+                                 points=50,
+                                 timesteps=100,
+                                 **kwargs):
+    """
+    Finite-difference version of diffusion1D_params with the same
+    lmfit parameters (see params_setup1D) and the same output: without 
+    data, the x vector in microns (centered) and the model values at
+    points positions; with data, the residuals for use in fitting.
+    
+    Optional keywords:
+     - initial_profile: unit values evenly spaced across the profile at
+       time zero, e.g., from an earlier experiment. If None (default), 
+       the profile starts at initial_unit_value everywhere.
+     - D_function: function of the unit concentrations that multiplies
+       10**log10D_m2s to give a concentration-dependent diffusivity. 
+       If None (default), D is constant.
+     - symmetric: if True (default), both edges are held at 
+       final_unit_value. If False, only the right edge is, and nothing
+       goes in or out through the left edge.
+     - points and timesteps: resolution of the solution
+     
+    Other keywords for diffusion1D_params are ignored. 
+    See crank_nicolson1D.
+    """
+    p = params.valuesdict()
+    L_meters = p['microns'] / 1e6
+    t = p['time_seconds']
+    D = 10.**p['log10D_m2s']
+    initial_value = p['initial_unit_value']
+    final_value = p['final_unit_value']
+
+    if t < 0:
+        return           
+
+    fitting = False
+    if (data_x_microns is not None) and (data_y_unit_areas is not None):
+        if len(data_x_microns) == len(data_y_unit_areas):
+            fitting = True
+        else:
+            print('x and y data must be the same length')
+            print('x', len(data_x_microns))
+            print('y', len(data_y_unit_areas))
+
+    points = int(points)
+    x_meters = np.linspace(0., L_meters, points)
+    if initial_profile is None:
+        start = initial_value * np.ones(points)
+    else:
+        profile = np.asarray(initial_profile, dtype=float)
+        start = np.interp(np.linspace(0., 1., points), 
+                          np.linspace(0., 1., len(profile)), profile)
+    
+    if D_function is None:
+        D_m2s = D
+    else:
+        def D_m2s(C):
+            return D * np.asarray(D_function(C), dtype=float)
+
+    if symmetric is True:
+        left = final_value
+    else:
+        left = None
+
+    model = crank_nicolson1D(start, L_meters, D_m2s, t, left=left, 
+                             right=final_value, timesteps=timesteps)
+    if model is None:
+        return False
+
+    if fitting is False:
+        x_microns = (x_meters - (L_meters / 2.)) * 1e6
+        return x_microns, model
+    data_x_meters = np.array(data_x_microns, dtype=float) / 1e6
+    return np.interp(data_x_meters, x_meters, model) - data_y_unit_areas
+
+
 #%% 3-dimensional diffusion parameter setup
 def length_checker(microns3):
     """
@@ -351,29 +1059,164 @@ def params_setup3D(microns3, log10D3, time_seconds,
     return params
 
 
-def diffusion3Dnpi_params(params, 
-                          data_x_microns=None, 
-                          data_y_unit_areas=None, 
-                          erf_or_sum='erf', 
-                          centered=True, 
-                          infinity=100, 
+def unit_profiles3D_array(lengths_microns, log10Ds_m2s, time_seconds, 
                           points=50):
-    """ 
-    Diffusion in 3 dimensions in a rectangular parallelipiped.
-    Requires:
-        params - lmfit parameters. Setup parameters with params_setup3D.
-        For more on parameters, see 
-        https://lmfit.github.io/lmfit-py/parameters.html 
+    """
+    Takes plain lists of three lengths in microns and three log10 
+    diffusivities in m2/s and the time in seconds and returns lists of 
+    the positions (centered, in microns) and values of the three 1D unit 
+    diffusion profiles (initial=1, final=0) in each direction that 
+    multiply together to make the 3D non-path-integrated solution. 
     
-    Option inpur aimilar to diffusion1D_params.
+    Returns None if the time is negative.
+    """
+    xprofiles = []    
+    yprofiles = []
+    for microns, log10D in zip(lengths_microns, log10Ds_m2s):
+        L_meters = float(microns) / 1e6
+        a_meters = L_meters / 2.
+        x = np.linspace(-a_meters, a_meters, points)
+        y = diffusion1D_array(x, L_meters, 10.**log10D, time_seconds)
+        if y is None:
+            print('Problem with diffusion1D_array; is time negative?')
+            return
+        xprofiles.append(x * 1e6)
+        yprofiles.append(y)
+    return xprofiles, yprofiles
+
+
+def unit_profiles3D(params, points=50):
+    """
+    Takes lmfit parameters set up with params_setup3D and returns 
+    lists of the positions and values of the three 1D unit diffusion 
+    profiles (initial=1, final=0) in each direction that multiply 
+    together to make the 3D non-path-integrated solution.
     
-    Returns:
-        v: complete 3D concentration matrix
-        y: slice profiles
-        x: positions of slice profiles
+    See unit_profiles3D_array.
+    """
+    p = params.valuesdict()
+    log10D3 = [p['log10Dx'], p['log10Dy'], p['log10Dz']]
+    return unit_profiles3D_array(p['microns3'], log10D3, p['time_seconds'],
+                                 points=points)
+
+
+def unit_profiles3D_jacobian(lengths_microns, log10Ds_m2s, time_seconds,
+                             points=50):
+    """
+    Takes the same input as unit_profiles3D_array and returns lists of 
+    the values of the three 1D unit diffusion profiles and of their 
+    derivatives with respect to their log10 diffusivities and to time
+    (see diffusion1D_jacobian). The 3D solutions are products of these 
+    profiles, so their derivatives follow from the product rule.
     
-    ### NOT SET UP FOR FITTING YET ###
-    """   
+    Returns None if the time is negative.
+    """
+    yprofiles = []
+    dDprofiles = []
+    dtprofiles = []
+    for microns, log10D in zip(lengths_microns, log10Ds_m2s):
+        L_meters = float(microns) / 1e6
+        a_meters = L_meters / 2.
+        x = np.linspace(-a_meters, a_meters, points)
+        jacobian = diffusion1D_jacobian(x, L_meters, 10.**log10D, 
+                                        time_seconds)
+        if jacobian is None:
+            print('Problem with diffusion1D_jacobian; is time negative?')
+            return
+        yprofiles.append(jacobian[:, 2])
+        dDprofiles.append(jacobian[:, 0])
+        dtprofiles.append(jacobian[:, 1])
+    return yprofiles, dDprofiles, dtprofiles
+
+
+def outer3D(profiles3, dtype=np.float64, out=None):
+    """
+    Takes a list of three 1D profiles and returns the 3D matrix v with
+    v[i, j, k] = profiles3[0][i] * profiles3[1][j] * profiles3[2][k]
+    
+    Optional input:
+        dtype: data type of the output (default np.float64)
+        out: preallocated array to fill in place and return. Its shape
+             must match the lengths of the three profiles.
+    """
+    a, b, c = [np.asarray(prof) for prof in profiles3]
+    shape = (len(a), len(b), len(c))
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif np.shape(out) != shape:
+        print('out must have shape', shape)
+        print('out', np.shape(out))
+        return
+    np.einsum('i,j,k->ijk', a, b, c, out=out, casting='same_kind')
+    return out
+
+
+def diffusion3Dnpi_jacobian(lengths_microns, log10Ds_m2s, time_seconds,
+                            init=1., fin=0., points=50):
+    """
+    Analytical partial derivatives of the 3D non-path-integrated solution
+    from diffusion3Dnpi_params, taking plain lists of three lengths in 
+    microns and three log10 diffusivities in m2/s and the time in seconds.
+    
+    Returns a list of six (points, points, points) matrices, the 
+    derivatives with respect to log10Dx, log10Dy, log10Dz, time, and the
+    initial and final unit values, or None if the time is negative.
+    """
+    profiles = unit_profiles3D_jacobian(lengths_microns, log10Ds_m2s, 
+                                        time_seconds, points=points)
+    if profiles is None:
+        return
+    yprofiles, dDprofiles, dtprofiles = profiles
+
+    jacobian = []
+    for k in range(3):
+        factors = list(yprofiles)
+        factors[k] = dDprofiles[k]
+        jacobian.append(outer3D(factors) * (init - fin))
+
+    dt = np.zeros((points, points, points))
+    for k in range(3):
+        factors = list(yprofiles)
+        factors[k] = dtprofiles[k]
+        dt += outer3D(factors)
+    jacobian.append(dt * (init - fin))
+
+    v = outer3D(yprofiles)
+    jacobian.append(v)
+    jacobian.append(1. - v)
+    return jacobian
+
+
+def diffusion3Dnpi_params(params, 
+                          data_x_microns=None, 
+                          data_y_unit_areas=None, 
+                          erf_or_sum='erf', 
+                          centered=True, 
+                          infinity=100, 
+                          points=50,
+                          dtype=np.float64,
+                          out=None):
+    """ 
+    Diffusion in 3 dimensions in a rectangular parallelipiped.
+    Requires:
+        params - lmfit parameters. Setup parameters with params_setup3D.
+        For more on parameters, see 
+        https://lmfit.github.io/lmfit-py/parameters.html 
+    
+    Option inpur aimilar to diffusion1D_params.
+    
+    The 3D matrix is built with outer3D. Set dtype=np.float32 to halve
+    the memory needed for large numbers of points, and pass in a 
+    preallocated (points, points, points) array as out to reuse the 
+    same memory between calls, e.g., during fitting.
+    
+    Returns:
+        v: complete 3D concentration matrix
+        y: slice profiles
+        x: positions of slice profiles
+    
+    ### NOT SET UP FOR FITTING YET ###
+    """   
     
     fitting = False
     
@@ -391,15 +1234,18 @@ def diffusion3Dnpi_params(params,
 
     p = params.valuesdict()
     L3_microns = np.array(p['microns3'])
-    t = p['time_seconds']
     init = p['initial_unit_value']
-    vary_init = [params['initial_unit_value'].vary]
     fin = p['final_unit_value']
-    vary_fin = [params['final_unit_value'].vary]
-    log10D3 = [p['log10Dx'], p['log10Dy'], p['log10Dz']]
-    vary_D = [params['log10Dx'].vary, 
-              params['log10Dy'].vary, 
-              params['log10Dz'].vary]
+
+    # same model as last time? See modelcache
+    use_cache = (fitting is False) and (out is None)
+    if use_cache is True:
+        key = modelcache.make_key('diffusion3Dnpi', p, erf_or_sum=erf_or_sum,
+                                  centered=centered, infinity=infinity, 
+                                  points=points, dtype=dtype)
+        cached = modelcache.lookup(key)
+        if cached is not None:
+            return cached
 
     # going in or out?
     if init < fin: 
@@ -409,42 +1255,23 @@ def diffusion3Dnpi_params(params,
         going_out = True
        
     # First create 3 1D profiles, 1 in each direction
-    xprofiles = []    
-    yprofiles = []
-    kwdict = {'points' : points}
-    
-    for microns, D, vD in zip(L3_microns, log10D3, vary_D):
-        p1D = lmfit.Parameters()
-        p1D.add('microns', float(microns), False)
-        p1D.add('time_seconds', t, params['time_seconds'].vary)
-        p1D.add('log10D_m2s', D, vD)
-        p1D.add('initial_unit_value', 1., vary_init)
-        p1D.add('final_unit_value', 0., vary_fin)
-        
-        try:
-            x, y = diffusion1D_params(p1D, **kwdict)
-        except TypeError:
-            print('Problem with x values after diffusion1D')
-            print(diffusion1D_params(p1D, **kwdict))
-            return
-
-        xprofiles.append(x)
-        yprofiles.append(y)
+    unit_profiles = unit_profiles3D(params, points=points)
+    if unit_profiles is None:
+        return
+    xprofiles, yprofiles = unit_profiles
                                       
     # Then multiply them together to get a 3D matrix
-    # I should figure out how to do this without the for-loops
-    v = np.ones((points, points, points))
-    for d in range(0, points):
-        for e in range(0, points):
-            for f in range(0, points):
-                v[d][e][f] = yprofiles[0][d]*yprofiles[1][e]*yprofiles[2][f]
+    v = outer3D(yprofiles, dtype=dtype, out=out)
+    if v is None:
+        return
 
     if going_out is False:
-        v = np.ones((points, points, points)) - v
+        np.subtract(1., v, out=v)
 
     scale = np.abs(fin-init)
     minimum_value = min([fin, init])
-    v = (v * scale) + minimum_value
+    v *= scale
+    v += minimum_value
 
     mid = int(points/2.)    
     aslice = v[:, mid][:, mid]
@@ -466,7 +1293,10 @@ def diffusion3Dnpi_params(params,
     sliceprofiles = [aslice, bslice, cslice]
     
     if fitting is False:
-        return v, sliceprofiles, slice_positions_microns
+        result = (v, sliceprofiles, slice_positions_microns)
+        if use_cache is True:
+            modelcache.store(key, result)
+        return result
     else:
         ### Still need to set up residuals! ###
         residuals = np.zeros_like(sliceprofiles)
@@ -531,72 +1361,509 @@ def diffusion3Dnpi(lengths_microns, log10Ds_m2s, time_seconds, points=50,
             
         
 #%% 3D whole-block: 3-dimensional diffusion with path integration
-def diffusion3Dwb_params(params, data_x_microns=None, data_y_unit_areas=None, 
-                          raypaths=None, erf_or_sum='erf', show_plot=True, 
-                          fig_ax=None, style=None, need_to_center_x_data=True,
-                          infinity=100, points=50, show_1Dplots=False):
-    """ 
-    Diffusion in 3 dimensions with path integration.
-    Requires setup with params_setup3Dwb
+def check_raypaths(raypaths):
     """
-    if raypaths is None:
-        print('raypaths must be in the form of a list of three abc directions')
+    Returns True if raypaths is a list of allowed ray paths for the 
+    profiles || a, b, and c, e.g., ['c', 'c', 'b']; otherwise prints what
+    is wrong and returns False.
+    """
+    allowed = [['b', 'c'], ['a', 'c'], ['a', 'b']]
+    for k in range(3):
+        if raypaths[k] not in allowed[k]:
+            print(''.join(('raypaths[', str(k), '] for profile || ', 
+                           'abc'[k], ' must be "', allowed[k][0], 
+                           '" or "', allowed[k][1], '"')))
+            return False
+    return True
+
+
+def wholeblock_array(lengths_microns, log10Ds_m2s, time_seconds, raypaths,
+                     init=1., fin=0., points=50, lookup=False):
+    """
+    Returns the three whole-block profiles [wbA, wbB, wbC] through the 
+    center of the block without making the full 3D matrix, taking plain 
+    lists of three lengths in microns and three log10 diffusivities in 
+    m2/s, the time in seconds, a list of three raypaths, one for each of 
+    the profiles || a, b, and c, and initial and final unit values.
+    
+    The non-path-integrated solution is a product of three 1D profiles, 
+    so its average along the ray path is the product of the 1D profile 
+    in the profile direction, the mean of the 1D profile along the 
+    ray path, and the central value of the 1D profile in the third 
+    direction.
+    
+    Set lookup=True to interpolate the 1D profiles in precomputed tables
+    (see lookuptables) instead of calculating them.
+    """
+    if check_raypaths(raypaths) is False:
+        return
+
+    if lookup is True:
+        unit_profiles = lookuptables.unit_profiles3D(lengths_microns, 
+                                                     log10Ds_m2s, 
+                                                     time_seconds, 
+                                                     points=points)
+    else:
+        unit_profiles = unit_profiles3D_array(lengths_microns, log10Ds_m2s,
+                                              time_seconds, points=points)
+    if unit_profiles is None:
         return
+    xprofiles, yprofiles = unit_profiles
+
+    scale = np.abs(fin-init)
+    minimum_value = min([fin, init])
+
+    mid = int(points/2)
+    wb_profiles = []
+    for k in range(3):
+        iray = styles.get_iorient(raypaths[k])
+        iother = 3 - k - iray
+        wb = (yprofiles[k] * np.mean(yprofiles[iray]) * 
+              yprofiles[iother][mid])
+        if init < fin:
+            wb = 1. - wb
+        wb_profiles.append((wb * scale) + minimum_value)
+    return wb_profiles
 
-    v, y, x = diffusion3Dnpi_params(params, points=int(points), 
-                                    centered=False)
+
+def wholeblock_jacobian(lengths_microns, log10Ds_m2s, time_seconds, 
+                        raypaths, init=1., fin=0., points=50):
+    """
+    Analytical partial derivatives of the whole-block profiles from 
+    wholeblock_array, which takes the same input. Each whole-block 
+    profile is a product of three 1D unit profiles (or their means), 
+    so the derivatives follow from the product rule.
     
-    # Fitting to data or not? Default is not
-    # Add appropriate x and y data to fit
-    fitting = False
-    if (data_x_microns is not None) and (data_y_unit_areas is not None):
-        x_array = np.array(data_x_microns)
-        y_array = np.array(data_y_unit_areas)
-        if np.shape(x_array) == np.shape(y_array):
-            print('fitting to data')
-            fitting = True
+    Returns a list of three arrays [jacA, jacB, jacC], one for each 
+    whole-block profile, with one row per model position and columns for
+    the derivatives with respect to log10Dx, log10Dy, log10Dz, time, and
+    the initial and final unit values.
+    """
+    if check_raypaths(raypaths) is False:
+        return
+
+    profiles = unit_profiles3D_jacobian(lengths_microns, log10Ds_m2s, 
+                                        time_seconds, points=points)
+    if profiles is None:
+        return
+    yprofiles, dDprofiles, dtprofiles = profiles
+
+    mid = int(points/2)
+    jacobians = []
+    for k in range(3):
+        iray = styles.get_iorient(raypaths[k])
+        iother = 3 - k - iray
+        along = yprofiles[k]
+        ray = np.mean(yprofiles[iray])
+        center = yprofiles[iother][mid]
+        
+        jacobian = np.empty((points, 6))
+        jacobian[:, k] = dDprofiles[k] * ray * center
+        jacobian[:, iray] = along * np.mean(dDprofiles[iray]) * center
+        jacobian[:, iother] = along * ray * dDprofiles[iother][mid]
+        jacobian[:, 3] = ((dtprofiles[k] * ray * center) + 
+                          (along * np.mean(dtprofiles[iray]) * center) +
+                          (along * ray * dtprofiles[iother][mid]))
+        jacobian[:, 0:4] = jacobian[:, 0:4] * (init - fin)
+        wb = along * ray * center
+        jacobian[:, 4] = wb
+        jacobian[:, 5] = 1. - wb
+        jacobians.append(jacobian)
+    return jacobians
+
+
+def wholeblock_separable(params, raypaths, points=50, lookup=False):
+    """
+    Returns the three whole-block profiles [wbA, wbB, wbC] through the 
+    center of the block without making the full 3D matrix.
+    
+    Requires lmfit parameters from params_setup3D and a list of three
+    raypaths, one for each of the profiles || a, b, and c. 
+    See wholeblock_array.
+    """
+    p = params.valuesdict()
+    log10D3 = [p['log10Dx'], p['log10Dy'], p['log10Dz']]
+    return wholeblock_array(p['microns3'], log10D3, p['time_seconds'], 
+                            raypaths, init=p['initial_unit_value'], 
+                            fin=p['final_unit_value'], points=points,
+                            lookup=lookup)
+
+
+def wholeblock_at_positions(wb_positions, wb_profiles, x_microns3):
+    """
+    Takes the positions and values of three modeled whole-block profiles 
+    and a list of three arrays of data positions in microns and returns 
+    the model values at all of the data positions as a single array, 
+    going through the three directions in order. 
+    
+    The model positions and the data positions must both be measured 
+    from one edge of the block (0 to the length), not centered on the 
+    middle, e.g., Block.xy_picker(centered=False). The model is linearly
+    interpolated between model positions, so the residuals change 
+    smoothly as the data points move relative to the model, which helps
+    the fits converge. Data points past the ends of the model, 
+    including any centered positions below 0, quietly get the end 
+    values, so centered data give wrong fits rather than errors.
+    """
+    y_model = []
+    for positions, profile, x_microns in zip(wb_positions, wb_profiles,
+                                             x_microns3):
+        y_model.append(np.interp(np.asarray(x_microns, dtype=float), 
+                                 positions, profile))
+    return np.concatenate(y_model)
+
+
+def fit_diffusion3Dwb(x_microns3, y3, lengths_microns, log10Ds_m2s, 
+                      time_seconds, raypaths, initial=1., final=0., 
+                      vD=[True, True, True], vinit=False, vfin=False,
+                      points=50, jacobian=True):
+    """
+    Fits whole-block diffusion to data directly with least squares using
+    wholeblock_array. Takes lists of three arrays of the data positions 
+    (x_microns3, measured from one edge) and unit values (y3), one for 
+    each direction, the raypaths, and the same information as 
+    params_setup3D for the starting values and what to vary. The fit uses
+    the analytical Jacobian from wholeblock_jacobian unless 
+    jacobian=False, which switches to finite differences.
+    
+    Returns dictionaries of the best-fit values and the standard errors, 
+    with the same names as in params_setup3D
+    """
+    names = ['log10Dx', 'log10Dy', 'log10Dz', 'initial_unit_value', 
+             'final_unit_value']
+    start = list(log10Ds_m2s) + [initial, final]
+    vary = list(vD) + [vinit, vfin]
+    wb_positions = [np.linspace(0., float(length), points) 
+                    for length in lengths_microns]
+    y = np.concatenate([np.asarray(yk, dtype=float) for yk in y3])
+
+    def residuals(values):
+        wb_profiles = wholeblock_array(lengths_microns, values[0:3], 
+                                       time_seconds, raypaths, 
+                                       init=values[3], fin=values[4],
+                                       points=points)
+        # wb_positions and the data positions both run from 0 to the length
+        model = wholeblock_at_positions(wb_positions, wb_profiles, 
+                                        x_microns3)
+        return model - y
+
+    def analytical_jacobian(values):
+        jacobians = wholeblock_jacobian(lengths_microns, values[0:3], 
+                                        time_seconds, raypaths, 
+                                        init=values[3], fin=values[4],
+                                        points=points)
+        columns = []
+        for column in [0, 1, 2, 4, 5]:
+            columns.append(wholeblock_at_positions(wb_positions, 
+                                        [jk[:, column] for jk in jacobians], 
+                                        x_microns3))
+        return np.column_stack(columns)
+
+    if jacobian is True:
+        jac = analytical_jacobian
+    else:
+        jac = '2-point'
+
+    best, errors, result = fit_least_squares(residuals, start, vary, 
+                                             jac=jac)
+    return dict(zip(names, best)), dict(zip(names, errors))
+
+
+def misfit_grid3Dwb(x_microns3, y3, lengths_microns, log10Dx, log10Dy,
+                    log10Dz, time_seconds, raypaths, init=1., fin=0., 
+                    points=50, lookup=False, processes=1):
+    """
+    Brute-force misfit map for whole-block diffusion over every 
+    combination of the diffusivities in the arrays log10Dx, log10Dy, and
+    log10Dz at a single time. 
+    
+    Takes lists of three arrays of the data positions (x_microns3, 
+    measured from one edge) and unit values (y3), one for each 
+    direction, the lengths, time, raypaths, and initial and final unit 
+    values, and returns the sum of squared residuals between the data and
+    wholeblock_array's model in an array with shape 
+    (len(log10Dx), len(log10Dy), len(log10Dz)).
+    
+    Each whole-block profile is a 1D profile times two numbers that 
+    depend on the other two diffusivities, so the sums of squares are 
+    put together from a few sums over the data for each 1D profile, and
+    the time per cell doesn't depend on how many data points there are.
+    Set lookup=True to interpolate the 1D profiles in precomputed tables
+    (see lookuptables). With processes > 1, log10Dx is split up over 
+    that many processes.
+    
+    Use grid_minimum to get the best cell.
+    """
+    if check_raypaths(raypaths) is False:
+        return
+    if time_seconds < 0:
+        print('time must not be negative')
+        return
+    grids = [np.atleast_1d(np.asarray(D, dtype=float)) 
+             for D in [log10Dx, log10Dy, log10Dz]]
+
+    if (processes > 1) and (len(grids[0]) > 1):
+        chunks = np.array_split(grids[0], min(processes, len(grids[0])))
+        with futures.ProcessPoolExecutor(len(chunks)) as pool:
+            jobs = [pool.submit(misfit_grid3Dwb, x_microns3, y3, 
+                                lengths_microns, chunk, grids[1], grids[2],
+                                time_seconds, raypaths, init, fin, points,
+                                lookup, 1) 
+                    for chunk in chunks]
+            return np.concatenate([job.result() for job in jobs], axis=0)
+
+    # 1D unit profiles for every diffusivity in each direction
+    xi = np.linspace(-0.5, 0.5, points)
+    mid = int(points/2)
+    units = []
+    for k in range(3):
+        L_meters = float(lengths_microns[k]) / 1e6
+        F = (10.**grids[k][:, np.newaxis]) * time_seconds / L_meters**2
+        if lookup is True:
+            units.append(lookuptables.unit_profile(xi[np.newaxis, :], F))
         else:
-            print('x and y data must be the same shape')
-            print('x', np.shape(x_array))
-            print('y', np.shape(y_array))
-            
+            units.append(lookuptables.erf_profile(xi[np.newaxis, :], F))
+
+    rss = np.zeros([len(D) for D in grids])
+    for k in range(3):
+        iray = styles.get_iorient(raypaths[k])
+        iother = 3 - k - iray
+
+        # 1D profiles interpolated at the data positions, as np.interp
+        positions = np.linspace(0., float(lengths_microns[k]), points)
+        x = np.clip(np.asarray(x_microns3[k], dtype=float), 0., 
+                    positions[-1])
+        idx = np.clip(np.searchsorted(positions, x) - 1, 0, points - 2)
+        weight = (x - positions[idx]) / (positions[idx+1] - positions[idx])
+        at_data = ((units[k][:, idx] * (1. - weight)) + 
+                   (units[k][:, idx+1] * weight))
+        
+        # model - y = g * at_data - (y - fin) with 
+        # g = (init - fin) * mean along the ray path * center value
+        r = np.asarray(y3[k], dtype=float) - fin
+        shape = [1, 1, 1]
+        shape[k] = -1
+        A2 = np.sum(at_data**2, axis=1).reshape(shape)
+        AR = np.dot(at_data, r).reshape(shape)
+        shape = [1, 1, 1]
+        shape[iray] = -1
+        g = (init - fin) * np.mean(units[iray], axis=1).reshape(shape)
+        shape = [1, 1, 1]
+        shape[iother] = -1
+        g = g * units[iother][:, mid].reshape(shape)
+        rss = rss + (g**2 * A2) - (2. * g * AR) + np.sum(r**2)
+    return rss
+
+
+def latin_hypercube(samples, bounds, seed=None):
+    """
+    Latin hypercube sample: takes the number of samples and a list of 
+    (low, high) bounds, one for each dimension, and returns an array 
+    with one row per sample and one column per dimension. Each dimension
+    is split into samples equal intervals, and every interval gets 
+    exactly one sample. Pass seed to get the same samples every time.
+    """
+    rng = np.random.RandomState(seed)
+    bounds = np.asarray(bounds, dtype=float).reshape(-1, 2)
+    points = np.empty((samples, len(bounds)))
+    for k, (low, high) in enumerate(bounds):
+        strata = (rng.permutation(samples) + rng.uniform(size=samples))
+        points[:, k] = low + (high - low) * strata / samples
+    return points
+
+
+def fit_diffusion3Dwb_multistart(x_microns3, y3, lengths_microns, 
+                                 log10Ds_m2s, time_seconds, raypaths, 
+                                 starts=8, start_range=(-16., -8.),
+                                 initial=1., final=0., 
+                                 vD=[True, True, True], vinit=False, 
+                                 vfin=False, points=50, jacobian=True,
+                                 processes=None, seed=None, 
+                                 tolerance=0.05):
+    """
+    Multi-start whole-block fitting for misfits with more than one 
+    minimum. Runs fit_diffusion3Dwb (same input) from starts different 
+    starting diffusivities taken from a Latin hypercube sample over 
+    start_range (log10 m2/s) for each diffusivity that varies. The fits
+    run in a pool of processes (default: one for each CPU; 
+    processes=1 runs them one after another here), so with enough CPUs
+    the time taken hardly depends on the number of starts.
+    
+    Fits that end up within tolerance of each other in every parameter 
+    are counted as the same solution. 
+    
+    Returns a list of the solutions, best first, each a dictionary with
+        values and errors: as returned by fit_diffusion3Dwb
+        rss: sum of squared residuals
+        starts: how many of the starts ended up there
+    """
+    vary = np.array(vD, dtype=bool)
+    start_Ds = np.tile(np.asarray(log10Ds_m2s, dtype=float), (starts, 1))
+    if vary.any():
+        start_Ds[:, vary] = latin_hypercube(starts, 
+                                            [start_range]*vary.sum(),
+                                            seed=seed)
+
+    y = np.concatenate([np.asarray(yk, dtype=float) for yk in y3])
+    wb_positions = [np.linspace(0., float(length), points) 
+                    for length in lengths_microns]
+    kwargs = dict(initial=initial, final=final, vD=vD, vinit=vinit, 
+                  vfin=vfin, points=points, jacobian=jacobian)
+
+    if processes == 1:
+        fits = [fit_diffusion3Dwb(x_microns3, y3, lengths_microns, Ds, 
+                                  time_seconds, raypaths, **kwargs)
+                for Ds in start_Ds]
+    else:
+        with futures.ProcessPoolExecutor(processes) as pool:
+            jobs = [pool.submit(fit_diffusion3Dwb, x_microns3, y3, 
+                                lengths_microns, Ds, time_seconds, 
+                                raypaths, **kwargs)
+                    for Ds in start_Ds]
+            fits = [job.result() for job in jobs]
+
+    names = ['log10Dx', 'log10Dy', 'log10Dz', 'initial_unit_value', 
+             'final_unit_value']
+    solutions = []
+    for values, errors in fits:
+        wb_profiles = wholeblock_array(lengths_microns, 
+                                       [values[name] for name in names[:3]],
+                                       time_seconds, raypaths,
+                                       init=values['initial_unit_value'],
+                                       fin=values['final_unit_value'],
+                                       points=points)
+        # wb_positions and the data positions both run from 0 to the length
+        model = wholeblock_at_positions(wb_positions, wb_profiles, 
+                                        x_microns3)
+        solutions.append({'values' : values, 'errors' : errors, 
+                          'rss' : np.sum((model - y)**2), 'starts' : 1})
+    solutions.sort(key=lambda solution: solution['rss'])
+
+    # combine solutions that are the same
+    unique = []
+    for solution in solutions:
+        for kept in unique:
+            differences = [abs(solution['values'][name] - 
+                               kept['values'][name]) for name in names]
+            if max(differences) < tolerance:
+                kept['starts'] = kept['starts'] + 1
+                break
+        else:
+            unique.append(solution)
+    return unique
+
+
+def wholeblock_from_matrix(v, raypaths):
+    """
+    Returns the three whole-block profiles [wbA, wbB, wbC] through the
+    center of the block by averaging the full 3D concentration matrix v
+    along the raypaths, one for each of the profiles || a, b, and c.
+    """
     # Whole-block measurements can be obtained through any of the three 
-    # planes of the whole-block, so profiles can come from one of two ray path
-    # directions. These are the planes.
+    # planes of the whole-block, so profiles can come from one of two 
+    # ray path directions. These are the planes.
     raypathA = v.mean(axis=0)
     raypathB = v.mean(axis=1)
     raypathC = v.mean(axis=2)
     
     # Specify whole-block profiles in model
-    mid = int(points/2)
+    mid = [int(n/2) for n in np.shape(v)]
     if raypaths[0] == 'b':
-        wbA = raypathB[:, mid]
+        wbA = raypathB[:, mid[2]]
     elif raypaths[0] == 'c':
-        wbA = raypathC[:, mid]       
+        wbA = raypathC[:, mid[1]]       
     else:
         print('raypaths[0] for profile || a must be "b" or "c"')
         return
         
     if raypaths[1] == 'a':
-        wbB = raypathA[:, mid]
+        wbB = raypathA[:, mid[2]]
     elif raypaths[1] == 'c':
-        wbB = raypathC[mid]       
+        wbB = raypathC[mid[0]]       
     else:
         print('raypaths[1] for profile || b must be "a" or "c"')
         return
 
     if raypaths[2] == 'a':
-        wbC = raypathA[mid]
+        wbC = raypathA[mid[1]]
     elif raypaths[2] == 'b':
-        wbC = raypathB[mid]       
+        wbC = raypathB[mid[0]]       
     else:
         print('raypaths[2] for profile || c must be "a" or "b"')
         return
 
+    return [wbA, wbB, wbC]
+
+
+def diffusion3Dwb_params(params, data_x_microns=None, data_y_unit_areas=None, 
+                          raypaths=None, erf_or_sum='erf', show_plot=True, 
+                          fig_ax=None, style=None, need_to_center_x_data=True,
+                          infinity=100, points=50, show_1Dplots=False,
+                          separable=True, lookup=False):
+    """ 
+    Diffusion in 3 dimensions with path integration.
+    Requires setup with params_setup3Dwb
+    
+    By default (separable=True), the whole-block profiles are calculated
+    with wholeblock_separable directly from the three 1D profiles, which
+    takes memory and time proportional to points rather than points**3,
+    so points can be raised to 1000 or more. Set separable=False to 
+    average over the full 3D matrix from diffusion3Dnpi_params instead.
+    With separable=True, lookup=True interpolates the 1D profiles in 
+    precomputed tables (see lookuptables) instead of calculating them.
+    """
+    if raypaths is None:
+        print('raypaths must be in the form of a list of three abc directions')
+        return
+
+    # Fitting to data or not? Default is not
+    # Add appropriate x and y data to fit
+    fitting = False
+    if (data_x_microns is not None) and (data_y_unit_areas is not None):
+        # one array per direction; they can have different lengths
+        x_array = [np.array(xk, dtype=float) for xk in data_x_microns]
+        y_array = [np.array(yk, dtype=float) for yk in data_y_unit_areas]
+        x_shape = [np.shape(xk) for xk in x_array]
+        y_shape = [np.shape(yk) for yk in y_array]
+        if x_shape == y_shape:
+            print('fitting to data')
+            fitting = True
+        else:
+            print('x and y data must be the same shape')
+            print('x', x_shape)
+            print('y', y_shape)
+            
+    # same model as last time? See modelcache
+    wb_profiles = None
+    if fitting is False:
+        key = modelcache.make_key('diffusion3Dwb', params.valuesdict(), 
+                                  raypaths=raypaths, erf_or_sum=erf_or_sum,
+                                  infinity=infinity, points=points, 
+                                  separable=separable, lookup=lookup)
+        wb_profiles = modelcache.lookup(key)
+    from_cache = wb_profiles is not None
+
+    if from_cache is True:
+        pass
+    elif separable is True:
+        wb_profiles = wholeblock_separable(params, raypaths, 
+                                           points=int(points), 
+                                           lookup=lookup)
+        if wb_profiles is None:
+            return
+    else:
+        v, y, x = diffusion3Dnpi_params(params, points=int(points), 
+                                        centered=False)
+        wb_profiles = wholeblock_from_matrix(v, raypaths)
+        if wb_profiles is None:
+            return
+
+    if (fitting is False) and (from_cache is False):
+        modelcache.store(key, wb_profiles)
+
     p = params.valuesdict()
     L3 = p['microns3']
     
-    wb_profiles = [wbA, wbB, wbC]
     wb_positions = []
     for length in L3:
         x_microns = np.linspace(0., float(length), points)
@@ -619,27 +1886,57 @@ def diffusion3Dwb_params(params, data_x_microns=None, data_y_unit_areas=None,
         return wb_positions, wb_profiles
     
     if fitting is True:
-        # Return residuals 
-        y_model = []
-        y_data = []
-        residuals = []
-        for k in range(3):
-            for pos in range(len(x_array[k])):
-                # wb_positions are centered, data are not
-                microns = x_array[k][pos]
-                
-                # Find the index of the full model whole-block value 
-                # closest to the data position
-                idx = (np.abs(wb_positions[k]-microns).argmin())
-                
-                model = wb_profiles[k][idx]
-                data = y_array[k][pos]
-                res = model - data
-                
-                y_model.append(model)
-                y_data.append(data)
-                residuals.append(res)                
-        return np.array(residuals)
+        # Return residuals; wb_positions and the data positions both
+        # run from 0 to the length
+        y_model = wholeblock_at_positions(wb_positions, wb_profiles, x_array)
+        return y_model - np.concatenate(y_array)
+
+
+def diffusion3Dwb_params_jacobian(params, data_x_microns, 
+                                  data_y_unit_areas, raypaths=None, 
+                                  points=50, **kwargs):
+    """
+    Jacobian of the residuals from diffusion3Dwb_params with respect to 
+    the parameters that vary, in the form lmfit wants for its Dfun keyword:
+        lmfit.minimize(diffusion3Dwb_params, params, args=(x, y),
+                       kws={'raypaths': raypaths}, 
+                       Dfun=diffusion3Dwb_params_jacobian)
+                       
+    Diffusivities tied to log10Dx in params_setup3D (isotropic=True or 
+    slowb=True) add their derivatives to log10Dx's. Other keywords for 
+    diffusion3Dwb_params are ignored. See wholeblock_jacobian.
+    """
+    if raypaths is None:
+        print('raypaths must be in the form of a list of three abc directions')
+        return
+
+    p = params.valuesdict()
+    L3 = p['microns3']
+    log10D3 = [p['log10Dx'], p['log10Dy'], p['log10Dz']]
+    jacobians = wholeblock_jacobian(L3, log10D3, p['time_seconds'], 
+                                    raypaths, init=p['initial_unit_value'],
+                                    fin=p['final_unit_value'], 
+                                    points=int(points))
+    if jacobians is None:
+        return
+    wb_positions = [np.linspace(0., float(length), int(points)) 
+                    for length in L3]
+    x_array = [np.array(xk, dtype=float) for xk in data_x_microns]
+    
+    names = ['log10Dx', 'log10Dy', 'log10Dz', 'time_seconds', 
+             'initial_unit_value', 'final_unit_value']
+    full = np.column_stack([wholeblock_at_positions(wb_positions, 
+                                        [jk[:, column] for jk in jacobians], 
+                                        x_array)
+                            for column in range(6)])
+    for name in ['log10Dy', 'log10Dz']:
+        if params[name].expr is not None:
+            full[:, 0] = full[:, 0] + full[:, names.index(name)]
+
+    columns = [names.index(name) for name in params 
+               if (name in names) and params[name].vary and 
+               (params[name].expr is None)]
+    return full[:, columns]
 
 
 def diffusion3Dwb(lengths_microns, log10Ds_m2s, time_seconds, raypaths,
@@ -681,4 +1978,677 @@ def diffusion3Dwb(lengths_microns, log10Ds_m2s, time_seconds, raypaths,
                                     lengths=lengths_microns,
                                     show_line_at_1=show_line_at_initial)
 
-        return x, y
\ No newline at end of file
+        return x, y
+
+#%% 3D finite-difference diffusion: any initial state, e.g., multi-stage
+def adi3D(initial_values, lengths_meters, Ds_m2s, time_seconds, 
+          boundary=0., timesteps=100):
+    """
+    Finite-difference solution for 3D diffusion in a rectangular block
+    starting from any 3D concentration matrix, e.g., the result of an 
+    earlier heating step.
+    
+    Requires:
+        initial_values: 3D matrix of concentrations at evenly spaced 
+            points through the block at time zero, edges included
+        lengths_meters: list of the 3 lengths of the block
+        Ds_m2s: list of the 3 diffusivities in m2/s
+        time_seconds: how long diffusion goes on
+        
+    Optional input:
+        boundary: concentration held fixed at all six faces (default 0.)
+        timesteps: number of time steps (default 100)
+
+    Uses alternating-direction-implicit (Douglas) steps: each step does 
+    one tridiagonal solve along each direction in turn for all lines 
+    at once, so the work per step goes as the number of points. The 
+    first step is split into two first-order half steps so sharp 
+    starting matrices don't set off oscillations (see crank_nicolson1D).
+    
+    Returns the 3D concentration matrix at time_seconds, or None if 
+    something is wrong with the input.
+    """
+    v = np.array(initial_values, dtype=float)
+    if (v.ndim != 3) or (min(v.shape) < 3):
+        print('Need a 3D matrix with at least 3 points in each direction')
+        return
+    if time_seconds < 0:
+        print('time must not be negative')
+        return
+    # the faces are held at the boundary value
+    for k in range(3):
+        face = [slice(None)] * 3
+        for idx in [0, -1]:
+            face[k] = idx
+            v[tuple(face)] = boundary
+    if time_seconds == 0:
+        return v
+    timesteps = max(1, int(timesteps))
+    dt = time_seconds / timesteps
+    coefficients = [Ds_m2s[k] / (lengths_meters[k] / (v.shape[k] - 1))**2 
+                    for k in range(3)]
+    interior = (slice(1, -1),) * 3
+
+    def change(v, k):
+        """D d2C/dx2 along direction k; zero at the faces"""
+        out = np.zeros_like(v)
+        center = [slice(1, -1)] * 3
+        before = list(center)
+        after = list(center)
+        before[k] = slice(None, -2)
+        after[k] = slice(2, None)
+        out[interior] = coefficients[k] * (v[tuple(before)] - 
+                                           (2. * v[interior]) + 
+                                           v[tuple(after)])
+        return out
+
+    def solve(rhs, k, factor):
+        """Solves (1 - factor * D d2/dx2) C = rhs along direction k"""
+        npoints = rhs.shape[k]
+        off = factor * coefficients[k]
+        banded = np.zeros((3, npoints))
+        banded[0, 2:] = -off
+        banded[1] = 1. + (2. * off)
+        banded[2, :-2] = -off
+        # faces stay put; lines lying in other faces are all at the 
+        # boundary value, so the solve leaves them alone as well
+        banded[1, 0] = 1.
+        banded[1, -1] = 1.
+        lines = np.moveaxis(rhs, k, 0)
+        shape = lines.shape
+        solved = scipy.linalg.solve_banded((1, 1), banded, 
+                                           lines.reshape(npoints, -1),
+                                           overwrite_b=True, 
+                                           check_finite=False)
+        return np.moveaxis(solved.reshape(shape), 0, k)
+
+    def step(v, step_dt, theta):
+        changes = [change(v, k) for k in range(3)]
+        rhs = v + step_dt * (((1. - theta) * changes[0]) + 
+                             changes[1] + changes[2])
+        new = solve(rhs, 0, theta * step_dt)
+        for k in [1, 2]:
+            new = solve(new - (theta * step_dt * changes[k]), k, 
+                        theta * step_dt)
+        return new
+
+    v = step(v, dt / 2., 1.)
+    v = step(v, dt / 2., 1.)
+    for n in range(timesteps - 1):
+        v = step(v, dt, 0.5)
+    return v
+
+
+def resample3D(values, points):
+    """
+    Linearly interpolates a 3D matrix covering a block onto points 
+    evenly spaced points in each direction, edges included.
+    """
+    values = np.asarray(values, dtype=float)
+    for k in range(3):
+        if values.shape[k] != points:
+            old = np.linspace(0., 1., values.shape[k])
+            new = np.linspace(0., 1., points)
+            values = np.apply_along_axis(lambda line: np.interp(new, old, 
+                                                                line),
+                                         k, values)
+    return values
+
+
+def diffusion3D_numerical_params(params, initial_matrix=None, points=50,
+                                 timesteps=100):
+    """
+    Returns the 3D unit concentration matrix after diffusion with the 
+    lmfit parameters from params_setup3D, calculated with adi3D and 
+    holding the faces at final_unit_value. 
+    
+    If initial_matrix is None (default), the block starts out at 
+    initial_unit_value everywhere. Otherwise, it starts out as 
+    initial_matrix, which is resampled to points in each direction
+    if needed; e.g., the output of diffusion3D_stages.
+    """
+    p = params.valuesdict()
+    L3_meters = [length / 1e6 for length in p['microns3']]
+    D3 = [10.**p['log10Dx'], 10.**p['log10Dy'], 10.**p['log10Dz']]
+    points = int(points)
+    if initial_matrix is None:
+        start = p['initial_unit_value'] * np.ones((points, points, points))
+    else:
+        start = resample3D(initial_matrix, points)
+    return adi3D(start, L3_meters, D3, p['time_seconds'], 
+                 boundary=p['final_unit_value'], timesteps=timesteps)
+
+
+def diffusion3D_stages(lengths_microns, stages, initial=1., points=50, 
+                       timesteps=100):
+    """
+    3D unit concentration matrix after several heating steps one after 
+    another, e.g., hydration and then dehydration.
+    
+    Requires:
+        list of 3 lengths in microns
+        list of stages, each a tuple of (list of 3 log10 diffusivities 
+            in m2/s, time in seconds, final unit value held at the faces
+            during that stage), 
+            e.g., [([-12, -12, -12], 3600, 1.), ([-13, -13, -13], 600, 0.)]
+        
+    Optional input:
+        initial unit value (default 1) or 3D matrix at the start
+        number of points in each direction (default 50)
+        number of time steps for each stage (default 100)
+        
+    Pass the result in to Block.fitD or Block.plot_diffusion as 
+    initial_matrix with solver='adi' to model the next stage.
+    """
+    lengths_microns = length_checker(lengths_microns)
+    if np.ndim(initial) == 0:
+        v = initial * np.ones((points, points, points))
+    else:
+        v = resample3D(initial, points)
+    L3_meters = [length / 1e6 for length in lengths_microns]
+    for log10Ds_m2s, time_seconds, final in stages:
+        log10Ds_m2s = D_checker(log10Ds_m2s)
+        D3 = [10.**D for D in log10Ds_m2s]
+        v = adi3D(v, L3_meters, D3, time_seconds, boundary=final, 
+                  timesteps=timesteps)
+        if v is None:
+            return
+    return v
+
+
+def diffusion3Dwb_numerical_params(params, data_x_microns=None, 
+                                   data_y_unit_areas=None, raypaths=None,
+                                   initial_matrix=None, points=50, 
+                                   timesteps=100, **kwargs):
+    """
+    Finite-difference version of diffusion3Dwb_params with the same 
+    lmfit parameters (see params_setup3D) and the same output: without 
+    data, the positions and values of the three whole-block profiles; 
+    with data, the residuals for use in fitting. 
+    
+    The block starts out as initial_matrix, e.g., from 
+    diffusion3D_stages, or at initial_unit_value everywhere if 
+    initial_matrix is None (default). See diffusion3D_numerical_params.
+    Other keywords for diffusion3Dwb_params are ignored.
+    """
+    if raypaths is None:
+        print('raypaths must be in the form of a list of three abc directions')
+        return
+    if check_raypaths(raypaths) is False:
+        return
+
+    fitting = False
+    if (data_x_microns is not None) and (data_y_unit_areas is not None):
+        x_array = [np.array(xk, dtype=float) for xk in data_x_microns]
+        y_array = [np.array(yk, dtype=float) for yk in data_y_unit_areas]
+        if [np.shape(xk) for xk in x_array] == [np.shape(yk) for yk in 
+                                                y_array]:
+            fitting = True
+        else:
+            print('x and y data must be the same shape')
+
+    if params.valuesdict()['time_seconds'] < 0:
+        return
+    v = diffusion3D_numerical_params(params, initial_matrix=initial_matrix,
+                                     points=points, timesteps=timesteps)
+    if v is None:
+        return
+    wb_profiles = wholeblock_from_matrix(v, raypaths)
+
+    points = int(points)
+    wb_positions = [np.linspace(0., float(length), points) for length in 
+                    params.valuesdict()['microns3']]
+    if fitting is False:
+        return wb_positions, wb_profiles
+    # wb_positions and the data positions both run from 0 to the length
+    y_model = wholeblock_at_positions(wb_positions, wb_profiles, x_array)
+    return y_model - np.concatenate(y_array)
+
+
+#%% Temperature-time paths: Arrhenius parameters in place of D and time
+def params_setup1D_path(microns, Ea_kJmol, log10D0_m2s, init=1., fin=0.,
+                        vEa=False, vD0=True, vinit=False, vfin=False):
+    """
+    Like params_setup1D, but with an activation energy in kJ/mol and 
+    log10 D0 in m2/s in place of the diffusivity and time, for use in 
+    diffusion1D_path_params with a temperature-time path.
+    """
+    params = lmfit.Parameters()
+    params.add('microns', microns, False, None, None, None)
+    params.add('Ea_kJmol', float(Ea_kJmol), vEa, 0., None, None)
+    params.add('log10D0_m2s', float(log10D0_m2s), vD0, None, None, None)
+    params.add('initial_unit_value', init, vinit, None, None, None)
+    params.add('final_unit_value', fin, vfin, None, None, None)
+    return params
+
+
+def isothermal_params1D(params, temperature_path):
+    """
+    Takes lmfit parameters from params_setup1D_path and a 
+    temperature-time path as a pair of lists (times in seconds, 
+    temperatures in celsius) and returns the equivalent isothermal 
+    parameters for diffusion1D_params: the diffusivity that gives the 
+    same integral of D over time (see diffusivities.effective_log10D) 
+    and the total time of the path. Returns None if something is wrong 
+    with the path.
+    """
+    p = params.valuesdict()
+    times_seconds, celsius = temperature_path
+    log10D = diffusivities.effective_log10D(p['Ea_kJmol'], 
+                                            10.**p['log10D0_m2s'],
+                                            times_seconds, celsius)
+    if log10D is None:
+        return
+    total_time = times_seconds[-1] - times_seconds[0]
+    return params_setup1D(p['microns'], log10D, total_time, 
+                          init=p['initial_unit_value'], 
+                          fin=p['final_unit_value'])
+
+
+def diffusion1D_path_params(params, data_x_microns=None, 
+                            data_y_unit_areas=None, temperature_path=None, 
+                            model=None, **kwargs):
+    """
+    1D diffusion along a temperature-time path, e.g., with a ramp up 
+    to temperature and a quench at the end, instead of at a single 
+    temperature. Takes lmfit parameters from params_setup1D_path and 
+    the path as a pair of lists (times in seconds, temperatures in 
+    celsius) with the temperature changing linearly between them.
+    
+    The diffusion equation only depends on time through the integral 
+    of D over time, which is worked out along the whole path (see 
+    diffusivities.integrate_Dt) and passed to model (default 
+    diffusion1D_params; diffusion1D_numerical_params also works) as the 
+    equivalent isothermal diffusivity and time. The output and other 
+    keywords are the same as for model.
+    """
+    if temperature_path is None:
+        print('Need temperature_path as (times in seconds, celsius)')
+        return
+    if model is None:
+        model = diffusion1D_params
+    isothermal = isothermal_params1D(params, temperature_path)
+    if isothermal is None:
+        return
+    return model(isothermal, data_x_microns, data_y_unit_areas, **kwargs)
+
+
+def params_setup3D_path(microns3, Ea_kJmol, log10D0s_m2s, initial=1., 
+                        final=0., vEa=False, vD0=[True, True, True], 
+                        vinit=False, vfin=False):
+    """
+    Like params_setup3D, but with activation energies in kJ/mol and 
+    log10 D0 values in m2/s in place of the diffusivities and time, 
+    for use in diffusion3Dwb_path_params with a temperature-time path.
+    
+    Ea_kJmol can be a single activation energy used in all three 
+    directions or a list of 3, one for each direction. vEa works the 
+    same way. log10D0s_m2s is a list of 3.
+    """
+    params = lmfit.Parameters()
+    params.add('microns3', microns3, False, None, None, None)
+    if np.ndim(Ea_kJmol) == 0:
+        Ea3 = [float(Ea_kJmol)] * 3
+        vEa3 = [vEa, False, False]
+        ties = [None, 'Eax_kJmol', 'Eax_kJmol']
+    else:
+        Ea3 = [float(Ea) for Ea in Ea_kJmol]
+        if np.ndim(vEa) == 0:
+            vEa3 = [vEa] * 3
+        else:
+            vEa3 = vEa
+        ties = [None, None, None]
+    for k, direction in enumerate(['x', 'y', 'z']):
+        params.add('Ea' + direction + '_kJmol', Ea3[k], vEa3[k], 0., None, 
+                   ties[k])
+    for k, direction in enumerate(['x', 'y', 'z']):
+        params.add('log10D0' + direction, float(log10D0s_m2s[k]), vD0[k], 
+                   None, None, None)
+    params.add('initial_unit_value', float(initial), vinit, None, None, None)
+    params.add('final_unit_value', float(final), vfin, None, None, None)
+    return params
+
+
+def isothermal_params3D(params, temperature_path):
+    """
+    Takes lmfit parameters from params_setup3D_path and a 
+    temperature-time path (see isothermal_params1D) and returns the 
+    equivalent isothermal parameters for the 3D models. Returns None if
+    something is wrong with the path.
+    """
+    p = params.valuesdict()
+    times_seconds, celsius = temperature_path
+    log10D3 = []
+    for direction in ['x', 'y', 'z']:
+        log10D = diffusivities.effective_log10D(p['Ea' + direction + 
+                                                  '_kJmol'], 
+                                                10.**p['log10D0' + 
+                                                       direction],
+                                                times_seconds, celsius)
+        if log10D is None:
+            return
+        log10D3.append(log10D)
+    total_time = times_seconds[-1] - times_seconds[0]
+    return params_setup3D(p['microns3'], log10D3, total_time, 
+                          initial=p['initial_unit_value'], 
+                          final=p['final_unit_value'])
+
+
+def diffusion3Dwb_path_params(params, data_x_microns=None, 
+                              data_y_unit_areas=None, temperature_path=None,
+                              model=None, **kwargs):
+    """
+    Whole-block diffusion along a temperature-time path. Takes lmfit 
+    parameters from params_setup3D_path and the path as a pair of lists
+    (times in seconds, temperatures in celsius). 
+    
+    Works like diffusion1D_path_params, with model defaulting to 
+    diffusion3Dwb_params (diffusion3Dwb_numerical_params also works). 
+    Each direction gets its own integral of D over time, which is exact
+    for both because diffusion in each direction goes on independently
+    of the others.
+    """
+    if temperature_path is None:
+        print('Need temperature_path as (times in seconds, celsius)')
+        return
+    if model is None:
+        model = diffusion3Dwb_params
+    isothermal = isothermal_params3D(params, temperature_path)
+    if isothermal is None:
+        return
+    return model(isothermal, data_x_microns, data_y_unit_areas, **kwargs)
+
+
+def arrhenius_effective(Ea_kJmol, temperature_path):
+    """
+    Returns the shifts from log10 D0 to the equivalent isothermal log10 
+    diffusivities along temperature_path (see isothermal_params1D) for 
+    an array of activation energies in kJ/mol, and the slopes of those 
+    shifts with respect to Ea (see diffusivities.effective_log10D_slope).
+    """
+    Ea = np.asarray(Ea_kJmol, dtype=float)
+    times_seconds, celsius = temperature_path
+    shifts = diffusivities.effective_log10D(Ea, 1., times_seconds, celsius)
+    if shifts is None:
+        return
+    slopes = diffusivities.effective_log10D_slope(Ea, times_seconds, celsius)
+    return np.atleast_1d(shifts), np.atleast_1d(slopes)
+
+
+def fit_arrhenius(datasets, Ea_kJmol=300., log10D0s_m2s=None, vary_Ea=True,
+                  common_Ea=False, points=50, jacobian=True, **kwargs):
+    """
+    Fits activation energies and D0 values directly to the data from 
+    many diffusion experiments at once, with one Ea and one D0 for each 
+    orientation (or one Ea for all of them with common_Ea=True) instead
+    of fitting D to each experiment and then fitting a line through 
+    the D values.
+    
+    Requires a list of datasets, each a dictionary with:
+        x_microns: list of arrays of data positions from 0 to the length,
+            one array for a profile or three for a whole block
+        y: list of arrays of unit values to go with them
+        lengths_microns: list of 1 or 3 lengths
+        orientations: list of 1 or 3 labels, e.g., ['a'] or 
+            ['a', 'b', 'c'], which decide which Ea and D0 go with each
+            direction
+        raypaths: list of 3 raypaths for whole-block data; leave it out 
+            for profiles
+        either temperature_path: (times in seconds, temperatures in 
+            celsius) or celsius and time_seconds for isothermal runs
+    and optionally:
+        initial and final: unit values (default 1 and 0)
+        vary_initial and vary_final: whether to fit them for that 
+            experiment only (default False)
+        symmetric: for profiles, as in diffusion1D_params (default True)
+        
+    Optional input:
+        Ea_kJmol: starting activation energy for all orientations or a
+            dictionary with one for each orientation (default 300)
+        log10D0s_m2s: the same for the starting log10 D0 in m2/s. 
+            Default gives log10 D = -12 in a typical experiment.
+        vary_Ea: set to False to hold Ea constant and only fit D0
+        points: resolution of the models
+        jacobian: set to False to use finite differences instead of 
+            the analytical derivatives
+        Other keywords are passed on to scipy.optimize.least_squares.
+        
+    Profiles use the erf solution in diffusion1D_array and whole blocks
+    use wholeblock_array, both with analytical derivatives. Each 
+    experiment only touches a few of the columns of the Jacobian (its 
+    orientations' Ea and D0 and its own initial and final values), so 
+    the Jacobian is put together as a sparse matrix and solved with 
+    least_squares' iterative trust-region solver, which keeps fitting 
+    hundreds of experiments with thousands of data points in one go 
+    quick. 
+    
+    Returns:
+        values: dictionary of best-fit values, with names like 
+            'Ea_kJmol_a' (or just 'Ea_kJmol' with common_Ea=True), 
+            'log10D0_m2s_a', 'initial_3', and 'final_3', where 3 is the
+            index of the dataset
+        errors: dictionary of the standard errors, 0 for parameters 
+            held constant and None if they can't be estimated
+        misfits: list with a dictionary for each dataset of its sum of 
+            squared residuals (rss), number of data points (npoints), 
+            and equivalent isothermal log10 diffusivities (log10Ds_m2s)
+    """
+    orientations = []
+    paths = []
+    for data in datasets:
+        for orientation in data['orientations']:
+            if orientation not in orientations:
+                orientations.append(orientation)
+        path = data.get('temperature_path', None)
+        if path is None:
+            try:
+                path = ([0., data['time_seconds']], 
+                        [data['celsius'], data['celsius']])
+            except KeyError:
+                print('Every dataset needs a temperature_path or celsius '
+                      'and time_seconds')
+                return
+        paths.append(path)
+
+    # set up the parameters, keeping track of where each one goes
+    names = []
+    start = []
+    vary = []
+    lower = []
+    Ea_index = {}
+    D0_index = {}
+    def add(name, value, free, minimum=-np.inf):
+        names.append(name)
+        start.append(float(value))
+        vary.append(free)
+        lower.append(minimum)
+        return len(names) - 1
+
+    def starting(value, orientation):
+        if isinstance(value, dict):
+            return value[orientation]
+        return value
+
+    if common_Ea is True:
+        index = add('Ea_kJmol', starting(Ea_kJmol, orientations[0]), vary_Ea,
+                    0.)
+        for orientation in orientations:
+            Ea_index[orientation] = index
+    for orientation in orientations:
+        if common_Ea is False:
+            Ea_index[orientation] = add('Ea_kJmol_' + orientation, 
+                                        starting(Ea_kJmol, orientation), 
+                                        vary_Ea, 0.)
+        if log10D0s_m2s is None:
+            Ea = start[Ea_index[orientation]]
+            shifts = [arrhenius_effective([Ea], path)[0][0] 
+                      for path in paths]
+            log10D0 = -12. - np.median(shifts)
+        else:
+            log10D0 = starting(log10D0s_m2s, orientation)
+        D0_index[orientation] = add('log10D0_m2s_' + orientation, log10D0,
+                                    True)
+    init_index = []
+    fin_index = []
+    for idx, data in enumerate(datasets):
+        if data.get('vary_initial', False) is True:
+            init_index.append(add('initial_' + str(idx), 
+                                  data.get('initial', 1.), True))
+        else:
+            init_index.append(None)
+        if data.get('vary_final', False) is True:
+            fin_index.append(add('final_' + str(idx), 
+                                 data.get('final', 0.), True))
+        else:
+            fin_index.append(None)
+
+    start = np.array(start)
+    vary = np.array(vary, dtype=bool)
+    free_index = -np.ones(len(names), dtype=int)
+    free_index[vary] = np.arange(vary.sum())
+    y_all = [np.concatenate([np.asarray(yk, dtype=float) 
+                             for yk in data['y']]) for data in datasets]
+    offsets = np.concatenate([[0], np.cumsum([len(y) for y in y_all])])
+
+    def evaluate(values, jacobian=False):
+        """Residuals (and sparse Jacobian entries) for all datasets"""
+        residuals = []
+        rows = []
+        columns = []
+        entries = []
+        for idx, data in enumerate(datasets):
+            orients = data['orientations']
+            Ea = [values[Ea_index[orientation]] for orientation in orients]
+            shifts, slopes = arrhenius_effective(Ea, paths[idx])
+            log10Ds = [values[D0_index[orientation]] + shift 
+                       for orientation, shift in zip(orients, shifts)]
+            times_seconds = paths[idx][0]
+            total_time = times_seconds[-1] - times_seconds[0]
+            if init_index[idx] is None:
+                init = data.get('initial', 1.)
+            else:
+                init = values[init_index[idx]]
+            if fin_index[idx] is None:
+                fin = data.get('final', 0.)
+            else:
+                fin = values[fin_index[idx]]
+
+            if data.get('raypaths', None) is None:
+                length_meters = data['lengths_microns'][0] / 1e6
+                x = (np.asarray(data['x_microns'][0], dtype=float) / 1e6 - 
+                     (length_meters / 2.))
+                symmetric = data.get('symmetric', True)
+                model = diffusion1D_array(x, length_meters, 
+                                          10.**log10Ds[0], total_time, 
+                                          init=init, fin=fin, 
+                                          symmetric=symmetric)
+                if jacobian is True:
+                    full = diffusion1D_jacobian(x, length_meters, 
+                                                10.**log10Ds[0], total_time,
+                                                init=init, fin=fin, 
+                                                symmetric=symmetric)
+                    derivatives = [full[:, 0]]
+                    init_column = full[:, 2]
+                    fin_column = full[:, 3]
+            else:
+                lengths = data['lengths_microns']
+                wb_positions = [np.linspace(0., float(length), points) 
+                                for length in lengths]
+                wb_profiles = wholeblock_array(lengths, log10Ds, total_time,
+                                               data['raypaths'], init=init,
+                                               fin=fin, points=points)
+                # wb_positions and the data positions both run from 0 to
+                # the length
+                model = wholeblock_at_positions(wb_positions, wb_profiles,
+                                                data['x_microns'])
+                if jacobian is True:
+                    full = wholeblock_jacobian(lengths, log10Ds, total_time,
+                                               data['raypaths'], init=init,
+                                               fin=fin, points=points)
+                    columns_at_data = [wholeblock_at_positions(wb_positions,
+                                        [jk[:, column] for jk in full], 
+                                        data['x_microns'])
+                                       for column in range(6)]
+                    derivatives = columns_at_data[0:3]
+                    init_column = columns_at_data[4]
+                    fin_column = columns_at_data[5]
+            residuals.append(model - y_all[idx])
+            if jacobian is False:
+                continue
+
+            pairs = []
+            for k, orientation in enumerate(orients):
+                pairs.append((D0_index[orientation], derivatives[k]))
+                pairs.append((Ea_index[orientation], 
+                              derivatives[k] * slopes[k]))
+            pairs.append((init_index[idx], init_column))
+            pairs.append((fin_index[idx], fin_column))
+            row_numbers = np.arange(offsets[idx], offsets[idx + 1])
+            for index, column in pairs:
+                if (index is None) or (free_index[index] < 0):
+                    continue
+                rows.append(row_numbers)
+                columns.append(free_index[index] * 
+                               np.ones(len(row_numbers), dtype=int))
+                entries.append(column)
+        if jacobian is False:
+            return np.concatenate(residuals)
+        # repeated entries, e.g., from a shared Ea, are added together
+        return scipy.sparse.coo_matrix((np.concatenate(entries), 
+                                        (np.concatenate(rows), 
+                                         np.concatenate(columns))), 
+                                       shape=(offsets[-1], 
+                                              vary.sum())).tocsr()
+
+    def all_values(free):
+        values = start.copy()
+        values[vary] = free
+        return values
+
+    if jacobian is True:
+        kwargs.setdefault('tr_solver', 'lsmr')
+        # Ea in kJ/mol and log10 D0 have very different scales
+        kwargs.setdefault('x_scale', 'jac')
+        def free_jac(free):
+            return evaluate(all_values(free), jacobian=True)
+    else:
+        free_jac = '2-point'
+    lower = np.array(lower)[vary]
+    result = least_squares(lambda free: evaluate(all_values(free)), 
+                           np.maximum(start[vary], lower), jac=free_jac, 
+                           bounds=(lower, np.inf), **kwargs)
+    best = all_values(result.x)
+
+    errors = {}
+    for name, free in zip(names, vary):
+        if free:
+            errors[name] = None
+        else:
+            errors[name] = 0.
+    nresiduals = len(result.fun)
+    nfree = len(result.x)
+    if nresiduals > nfree:
+        jac = evaluate(best, jacobian=True)
+        try:
+            covariance = np.linalg.inv((jac.T.dot(jac)).toarray())
+            covariance = covariance * 2. * result.cost / (nresiduals - nfree)
+            for name, error in zip(np.array(names)[vary], 
+                                   np.sqrt(np.diag(covariance))):
+                errors[name] = error
+        except np.linalg.LinAlgError:
+            pass
+
+    values = dict(zip(names, best))
+    misfits = []
+    residuals = evaluate(best)
+    for idx, data in enumerate(datasets):
+        shifts = arrhenius_effective([best[Ea_index[orientation]] for 
+                                      orientation in data['orientations']],
+                                     paths[idx])[0]
+        misfits.append({'rss' : np.sum(residuals[offsets[idx]:
+                                                 offsets[idx + 1]]**2),
+                        'npoints' : offsets[idx + 1] - offsets[idx],
+                        'log10Ds_m2s' : [best[D0_index[orientation]] + shift
+                                         for orientation, shift in 
+                                         zip(data['orientations'], shifts)]})
+    return values, errors, misfits
@@ -0,0 +1,96 @@
+"""
+Binary cache for text files that get read over and over again, such as
+FTIR spectra, baselines, and peakfits.
+
+The first time a file is read, the numbers are saved as a .npy file in a
+hidden folder (.pynams_cache) next to the original file. The name of the
+.npy file includes the size and modification time of the original, so
+if the original changes, it is read again and the cache is refreshed.
+Cached files are memory-mapped copy-on-write when they are loaded, so
+reopening hundreds of spectra takes very little time, and changing the
+arrays in python never changes the cache.
+
+To turn the cache off everywhere, set pynams.filecache.enabled = False.
+
+@author Elizabeth Ferriss
+"""
+from __future__ import print_function, division, absolute_import
+import numpy as np
+import os
+
+CACHE_FOLDER = '.pynams_cache'
+enabled = True
+
+
+def cache_filename(filename):
+    """
+    Returns the name of the .npy cache file for filename, which depends
+    on the size and modification time of filename.
+    """
+    stats = os.stat(filename)
+    folder, base = os.path.split(filename)
+    key = '{}.{}-{}.npy'.format(base, stats.st_size,
+                                int(stats.st_mtime * 1e6))
+    return os.path.join(folder, CACHE_FOLDER, key)
+
+
+def clear_stale(filename, keep):
+    """Remove any old cache files for filename other than keep"""
+    cache_folder = os.path.dirname(keep)
+    prefix = os.path.basename(filename) + '.'
+    for name in os.listdir(cache_folder):
+        path = os.path.join(cache_folder, name)
+        if name.startswith(prefix) and path != keep:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def load(filename, reader, use_cache=True):
+    """
+    Returns the 2D array of numbers in filename.
+
+    If there is an up-to-date cache file, it is memory-mapped and
+    returned. Otherwise reader(filename), which must return a numeric
+    array, is called, and the result is saved to the cache for next
+    time. If the cache can't be written, e.g., because the folder is
+    read-only, the result of reader is returned anyway.
+    """
+    if (enabled is False) or (use_cache is False):
+        return reader(filename)
+
+    try:
+        cached = cache_filename(filename)
+    except OSError:
+        return reader(filename)
+
+    if os.path.isfile(cached):
+        try:
+            return np.asarray(np.load(cached, mmap_mode='c'))
+        except (OSError, ValueError):
+            pass
+
+    data = reader(filename)
+    if data is None:
+        return
+    data = np.asarray(data, dtype=float)
+    try:
+        cache_folder = os.path.dirname(cached)
+        if os.path.isdir(cache_folder) is False:
+            os.mkdir(cache_folder)
+        np.save(cached, data)
+        clear_stale(filename, cached)
+    except OSError:
+        pass
+    return data
+
+
+def clear(folder):
+    """Delete all cache files for files in folder"""
+    cache_folder = os.path.join(folder, CACHE_FOLDER)
+    if os.path.isdir(cache_folder) is False:
+        return
+    for name in os.listdir(cache_folder):
+        if name.endswith('.npy'):
+            os.remove(os.path.join(cache_folder, name))
@@ -0,0 +1,270 @@
+"""
+Monte Carlo uncertainties for diffusivities fit to Profiles.
+
+The uncertainty from Profile.fitD only reflects the scatter of the data
+around the best-fit curve. montecarlo_fitD makes thousands of copies of
+a profile in which the sample thickness, the positions, the baselines,
+and the areas are all randomly perturbed by their uncertainties, fits
+every copy, and returns the distributions of the best-fit values, e.g.,
+    results = montecarlo_fitD(profile, trials=5000,
+                              thickness_error=0.02,
+                              position_error_microns=10.,
+                              baseline_error=0.05, seed=1)
+    np.percentile(results['log10D_m2s'], [2.5, 97.5])
+
+The copies are fit in batches with models.fit_diffusion1D_batch, which
+steps all of the fits in a batch at once in numpy arrays, and the
+batches are spread over a pool of processes. All of the random
+perturbations are made up front from a single seed, so the results are
+the same whatever the number of processes or the batch size.
+
+Profile.montecarlo_fitD does the same thing.
+
+@author Elizabeth Ferriss
+"""
+from __future__ import print_function, division, absolute_import
+import numpy as np
+import os
+from concurrent import futures
+from pynams.diffusion import models
+from pynams.spectra import AreaIntegrator
+
+RESULT_NAMES = ['log10D_m2s', 'initial', 'final', 'minutes']
+
+
+def baseline_sensitivities(spectra, method='mean'):
+    """
+    Returns two arrays with the change in the area under the curve of
+    each spectrum in a list when its baseline is raised by 1 (in the
+    thickness-normalized absorbance units of the baseline) all the way
+    across, and when the middle of the baseline is raised by 1 with a
+    quadratic bow that leaves the two ends where they are.
+
+    Spectra without baselines get 0.
+    """
+    offsets = np.zeros(len(spectra))
+    bows = np.zeros(len(spectra))
+    for idx, spec in enumerate(spectra):
+        wn = getattr(spec, 'base_wn', None)
+        if wn is None:
+            continue
+        wn = np.asarray(wn, dtype=float)
+        middle = (wn[0] + wn[-1]) / 2.
+        halfwidth = (wn[-1] - wn[0]) / 2.
+        bow = 1. - ((wn - middle) / halfwidth)**2
+        integrator = AreaIntegrator(wn, np.vstack((-np.ones_like(wn), -bow)))
+        areas = integrator.area(wn_low=spec.base_low_wn,
+                                wn_high=spec.base_high_wn, method=method)
+        if areas is not None:
+            offsets[idx], bows[idx] = areas
+    return offsets, bows
+
+
+def perturb_areas(areas, trials, rng, sensitivities=None,
+                  thickness_error=0., baseline_error=0.,
+                  baseline_bow_error=0., area_error=0.):
+    """
+    Returns an array with one row for each of trials copies of areas,
+    each perturbed by:
+        thickness_error: relative error in the thickness of each
+            spectrum; the areas are divided by the thickness
+        baseline_error and baseline_bow_error: errors in the height and
+            the bow of each baseline, with the area changing by
+            sensitivities (see baseline_sensitivities)
+        area_error: any other relative error in each area
+    using the random numbers from rng, a numpy RandomState.
+    """
+    areas = np.asarray(areas, dtype=float)
+    shape = (trials, len(areas))
+    perturbed = np.tile(areas, (trials, 1))
+    if sensitivities is not None:
+        offsets, bows = sensitivities
+        perturbed = (perturbed +
+                     (baseline_error * rng.standard_normal(shape) * offsets) +
+                     (baseline_bow_error * rng.standard_normal(shape) * bows))
+    perturbed = perturbed * (1. + (area_error * rng.standard_normal(shape)))
+    thickness = 1. + (thickness_error * rng.standard_normal(shape))
+    return perturbed / thickness
+
+
+def perturbed_data(profile, trials=1000, seed=None, thickness_error=0.,
+                   position_error_microns=0., baseline_error=0.,
+                   baseline_bow_error=0., area_error=0., peak_idx=None,
+                   wholeblock=False, heights_instead=False, method='mean'):
+    """
+    Returns arrays of positions and y-values for trials perturbed copies
+    of the profile data, one copy per row (see montecarlo_fitD).
+    """
+    rng = np.random.RandomState(seed)
+    positions = np.asarray(profile.positions_microns, dtype=float)
+    bulk = (peak_idx is None)
+
+    def perturbed_profile_areas(prof):
+        areas = prof.y_data_picker(False, heights_instead, peak_idx)
+        if bulk is True:
+            sensitivities = baseline_sensitivities(prof.spectra,
+                                                   method=method)
+        else:
+            sensitivities = None
+        return perturb_areas(areas, trials, rng, sensitivities,
+                             thickness_error=thickness_error,
+                             baseline_error=baseline_error,
+                             baseline_bow_error=baseline_bow_error,
+                             area_error=area_error)
+
+    if (wholeblock is True) and (bulk is True):
+        areas = perturbed_profile_areas(profile)
+        initial = profile.initial_profile
+        if (initial is None) or (initial is profile):
+            initial_areas = areas
+            initial_positions = positions
+        else:
+            initial_areas = perturbed_profile_areas(initial)
+            initial_positions = np.asarray(initial.positions_microns,
+                                           dtype=float)
+        # best-fit line through each set of initial areas,
+        # as in Profile.make_wholeblock
+        if (len(initial_positions) > 1) and (np.ptp(initial_positions) > 0):
+            slopes, intercepts = np.polyfit(initial_positions,
+                                            initial_areas.T, 1)
+            lines = ((slopes[:, None] * positions[None, :]) +
+                     intercepts[:, None])
+        else:
+            lines = np.mean(initial_areas, axis=1)[:, None]
+        y = areas / lines
+    elif wholeblock is True:
+        # peak-specific whole-block ratios are perturbed directly
+        y = perturb_areas(profile.y_data_picker(True, heights_instead,
+                                                peak_idx),
+                          trials, rng, thickness_error=thickness_error,
+                          area_error=area_error)
+    else:
+        y = perturbed_profile_areas(profile)
+
+    x = positions + (position_error_microns *
+                     rng.standard_normal((trials, len(positions))))
+    x = np.clip(x, 0., profile.length_microns)
+    return x, y
+
+
+def montecarlo_fitD(profile, trials=1000, seed=None, thickness_error=0.02,
+                    position_error_microns=10., baseline_error=0.,
+                    baseline_bow_error=0., area_error=0.,
+                    time_seconds=None, log10Dm2s=None,
+                    initial_unit_value=1., final_unit_value=0.,
+                    vary_initial=False, vary_final=False, vary_time=False,
+                    varyD=True, peak_idx=None, wholeblock=False,
+                    heights_instead=False, symmetric=True, method='mean',
+                    processes=None, batch_size=500, printout=True):
+    """
+    Monte Carlo uncertainties for the values from Profile.fitD.
+
+    Makes trials copies of the profile data with:
+        thickness_error: relative error in the thickness of each
+            spectrum (default 0.02, i.e., 2%)
+        position_error_microns: error in each position (default 10)
+        baseline_error: error in the height of each baseline in
+            thickness-normalized absorbance units (default 0)
+        baseline_bow_error: error in how far the middle of each baseline
+            bows up or down from its ends, in the same units (default 0)
+        area_error: any other relative error in each area (default 0)
+    all drawn from normal distributions, fits the erf solution for 1D
+    diffusion to every copy, and returns a dictionary of arrays with one
+    value for each copy:
+        log10D_m2s, initial, final, minutes: best-fit values, with
+            initial and final on the scale of the data, as in fitD
+        rss: sum of squared residuals of the unit-scaled fit
+        converged: whether the fit converged
+
+    The baseline and thickness errors go into the areas and so only
+    apply to bulk areas (peak_idx=None). For whole-block data, the
+    initial profile's areas are perturbed too, and the whole-block
+    ratios are remade from them. Peak-specific data are perturbed
+    directly by thickness_error and area_error.
+
+    Pass a seed to get the same results every time. The other keywords
+    are the same as for Profile.fitD, except that by default the 
+    diffusivity varies and the time is fixed (varyD=True, 
+    vary_time=False), since the distribution of log10D is usually 
+    what's wanted.
+
+    The fits are done batch_size at a time with
+    models.fit_diffusion1D_batch and spread over a pool of processes
+    (default: one for each CPU). Set processes=1 to do them all here.
+    """
+    if profile.length_microns is None:
+        print('Need to set profile attribute length_microns')
+        return
+    if profile.positions_microns is None:
+        print('Need to set profile positions')
+        return
+
+    if time_seconds is None:
+        time_seconds = getattr(profile, 'time_seconds', None)
+        if time_seconds is None:
+            time_seconds = 36000.
+    if log10Dm2s is None:
+        log10Dm2s = getattr(profile, 'D_area', None)
+        if log10Dm2s is None:
+            log10Dm2s = -12.
+
+    x, y = perturbed_data(profile, trials=trials, seed=seed,
+                          thickness_error=thickness_error,
+                          position_error_microns=position_error_microns,
+                          baseline_error=baseline_error,
+                          baseline_bow_error=baseline_bow_error,
+                          area_error=area_error, peak_idx=peak_idx,
+                          wholeblock=wholeblock,
+                          heights_instead=heights_instead, method=method)
+
+    # as in fitD, scale each copy so its highest value is 1
+    scale = np.max(y, axis=1)
+    y = y / scale[:, None]
+
+    kwargs = dict(init=initial_unit_value, fin=final_unit_value,
+                  vD=varyD, vinit=vary_initial, vfin=vary_final,
+                  vTime=vary_time, symmetric=symmetric)
+    batches = [slice(start, start + batch_size) for start in
+               range(0, trials, batch_size)]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(int(processes), len(batches)))
+
+    if processes == 1:
+        fits = [models.fit_diffusion1D_batch(x[batch], y[batch],
+                                             profile.length_microns,
+                                             log10Dm2s, time_seconds,
+                                             **kwargs)
+                for batch in batches]
+    else:
+        with futures.ProcessPoolExecutor(processes) as pool:
+            jobs = [pool.submit(models.fit_diffusion1D_batch, x[batch],
+                                y[batch], profile.length_microns,
+                                log10Dm2s, time_seconds, **kwargs)
+                    for batch in batches]
+            fits = [job.result() for job in jobs]
+
+    def gather(name):
+        return np.concatenate([fit[name] for fit in fits])
+
+    results = {'log10D_m2s' : gather('log10D_m2s'),
+               'initial' : gather('initial_unit_value') * scale,
+               'final' : gather('final_unit_value') * scale,
+               'minutes' : gather('time_seconds') / 60.,
+               'rss' : gather('rss'),
+               'converged' : gather('converged')}
+
+    if printout is True:
+        print(trials, 'Monte Carlo fits,',
+              np.count_nonzero(results['converged']), 'converged')
+        varied = [varyD, vary_initial, vary_final, vary_time]
+        for name, vary in zip(RESULT_NAMES, varied):
+            if vary is False:
+                continue
+            values = results[name]
+            low, median, high = np.percentile(values, [2.5, 50., 97.5])
+            print(''.join((name, ': ', '{:.2f}'.format(np.mean(values)),
+                           ' +/- ', '{:.2f}'.format(np.std(values)),
+                           ' (95%: ', '{:.2f}'.format(low), ' to ',
+                           '{:.2f}'.format(high), ')')))
+    return results
@@ -11,8 +11,11 @@ from __future__ import print_function, division, absolute_import
 import numpy as np
 from . import styles
 from . diffusion import models
+from . diffusion import diffusivities
 from . import pynams
+from . import montecarlo
 from .spectra import Spectrum
+from . import spectra as spectramodule
 import uncertainties
 from uncertainties import ufloat
 import gc
@@ -44,6 +47,7 @@ class Profile():
                  diff_error=None, 
                  peak_diffusivities=[], 
                  peak_diff_error=[], 
+                 store=None,
                  ):
         """
         Creates a group of FTIR Spectrum objects that can be handled
@@ -67,6 +71,9 @@ class Profile():
         info contained in sample's length_a_microns, length_b_microns, 
         and length_c_microns.
         
+        To load many spectra at once, pass in a SpectraStore holding the
+        fnames as store (see pynams.spectrastore), and the spectra will
+        use the store's arrays instead of each reading its own file.
         """
         self.name = name
         self.folder = folder
@@ -82,6 +89,7 @@ class Profile():
         self.diff_error = diff_error
         self.peak_diffusivities = peak_diffusivities
         self.peak_diff_error = peak_diff_error
+        self.store = store
         
         try:
             if (self.raypath is not None) and (self.raypath == self.direction):
@@ -94,7 +102,7 @@ class Profile():
         # construct each spectrum from fnames
         fspectra_list = []
         for x in self.fnames:
-            newspec = Spectrum(fname=x, folder=self.folder)
+            newspec = Spectrum(fname=x, folder=self.folder, store=store)
             newspec.fname = x
             fspectra_list.append(newspec)
         self.spectra = fspectra_list
@@ -336,14 +344,47 @@ class Profile():
                       abs_low=None,
                       abs_smear_high=0, 
                       abs_smear_low=0,
-                      store_baseline=True
+                      store_baseline=True,
+                      wn_mid=3550,
+                      batch=True
                       ):
-        """Make baselines for all final and initial spectra in profile"""
+        """
+        Make baselines for all final and initial spectra in profile.
+        Keywords are the same as for spectrum.make_baseline().
+        
+        If all spectra share the same wavenumbers, line and polynomial 
+        baselines are made for the whole profile at once (batch=True) 
+        with pynams.spectra.make_baselines. Splines, plots, or 
+        batch=False make each baseline separately.
+        
+        Either way, the baselines are returned as a 2D array with one row
+        per spectrum, or None if any baseline could not be made or they 
+        don't all have the same length.
+        """
         for spectrum in self.spectra:
             spectrum.base_high_wn = wn_high
             spectrum.base_low_wn = wn_low
-            spectrum.make_baseline(raw_data=raw_data, wn_low=wn_low, 
-                                   wn_high=wn_high, linetype=linetype, 
+
+        if ((batch is True) and (linetype in ['line', 'polynomial']) and 
+            (show_plot is False) and (show_fit_values is False)):
+            base_wn, base_abs = spectramodule.make_baselines(self.spectra, 
+                                   raw_data=raw_data, wn_low=wn_low, 
+                                   wn_high=wn_high, wn_mid=wn_mid, 
+                                   linetype=linetype, curvature=curvature,
+                                   force_through_wn=force_through_wn,
+                                   polynomial_order=polynomial_order,
+                                   abs_high=abs_high, abs_low=abs_low, 
+                                   abs_smear_high=abs_smear_high,
+                                   abs_smear_low=abs_smear_low,
+                                   store_baseline=store_baseline)
+            if base_abs is not None:
+                return base_abs
+
+        baselines = []
+        for spectrum in self.spectra:
+            bline = spectrum.make_baseline(raw_data=raw_data, wn_low=wn_low, 
+                                   wn_high=wn_high, wn_mid=wn_mid,
+                                   linetype=linetype, 
                                    spline_kind=spline_kind, 
                                    spline_wn_high=spline_wn_high,
                                    spline_wn_low=spline_wn_low,
@@ -356,6 +397,8 @@ class Profile():
                                    abs_smear_high=abs_smear_high,
                                    abs_smear_low=abs_smear_low,
                                    store_baseline=store_baseline)
+            baselines.append(bline)
+        return spectramodule.vstack_baselines(baselines)
 
 
     def get_baselines(self, folder=None, delim=',', 
@@ -381,23 +424,45 @@ class Profile():
         
 
     def make_areas(self, peak=None, show_plot=False, 
-                       printout_area=False, wn_low=None, wn_high=None):
+                       printout_area=False, wn_low=None, wn_high=None,
+                       method='mean', batch=True):
         """
         Make list of areas under the curve for an FTIR profile.
         Default is bulk area. Set peak=wavenumber for peak-specific profile.
         Change wn_low and wn_high for wavenumber range other than 
-        full baseline range, as in spectrum.make_area.
+        full baseline range, as in spectrum.make_area. method can be
+        'mean' (default), 'trapezoid', or 'simpson', as in 
+        spectrum.make_area.
         
         If show_plot and printout_area are set to True, then the plot and
         areas will show up when it calculates the areas under the curve
         for each spectrum.
+        
+        If all spectra share the same wavenumbers and baseline wavenumbers,
+        the bulk areas are all made at once (batch=True), and the 
+        AreaIntegrator is kept as self.area_integrator for getting 
+        areas over other wavenumber ranges quickly, e.g., 
+            profile.area_integrator.area(wn_low=3500, wn_high=3550)
         """
         areas = []
         if peak is None:
+            if ((batch is True) and (show_plot is False) and 
+                (printout_area is False)):
+                areas, integrator = spectramodule.make_areas(self.spectra,
+                                                    wn_low=wn_low, 
+                                                    wn_high=wn_high,
+                                                    method=method)
+                if areas is not None:
+                    self.area_integrator = integrator
+                    self.areas = areas
+                    return list(areas)
+                areas = []
+                
             for spec in self.spectra:
                 a = spec.make_area(show_plot=show_plot, 
                                               printout=printout_area,
-                                              wn_low=wn_low, wn_high=wn_high)
+                                              wn_low=wn_low, wn_high=wn_high,
+                                              method=method)
                 areas.append(a)            
             self.areas = np.array(areas)
             
@@ -429,16 +494,16 @@ class Profile():
         for peak in (peaks):
             heights = []
             for spec in self.spectra:
-                idx = np.abs(peak - spec.base_wn).argmin()
+                idx = spec.index_nearest(peak, base=True)
                 height_base = spec.base_abs[idx]
-                idx = np.abs(peak - spec.wn_full).argmin()
+                idx = spec.index_nearest(peak)
                 height_abs = spec.abs_full_cm[idx]                        
                 height = height_abs - height_base
                 heights.append(height)
             self.peak_heights.append(heights)
 
 
-    def make_peakfit_like(self, spectrum):
+    def make_peakfit_like(self, spectrum, fit=False, **kwargs):
         """
         Exactly like spectrum.make_peakfit_like() but applies the 
         input spectrum's peakfitting information to all spectra in 
@@ -449,9 +514,12 @@ class Profile():
             profile.spectra[0].save_peakfit()
         and then change the index from 0 to whatever spectrum
         you want to look at next
+        
+        Set fit=True to refit every spectrum starting from the input
+        spectrum's peakfit instead, or see make_peakfits(warm_start=True).
         """
         for spec in self.spectra:
-            spec.make_peakfit_like(spectrum)
+            spec.make_peakfit_like(spectrum, fit=fit, **kwargs)
 
             
     def save_peakfits(self, folder=None, peak_ending='-peakfit.CSV'):
@@ -465,19 +533,79 @@ class Profile():
 
     def make_peakfits(self, sensitivity=40, peak_positions=None,
                       peak_heights=None, peak_widths=None,
-                      show_plots=False):
+                      show_plots=False, warm_start=False, 
+                      from_center=False, **kwargs):
         """ 
-        Applies Spectrum method make_peakfit() to all spectra in profile
+        Applies Spectrum method make_peakfit() to all spectra in profile.
+        Other keywords, e.g., max_shift, are passed on to make_peakfit().
+        
+        If warm_start is True, only the first spectrum starts from the 
+        input or guessed peak information. Every other spectrum is fit
+        starting from the best fit of its neighbor, going in order of 
+        position, which takes fewer iterations because neighboring spectra 
+        are so similar and keeps the same peaks all along the profile.
+        If from_center is also True, the fitting starts with the spectrum
+        closest to the middle of the profile and works out to both edges.
+        
+        Returns the number of function evaluations used for each fit made
+        here, with 0 for any spectrum whose fit failed.
         """
-        for spec in self.spectra:
-            spec.make_peakfit(sensitivity=sensitivity, 
-                              peak_positions=peak_positions,
-                              peak_heights=peak_heights, 
-                              peak_widths=peak_widths,
-                              show_plot=show_plots)
+        fit = kwargs.pop('fit', True)
+        if warm_start is False:
+            for spec in self.spectra:
+                spec.make_peakfit(sensitivity=sensitivity, 
+                                  peak_positions=peak_positions,
+                                  peak_heights=peak_heights, 
+                                  peak_widths=peak_widths,
+                                  show_plot=show_plots, fit=fit, **kwargs)
+        else:
+            if len(self.positions_microns) == len(self.spectra):
+                order = list(np.argsort(self.positions_microns, 
+                                        kind='mergesort'))
+            else:
+                order = list(range(len(self.spectra)))
+            
+            # pairs of (spectrum index, neighbor index to start from)
+            if from_center is True:
+                middle = len(order) // 2
+                sequence = [(order[middle], None)]
+                for idx in range(middle+1, len(order)):
+                    sequence.append((order[idx], order[idx-1]))
+                for idx in range(middle-1, -1, -1):
+                    sequence.append((order[idx], order[idx+1]))
+            else:
+                sequence = [(order[0], None)]
+                for idx in range(1, len(order)):
+                    sequence.append((order[idx], order[idx-1]))
+
+            for idx, neighbor in sequence:
+                spec = self.spectra[idx]
+                if neighbor is None:
+                    spec.make_peakfit(sensitivity=sensitivity, 
+                                      peak_positions=peak_positions,
+                                      peak_heights=peak_heights, 
+                                      peak_widths=peak_widths,
+                                      show_plot=show_plots, fit=fit, 
+                                      **kwargs)
+                elif fit is True:
+                    spec.make_peakfit_like(self.spectra[neighbor], fit=True,
+                                           show_plot=show_plots, **kwargs)
+                else:
+                    spec.make_peakfit_like(self.spectra[neighbor])
 
         self.get_peak_info()
         
+        # make_peakfit clears peakfit_result first, so these are all
+        # from fits made here
+        nfev = []
+        for spec in self.spectra:
+            result = getattr(spec, 'peakfit_result', None)
+            if result is None:
+                nfev.append(0)
+            else:
+                nfev.append(result.nfev)
+        return nfev
+        
 
     def get_peakfits(self, peak_ending='-peakfit.CSV'):
         """
@@ -553,6 +681,18 @@ class Profile():
         self.peak_maximum_heights_wb = np.ones_like(peakpos)
 
 
+    def make_peakareas(self):
+        """
+        Make Gaussian peak areas for all spectra in the profile at once 
+        using pynams.spectra.make_peakareas and pull the peak info into 
+        the profile with get_peak_info(). Returns the peak areas as a 2D 
+        array (number of spectra x number of peaks).
+        """
+        peak_areas = spectramodule.make_peakareas(self.spectra)
+        self.get_peak_info()
+        return peak_areas
+
+
     def get_area_total(self):
         """Sum up total area of all peaks"""
         total_peak_area = []
@@ -1322,6 +1462,85 @@ class Profile():
         return resid, RSS
             
 
+    def misfit_map(self, log10Ds_m2s, times_seconds=None, wholeblock=False,
+                   heights_instead=False, peak_idx=None, 
+                   initial_unit_value=1., final_unit_value=0., 
+                   erf_or_sum='erf', symmetric=True, lookup=False, 
+                   processes=1, show_plot=True, axes=None):
+        """
+        Brute-force search for diffusivities and times that match the 
+        profile data. Compares the data, scaled the same way as in fitD,
+        with 1D diffusion models for every combination of the 
+        diffusivities in log10Ds_m2s and the times in times_seconds 
+        (default: the profile's time_seconds). 
+        
+        Set processes to spread the work over more than one process and 
+        lookup=True to use precomputed tables (see models.misfit_grid1D).
+        If show_plot is True (default), plots log10 of the misfit, 
+        which shows how well D and time can be told apart.
+        
+        Returns the misfit (sum of squared residuals) with one row per
+        diffusivity and one column per time, and the best log10 D and 
+        time, which make good starting values for fitD.
+        """
+        if times_seconds is None:
+            times_seconds = self.time_seconds
+        if times_seconds is None:
+            print('Need times_seconds or profile attribute time_seconds')
+            return
+        if self.length_microns is None:
+            print('Need to set profile attribute length_microns')
+            return
+        if self.positions_microns is None:
+            print('Need to set profile positions')
+            return
+
+        log10Ds = np.atleast_1d(log10Ds_m2s)
+        times = np.atleast_1d(times_seconds)
+        x = self.positions_microns
+        y_raw = np.array(self.y_data_picker(wholeblock, heights_instead, 
+                                            peak_idx), dtype=float)
+        y = y_raw / max(y_raw)
+        
+        rss = models.misfit_grid1D(x, y, self.length_microns, log10Ds, 
+                                   times, init=initial_unit_value, 
+                                   fin=final_unit_value, 
+                                   erf_or_sum=erf_or_sum, 
+                                   symmetric=symmetric, lookup=lookup,
+                                   processes=processes)
+        if rss is None:
+            return
+        best, best_rss = models.grid_minimum(rss, log10Ds, times)
+        best_D, best_time = best
+        
+        if show_plot is True:
+            if axes is None:
+                fig, axes = plt.subplots()
+            hours = times / 3600.
+            if (len(log10Ds) > 1) and (len(times) > 1):
+                image = axes.pcolormesh(log10Ds, hours, np.log10(rss.T),
+                                        shading='auto')
+                plt.colorbar(image, ax=axes, label='log10 misfit')
+                axes.set_ylabel('time (hours)')
+            elif len(log10Ds) > 1:
+                axes.plot(log10Ds, rss[:, 0], **styles.style_blue)
+                axes.set_ylabel('misfit')
+            else:
+                axes.plot(hours, rss[0], **styles.style_blue)
+                axes.set_xlabel('time (hours)')
+                axes.set_ylabel('misfit')
+            if len(log10Ds) > 1:
+                axes.set_xlabel('log$_{10}$D m$^2$/s')
+                if len(times) > 1:
+                    axes.plot(best_D, best_time / 3600., 'r+', 
+                              markersize=12)
+            axes.set_title(self.name)
+
+        print('best log10D m2/s:', best_D)
+        print('best time (hours):', best_time / 3600.)
+        return rss, best_D, best_time
+
+
     def fitD(self, 
              time_seconds=None, 
              log10Dm2s=None, 
@@ -1339,7 +1558,18 @@ class Profile():
              heights_instead=False,
              symmetric=True,
              points=200,
-             ignore_idx=[]):
+             ignore_idx=[],
+             method='lmfit',
+             jacobian=True,
+             erf_or_sum='erf',
+             solver='analytical',
+             initial_profile=None,
+             D_function=None,
+             timesteps=100,
+             temperature_path=None,
+             Ea_kJmol=None,
+             log10D0_m2s=None,
+             vary_Ea=False):
         """
         Fits a 1D diffusion curve to profile data.
         
@@ -1357,6 +1587,35 @@ class Profile():
         with initial_unit_value or starting_value.
         
         Pass list of indexes of points you don't want included to ignore_idx
+        
+        The fit is done with lmfit by default (method='lmfit'). Set 
+        method='least_squares' to skip lmfit and fit directly with 
+        scipy.optimize.least_squares, which has less overhead.
+        Either way, the fit uses the analytical derivatives of the 
+        diffusion model (see models.diffusion1D_jacobian) unless 
+        jacobian=False, which switches to finite differences. Those 
+        derivatives are for the erf solution, so the fit also uses finite
+        differences with the infinite sum (erf_or_sum='infsum').
+        
+        For profiles that didn't start out uniform or have a 
+        concentration-dependent diffusivity, set solver='crank-nicolson' 
+        to fit with the finite-difference model 
+        models.diffusion1D_numerical_params instead, passing in the 
+        starting unit values as initial_profile and/or a function of 
+        the unit concentrations that multiplies D as D_function. These
+        fits always use lmfit with finite differences.
+        
+        For experiments that weren't isothermal, pass the 
+        temperature-time path as temperature_path=(times in seconds, 
+        temperatures in celsius), e.g., ([0, 600, 4200, 4260], 
+        [25, 1000, 1000, 25]), and the activation energy Ea_kJmol to fit 
+        log10D0_m2s (varyD) and, with vary_Ea=True, Ea_kJmol directly 
+        (see models.diffusion1D_path_params). The starting log10D0_m2s 
+        defaults to the one that gives log10Dm2s over the path. The time
+        is then the total time of the path, and the diffusivity returned
+        is the equivalent isothermal one, with only the error on log10D0.
+        The best-fit Ea and log10D0 are saved as self.fitD_arrhenius. 
+        These fits always use lmfit with finite differences.
         """           
         if time_seconds is None:
             try:
@@ -1371,6 +1630,8 @@ class Profile():
                 log10Dm2s = self.D_area
             except AttributeError:
                 log10Dm2s = -12.
+            if log10Dm2s is None:
+                log10Dm2s = -12.
 
         if self.length_microns is None:
             print('Need to set profile attribute length_microns')
@@ -1418,16 +1679,108 @@ class Profile():
                         'centered' : centered
                         }
 
-        lmfit.minimize(models.diffusion1D_params, params, args=(x, y), 
-                       kws=dict_fitting)
-        best_D = ufloat(params['log10D_m2s'].value, 
-                        params['log10D_m2s'].stderr)
-        best_init = ufloat(params['initial_unit_value'].value, 
-                         params['initial_unit_value'].stderr)
-        best_final = ufloat(params['final_unit_value'].value, 
-                         params['final_unit_value'].stderr)
-        best_time = ufloat(params['time_seconds'].value,
-                           params['time_seconds'].stderr)
+        if temperature_path is not None:
+            if Ea_kJmol is None:
+                print('Need Ea_kJmol to go along with temperature_path')
+                return
+            times_seconds, celsius = temperature_path
+            if log10D0_m2s is None:
+                log10D0_m2s = log10Dm2s - diffusivities.effective_log10D(
+                                             Ea_kJmol, 1., times_seconds, 
+                                             celsius)
+            params = models.params_setup1D_path(self.length_microns, 
+                                                Ea_kJmol, log10D0_m2s, 
+                                                init=init, 
+                                                fin=final_unit_value,
+                                                vEa=vary_Ea, vD0=varyD,
+                                                vinit=vary_initial,
+                                                vfin=vary_final)
+            dict_fitting['temperature_path'] = temperature_path
+            if solver == 'crank-nicolson':
+                dict_fitting['model'] = models.diffusion1D_numerical_params
+                dict_fitting['initial_profile'] = initial_profile
+                dict_fitting['D_function'] = D_function
+                dict_fitting['timesteps'] = timesteps
+            elif solver != 'analytical':
+                print("solver must be 'analytical' or 'crank-nicolson'")
+                return
+            result = lmfit.minimize(models.diffusion1D_path_params, params,
+                                    args=(x, y), kws=dict_fitting)
+            params = getattr(result, 'params', params)
+            values = {}
+            errors = {}
+            for name in params:
+                values[name] = params[name].value
+                errors[name] = params[name].stderr
+            isothermal = models.isothermal_params1D(params, temperature_path)
+            values['log10D_m2s'] = isothermal['log10D_m2s'].value
+            errors['log10D_m2s'] = errors['log10D0_m2s']
+            values['time_seconds'] = isothermal['time_seconds'].value
+            errors['time_seconds'] = 0.
+        elif solver == 'crank-nicolson':
+            dict_fitting['initial_profile'] = initial_profile
+            dict_fitting['D_function'] = D_function
+            dict_fitting['timesteps'] = timesteps
+            result = lmfit.minimize(models.diffusion1D_numerical_params, 
+                                    params, args=(x, y), kws=dict_fitting)
+            params = getattr(result, 'params', params)
+            values = {}
+            errors = {}
+            for name in params:
+                values[name] = params[name].value
+                errors[name] = params[name].stderr
+        elif solver != 'analytical':
+            print("solver must be 'analytical' or 'crank-nicolson'")
+            return
+        elif method == 'least_squares':
+            values, errors = models.fit_diffusion1D(x, y, 
+                                                self.length_microns,
+                                                log10Dm2s, time_seconds,
+                                                init=init,
+                                                fin=final_unit_value,
+                                                vD=varyD, vinit=vary_initial,
+                                                vfin=vary_final, 
+                                                vTime=vary_time,
+                                                symmetric=symmetric,
+                                                erf_or_sum=erf_or_sum,
+                                                jacobian=jacobian)
+        elif method == 'lmfit':
+            dict_fitting['erf_or_sum'] = erf_or_sum
+            fit_kws = {}
+            # the analytical Jacobian is only for the erf solution
+            if (jacobian is True) and (erf_or_sum == 'erf'):
+                fit_kws['Dfun'] = models.diffusion1D_params_jacobian
+            result = lmfit.minimize(models.diffusion1D_params, params, 
+                                    args=(x, y), kws=dict_fitting, 
+                                    **fit_kws)
+            # newer versions of lmfit leave params alone and return new ones
+            params = getattr(result, 'params', params)
+            values = {}
+            errors = {}
+            for name in params:
+                values[name] = params[name].value
+                errors[name] = params[name].stderr
+        else:
+            print("method must be 'lmfit' or 'least_squares'")
+            return
+
+        for name in errors:
+            if errors[name] is None:
+                errors[name] = 0.
+        best_D = ufloat(values['log10D_m2s'], errors['log10D_m2s'])
+        best_init = ufloat(values['initial_unit_value'], 
+                           errors['initial_unit_value'])
+        best_final = ufloat(values['final_unit_value'], 
+                            errors['final_unit_value'])
+        best_time = ufloat(values['time_seconds'], errors['time_seconds'])
+        if temperature_path is not None:
+            self.fitD_arrhenius = {}
+            for name in ['Ea_kJmol', 'log10D0_m2s']:
+                self.fitD_arrhenius[name] = ufloat(values[name], errors[name])
+            print('Ea kJ/mol:', 
+                  '{:.1f}'.format(self.fitD_arrhenius['Ea_kJmol']))
+            print('log10D0 m2/s:', 
+                  '{:.2f}'.format(self.fitD_arrhenius['log10D0_m2s']))
 
         if wholeblock is True:
             if peak_idx is not None:
@@ -1466,6 +1819,21 @@ class Profile():
         return init, fin, D, minutes
 
 
+    def montecarlo_fitD(self, trials=1000, seed=None, **kwargs):
+        """
+        Monte Carlo uncertainties for the values from fitD: fits trials
+        randomly perturbed copies of the profile data. See
+        montecarlo.montecarlo_fitD for the errors that can be set and the
+        other keywords. The dictionary of results is returned and saved
+        as self.fitD_montecarlo.
+        """
+        results = montecarlo.montecarlo_fitD(self, trials=trials, seed=seed,
+                                             **kwargs)
+        if results is not None:
+            self.fitD_montecarlo = results
+        return results
+
+
     def save_diffusivities(self, folder=None, 
                            file_ending='-diffusivities.txt'):
         """Save diffusivities for profile to a file"""
@@ -1597,7 +1965,7 @@ class Profile():
                 if check is False:
                     return False
             # print 'Setting to zero at wn_matchup'
-            index = (np.abs(x.wn_full - wn_matchup)).argmin()
+            index = x.index_nearest(wn_matchup)
             abs_matched = (x.abs_full_cm - x.abs_full_cm[index]) + offset
             x.abs_full_cm = abs_matched
         return
@@ -1643,11 +2011,12 @@ class TimeSeries(Profile):
         ax.set_xlim(0, max_hours)
 
         # curves for diffusivities in D_list    
-        for D in D_list:
-             t, cc = models.diffusionThinSlab(log10D_m2s=D, 
+        if len(D_list) > 0:
+            t, ccs = models.diffusionThinSlab(log10D_m2s=list(D_list), 
                                         thickness_microns=thickness_microns, 
                                         max_time_hours=max_hours)
-             ax.plot(t, cc, '-k', linewidth=1)
+            for cc in ccs:
+                ax.plot(t, cc, '-k', linewidth=1)
     
         # plot area data
         x = self.times_hours
@@ -1691,8 +2060,8 @@ def subtract_2spectra(list2, wn_high=4000, wn_low=3000):
 
     # Set up wavenumber list for just the main spectrum 0
     x = list2[0]
-    index_lo = (np.abs(x.wn_full-wn_low)).argmin()
-    index_hi = (np.abs(x.wn_full-wn_high)).argmin()
+    index_lo = x.index_nearest(wn_low)
+    index_hi = x.index_nearest(wn_high)
     
     wn_upper_spectrum = x.wn_full[index_lo:index_hi]
     abs_upper_spectrum = x.abs_full_cm[index_lo:index_hi]
@@ -1701,7 +2070,7 @@ def subtract_2spectra(list2, wn_high=4000, wn_low=3000):
     idx = 0
     for wn in wn_upper_spectrum:
         # find index of nearest wavenumber in spectrum to be subtracted off
-        idx_subtract = (np.abs(list2[1].wn_full-wn)).argmin()
+        idx_subtract = list2[1].index_nearest(wn)
         # subtract
         abs_difference[idx] = (abs_upper_spectrum[idx] - 
                                 list2[1].abs_full_cm[idx_subtract])
@@ -9,6 +9,8 @@ but they both use functions stored here.
 from __future__ import print_function, division, absolute_import
 from uncertainties import ufloat
 import numpy as np
+from collections import OrderedDict
+from scipy.optimize import least_squares
 
 
 def absorption_coefficients(phase, calibration):
@@ -70,6 +72,179 @@ def make_gaussian(pos, h, w, x=np.linspace(3000, 4000, 150)):
     return y
 
 
+def make_gaussians(pos, h, w, x=np.linspace(3000, 4000, 150)):
+    """
+    Make and return many Gaussian curves at once, e.g., for all peaks in
+    all spectra of a profile or block.
+    
+    pos, h, and w are the peak positions, heights, and widths, which can
+    be single numbers or arrays of any shape that broadcast together, 
+    such as (number of spectra x number of peaks). The curves are 
+    evaluated over wavenumbers x, which is added as the last dimension, 
+    so the result has shape (number of spectra x number of peaks x len(x)).
+    Sum over the next-to-last axis to get the summed spectra.
+    """
+    pos = np.asarray(pos, dtype=float)[..., np.newaxis]
+    h = np.asarray(h, dtype=float)[..., np.newaxis]
+    w = np.asarray(w, dtype=float)[..., np.newaxis]
+    y = h * np.exp(-((x-pos) / (0.6005615*w))**2)
+    return y
+
+
+def gaussians_jacobian(pos, h, w, x):
+    """
+    Returns the Jacobian of the sum of Gaussian curves made by 
+    make_gaussians with respect to the peak positions, heights, and 
+    widths over wavenumbers x, as a 2D array with one row for each x and
+    columns in the order [positions, heights, widths].
+    """
+    pos = np.asarray(pos, dtype=float)[:, np.newaxis]
+    h = np.asarray(h, dtype=float)[:, np.newaxis]
+    w = np.asarray(w, dtype=float)[:, np.newaxis]
+    u = (x - pos) / (0.6005615*w)
+    g = np.exp(-u**2)
+    d_pos = h * g * 2. * u / (0.6005615*w)
+    d_h = g
+    d_w = h * g * 2. * u**2 / w
+    return np.vstack((d_pos, d_h, d_w)).T
+
+
+def fit_gaussians(x, y, pos, h, w, max_shift=None, 
+                  width_bounds=(1., 300.), height_bounds=(0., np.inf),
+                  tolerance=1e-6, max_nfev=None):
+    """
+    Fits the sum of Gaussian curves (see make_gaussian) to the curve
+    given by wavenumbers x and absorbances y by nonlinear least squares
+    with an analytic Jacobian.
+    
+    pos, h, and w are the starting peak positions, heights, and widths 
+    in cm-1. The best-fit values are kept within bounds:
+        positions stay within max_shift cm-1 of where they start 
+            (default None: anywhere between the first and last x)
+        widths are between width_bounds (default 1 to 300 cm-1)
+        heights are between height_bounds (default 0 to infinity)
+    
+    The fit stops when the relative change in the sum of squares or in the
+    peak values drops below tolerance (default 1e-6), which is plenty for
+    FTIR spectra and quick enough to refit whole blocks. Use a smaller 
+    tolerance for more precision, or set max_nfev to limit the number of 
+    function evaluations.
+    
+    Returns the best-fit positions, heights, and widths as arrays
+    and the full scipy.optimize.least_squares result, which includes 
+    the number of function evaluations (nfev), or 
+    None, None, None, None if the fit fails.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    pos = np.atleast_1d(np.asarray(pos, dtype=float))
+    h = np.atleast_1d(np.asarray(h, dtype=float))
+    w = np.atleast_1d(np.asarray(w, dtype=float))
+    npeaks = len(pos)
+    if (len(h) != npeaks) or (len(w) != npeaks):
+        print('Need the same number of peak positions, heights, and widths')
+        return None, None, None, None
+    if npeaks == 0:
+        print('No peaks to fit')
+        return None, None, None, None
+
+    if max_shift is None:
+        pos_low = np.ones(npeaks) * min(x[0], x[-1])
+        pos_high = np.ones(npeaks) * max(x[0], x[-1])
+    else:
+        pos_low = pos - max_shift
+        pos_high = pos + max_shift
+    lower = np.concatenate((pos_low, np.ones(npeaks) * height_bounds[0],
+                            np.ones(npeaks) * width_bounds[0]))
+    upper = np.concatenate((pos_high, np.ones(npeaks) * height_bounds[1],
+                            np.ones(npeaks) * width_bounds[1]))
+
+    # starting values have to be inside the bounds
+    start = np.concatenate((pos, h, w))
+    margin = 1e-6 * (1. + np.abs(start))
+    start = np.clip(start, lower + margin, upper - margin)
+    
+    def residuals(params):
+        model = np.sum(make_gaussians(params[:npeaks], 
+                                      params[npeaks:2*npeaks], 
+                                      params[2*npeaks:], x=x), axis=0)
+        return model - y
+
+    def jacobian(params):
+        return gaussians_jacobian(params[:npeaks], params[npeaks:2*npeaks],
+                                  params[2*npeaks:], x)
+
+    try:
+        result = least_squares(residuals, start, jac=jacobian, 
+                               bounds=(lower, upper), x_scale='jac',
+                               ftol=tolerance, xtol=tolerance,
+                               max_nfev=max_nfev)
+    except ValueError as err:
+        print('Problem fitting Gaussians:', err)
+        return None, None, None, None
+    
+    best = result.x
+    return best[:npeaks], best[npeaks:2*npeaks], best[2*npeaks:], result
+
+
+class WavenumberIndex():
+    """
+    Finds the index of the wavenumber closest to a given wavenumber in
+    an array of wavenumbers, wn_array, which is usually a Spectrum's 
+    wn_full or base_wn. The answer is the same as 
+        (np.abs(wn_array - wn)).argmin()
+    including for ties, but for wavenumbers sorted from low to high
+    it uses a binary search (np.searchsorted), and the most recent
+    answers are remembered (up to maxsize), so repeated lookups cost
+    almost nothing. Unsorted wavenumbers fall back on argmin.
+    """
+    def __init__(self, wn_array, maxsize=256):
+        self.wn_array = wn_array
+        self.maxsize = maxsize
+        self.lookups = OrderedDict()
+        wn = np.asarray(wn_array)
+        self.ascending = (wn.ndim == 1 and len(wn) > 0 and 
+                          bool(np.all(wn[1:] > wn[:-1])))
+
+
+    def find(self, wn):
+        """Returns the index closest to wavenumber wn without the cache"""
+        wn_array = np.asarray(self.wn_array)
+        if (self.ascending is False) or not np.isfinite(wn):
+            return int((np.abs(wn_array - wn)).argmin())
+        idx = int(np.searchsorted(wn_array, wn))
+        if idx == 0:
+            return 0
+        if idx == len(wn_array):
+            return idx - 1
+        if abs(wn_array[idx-1] - wn) <= abs(wn_array[idx] - wn):
+            return idx - 1
+        return idx
+
+
+    def __call__(self, wn):
+        """Returns the index closest to wavenumber wn"""
+        wn = float(wn)
+        try:
+            idx = self.lookups.pop(wn)
+        except KeyError:
+            idx = self.find(wn)
+            if len(self.lookups) >= self.maxsize:
+                self.lookups.popitem(last=False)
+        self.lookups[wn] = idx
+        return idx
+
+
+def index_nearest(wn_array, wn):
+    """
+    Returns the index of the wavenumber in wn_array closest to wn, 
+    the same as (np.abs(wn_array - wn)).argmin(). For many lookups in 
+    the same array, keep a WavenumberIndex for it instead, as Spectrum 
+    does (see Spectrum.index_nearest).
+    """
+    return int((np.abs(np.asarray(wn_array) - wn)).argmin())
+
+
 def make_peakheights(wb, peaks=[3600, 3525, 3356, 3236]):
     """
     Requires:
@@ -84,6 +259,6 @@ def make_peakheights(wb, peaks=[3600, 3525, 3356, 3236]):
         for pidx, peak in enumerate(peaks): 
             prof.peak_heights[pidx] = []
             for spec in prof.spectra:
-                idx = np.abs(peak - spec.base_wn).argmin()
+                idx = spec.index_nearest(peak, base=True)
                 height = spec.abs_nobase_cm[idx]
                 prof.peak_heights[pidx].append(height)
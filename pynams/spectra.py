@@ -21,6 +21,7 @@ import scipy.interpolate as interp
 import pandas as pd
 from uncertainties import ufloat
 from . import pynams
+from . import filecache
 from mpl_toolkits.axes_grid1.parasite_axes import SubplotHost
 import gc
 from scipy import signal as scipysignal
@@ -73,6 +74,14 @@ class Spectrum():
            by calling the bound method get_thickness_from_SiO():
                my_spectrum.get_thickness_from_SiO()
     
+    To skip reading the file, pass in a SpectraStore that already holds
+    the spectrum as store, and the wavenumbers and raw absorbances will
+    point into the store instead (see pynams.spectrastore).
+    
+    The numbers in the file are cached in binary form the first time
+    it is read and memory-mapped after that (see pynams.filecache).
+    Set cache=False to always read the text file.
+    
     The baseline is by default a line between wavenumbers 3200 cm-1 
     (base_low_wn) and 3700 (base_high_wn), and a quadratic baseline would
     deviate from that line relative to base_mid_wn in the middle. Those 
@@ -84,7 +93,7 @@ class Spectrum():
     def __init__(self, fname, filetype='.CSV', folder='', sample=None,
                  thickness_microns=None, raypath=None, polar=None, 
                  base_low_wn=3200, base_high_wn=3700,
-                 base_mid_wn=3550):
+                 base_mid_wn=3550, store=None, cache=True):
         """
         Automatically locates the FTIR file and pulls out the wavenumber 
         (wn_full) and raw absorbance data (abs_raw) and sets the 
@@ -106,36 +115,59 @@ class Spectrum():
         
         self.filename = self.folder + self.fname + self.filetype
 
-        if os.path.isfile(self.filename):
-            if self.filetype == '.CSV':
-                signal = pd.read_csv(self.filename, header=None)
-            elif self.filetype == '.txt':
-                try:
-                    signal = np.loadtxt(self.filename, delimiter='\t', 
-                                        dtype=None) 
-                except ValueError:
-                    print('\nProblem reading this file format. Try .CSV')
-            else:
-                print('For now only CSV and txt files work.')
-
-            signal = signal.sort_values(by=[0])
-            self.wn_full = np.array(signal[0])
-            self.abs_raw = np.array(signal[1])
-            
-            if thickness_microns is not None:
-                self.thickness_microns = thickness_microns
-            else:
-                if sample is not None:
-                    idx = styles.get_iorient(raypath)
-                    self.thickness_microns = sample.thickness_microns[idx]
-                else:
-                    self.thickness_microns = None
+        if (store is not None) and (self.filename in store):
+            self.wn_full, self.abs_raw = store.get_spectrum_data(self.filename)
+            self.wn_index = store.wn_index
+        elif os.path.isfile(self.filename):
+            signal = filecache.load(self.filename, read_spectrum_file, 
+                                    use_cache=cache)
+            if signal is None:
+                return
+            self.wn_full = signal[0]
+            self.abs_raw = signal[1]
         else:
             print('There is a problem finding the file.')
             print('filename =', self.filename)
             print('Maybe check the folder name')
+            return
+            
+        if thickness_microns is not None:
+            self.thickness_microns = thickness_microns
+        else:
+            if sample is not None:
+                idx = styles.get_iorient(raypath)
+                self.thickness_microns = sample.thickness_microns[idx]
+            else:
+                self.thickness_microns = None
             
 
+    def index_nearest(self, wn, base=False):
+        """
+        Returns the index of the wavenumber closest to wn in wn_full, or 
+        in base_wn if base=True, the same as 
+        (np.abs(self.wn_full - wn)).argmin().
+        
+        The WavenumberIndex for each array is made the first time and 
+        kept as self.wn_index or self.base_wn_index until a different 
+        array is assigned to wn_full or base_wn. Spectra that use a 
+        SpectraStore share the store's wn_index. Assign a new array 
+        instead of changing wn_full or base_wn in place.
+        """
+        if base is True:
+            wn_array = self.base_wn
+            index = getattr(self, 'base_wn_index', None)
+        else:
+            wn_array = self.wn_full
+            index = getattr(self, 'wn_index', None)
+        if (index is None) or (index.wn_array is not wn_array):
+            index = pynams.WavenumberIndex(wn_array)
+            if base is True:
+                self.base_wn_index = index
+            else:
+                self.wn_index = index
+        return index(wn)
+
+
     def plot_spectrum(self, axes=None, style=None, offset=0., 
                       label=None, wn_xlim_left=4000., wn_xlim_right=3000., 
                       pad_top=0.1, pad_bot=0., plot_raw=False):
@@ -261,8 +293,8 @@ class Spectrum():
                            wn_xlim_right=wn_low, plot_raw=True)
         
         # zoom in on Si overtone areas
-        index_lo = (np.abs(self.wn_full-wn_low)).argmin()
-        index_hi = (np.abs(self.wn_full-wn_high)).argmin()        
+        index_lo = self.index_nearest(wn_low)
+        index_hi = self.index_nearest(wn_high)        
         SiO = self.abs_raw[index_lo:index_hi]
         ax1.set_ylim(min(SiO), max(SiO)+0.2*max(SiO))
         
@@ -308,8 +340,8 @@ class Spectrum():
         wn_high = 2150
 
         # indices for absorbance of interest
-        index_lo = (np.abs(self.wn_full-wn_low)).argmin()
-        index_hi = (np.abs(self.wn_full-wn_high)).argmin()        
+        index_lo = self.index_nearest(wn_low)
+        index_hi = self.index_nearest(wn_high)        
 
         # raw absorbance over Si-O overtones
         SiO_overtones = self.abs_raw[index_lo:index_hi]
@@ -346,8 +378,8 @@ class Spectrum():
         ## find minimum relative to a linear baseline
         if relative is True:            
             self.make_baseline(linetype='line', show_plot=False)
-            idx_mid_high = (np.abs(self.base_wn-wn_mid_range_high)).argmin()
-            idx_mid_low = (np.abs(self.base_wn-wn_mid_range_low)).argmin()
+            idx_mid_high = self.index_nearest(wn_mid_range_high, base=True)
+            idx_mid_low = self.index_nearest(wn_mid_range_low, base=True)
             if idx_mid_high == idx_mid_low:
                 print('basenumber range not established. Check wavenumber range')
                 return False
@@ -361,8 +393,8 @@ class Spectrum():
 
         else:        
             ## finds absolute minimum over range
-            idx_mid_high = (np.abs(self.wn_full-wn_mid_range_high)).argmin()
-            idx_mid_low = (np.abs(self.wn_full-wn_mid_range_low)).argmin()
+            idx_mid_high = self.index_nearest(wn_mid_range_high)
+            idx_mid_low = self.index_nearest(wn_mid_range_low)
             mid_abs_range = self.abs_full_cm[idx_mid_low:idx_mid_high]
             mid_wn_range = self.wn_full[idx_mid_low:idx_mid_high]
             idx_abs_mid = mid_abs_range.argmin()
@@ -410,9 +442,9 @@ class Spectrum():
         self.peakpos = peaks
         self.peak_heights = []
         for peak in (peaks):
-            idx = np.abs(peak - self.base_wn).argmin()
+            idx = self.index_nearest(peak, base=True)
             height_base = self.base_abs[idx]
-            idx = np.abs(peak - self.wn_full).argmin()
+            idx = self.index_nearest(peak)
             height_abs = self.abs_full_cm[idx]                        
             height = height_abs - height_base
             self.peak_heights.append(height)
@@ -469,8 +501,8 @@ class Spectrum():
         shift minimum to 0 within specified wavenumber range specified
         by wn_xlim_left and _right
         """
-        index_lo = (np.abs(self.wn_full-wn_xlim_right)).argmin()
-        index_hi = (np.abs(self.wn_full-wn_xlim_left)).argmin()
+        index_lo = self.index_nearest(wn_xlim_right)
+        index_hi = self.index_nearest(wn_xlim_left)
         indices = list(range(index_lo, index_hi, 1))
 
         try: 
@@ -564,8 +596,8 @@ class Spectrum():
                     return
         
         # get wavenumber range
-        index_lo = (np.abs(self.wn_full-wn_low)).argmin()
-        index_hi = (np.abs(self.wn_full-wn_high)).argmin()        
+        index_lo = self.index_nearest(wn_low)
+        index_hi = self.index_nearest(wn_high)        
         base_wn = self.wn_full[index_lo:index_hi]
 
         # Smear start and stop over a range of wavenumbers
@@ -618,14 +650,14 @@ class Spectrum():
                     xadd = []
                     yadd = []
                     for forcewn in force_through_wn:
-                        index_mid = (np.abs(self.wn_full - forcewn)).argmin()
+                        index_mid = self.index_nearest(forcewn)
                         abs_at_wn_mid = absorbance[index_mid]
                         xadd.append(forcewn)
                         yadd.append(abs_at_wn_mid)
                 else:                        
                     try:
                         forcewn = force_through_wn
-                        index_mid = (np.abs(self.wn_full - forcewn)).argmin()
+                        index_mid = self.index_nearest(forcewn)
                         abs_at_wn_mid = absorbance[index_mid]
                         xadd = force_through_wn
                         yadd = abs_at_wn_mid                    
@@ -652,8 +684,8 @@ class Spectrum():
 
         # make a spline
         elif linetype == 'spline':
-            idx_max = (np.abs(self.wn_full - spline_wn_high)).argmin()
-            idx_min = (np.abs(self.wn_full - spline_wn_low)).argmin()
+            idx_max = self.index_nearest(spline_wn_high)
+            idx_min = self.index_nearest(spline_wn_low)
             xinterp = np.concatenate((self.wn_full[idx_min:index_lo], 
                                       self.wn_full[index_hi:idx_max]))
             yinterp = np.concatenate((absorbance[idx_min:index_lo], 
@@ -741,8 +773,8 @@ class Spectrum():
         if wn_high is None:
             wn_high = min(self.base_wn)
             
-        index_lo = (np.abs(self.wn_full-wn_low)).argmin()
-        index_hi = (np.abs(self.wn_full-wn_high)).argmin()
+        index_lo = self.index_nearest(wn_low)
+        index_hi = self.index_nearest(wn_high)
 
         absorbance = self.absorbance_picker()
         if index_lo < index_hi:
@@ -770,7 +802,7 @@ class Spectrum():
 
     def make_area(self, show_plot=False, raw_data=False,
                              printout=True, numformat='{:.1f}', 
-                             wn_high=None, wn_low=None):
+                             wn_high=None, wn_low=None, method='mean'):
         """
         Returns area under the curve in cm^2 between wavenumbers given
         by wn_high and wn_low.
@@ -778,6 +810,11 @@ class Spectrum():
         If wn_high and wn_low are not set, they are assumed to be equal to 
         the full range of the baseline.
         
+        The default method='mean' multiplies the wavenumber range by the
+        mean baseline-subtracted absorbance. Set method='trapezoid' or 
+        'simpson' to integrate with the trapezoidal rule or Simpson's 
+        rule instead. See AreaIntegrator.
+        
         If raw_data is set to True, the area will be determined for the raw
         data. The default is to determine the thickness-normalized area.
         
@@ -792,13 +829,15 @@ class Spectrum():
             wn_high = self.base_high_wn
         if wn_low is None:
             wn_low = self.base_low_wn            
-        dx = wn_high - wn_low
 
-        idx_high = (np.abs(self.base_wn-wn_high)).argmin()
-        idx_low = (np.abs(self.base_wn-wn_low)).argmin()
-        dy = np.mean(self.abs_nobase_cm[idx_low:idx_high])
-        
-        area = dx * dy
+        idx_high = self.index_nearest(wn_high, base=True)
+        idx_low = self.index_nearest(wn_low, base=True)
+        integrator = AreaIntegrator(self.base_wn, self.abs_nobase_cm)
+        area = integrator.area(wn_low=wn_low, wn_high=wn_high, 
+                               method=method)
+        if area is None:
+            return
+        area = area[0]
         self.area = area
         
         if printout is True:
@@ -933,7 +972,7 @@ class Spectrum():
 
     def get_baseline(self, folder=None, delim=',', 
                      baseline_ending='-baseline.CSV',
-                     print_confirmation=True):
+                     print_confirmation=True, cache=True):
         """
         Get baseline saved using save_baseline().
         
@@ -945,6 +984,8 @@ class Spectrum():
         
         Set print_confirmation=False to suppress printout when file
         successfully retrieved
+        
+        Set cache=False to skip the binary cache (see pynams.filecache)
         """
         if folder is None:
             folder = self.folder
@@ -955,16 +996,15 @@ class Spectrum():
             print('Probably you need to specify the folder.')
         if os.path.isfile(filename) is False:
             return
-        data = pd.read_csv(filename)
+        data = filecache.load(filename, read_baseline_file, use_cache=cache)
 
         if print_confirmation is True:
             print('Got baseline ', filename)
-        columns = data.columns
-        self.base_wn = data[columns[0]]
-        self.base_abs = data[columns[1]]
-        self.abs_nobase_cm = data[columns[2]]
-        self.base_high_wn = np.max(data[columns[0]])
-        self.base_low_wn = np.min(data[columns[0]])
+        self.base_wn = data[0]
+        self.base_abs = data[1]
+        self.abs_nobase_cm = data[2]
+        self.base_high_wn = np.max(data[0])
+        self.base_low_wn = np.min(data[0])
         return self.base_abs, self.abs_nobase_cm
         
     
@@ -986,7 +1026,8 @@ class Spectrum():
     
     def make_peakfit(self, sensitivity=40, peak_positions=None,
                      peak_heights=None, peak_widths=None,
-                     show_plot=True):
+                     show_plot=True, fit=True, max_shift=None, 
+                     width_bounds=(1., 300.), height_bounds=(0., np.inf)):
         """
         Fiddle with the peakfits by passing in peak_positions in as a list of
         wavenmbers in cm-1 and/or peak_heights as a list of baseline-subtracted
@@ -998,9 +1039,19 @@ class Spectrum():
         for all peaks, and take the height as the absorbance at each peak
         position.
         
+        If fit is True (default), those values are then used as the starting
+        point for a least-squares fit of the Gaussian peaks to the 
+        baseline-subtracted absorbance using pynams.fit_gaussians. 
+        max_shift, width_bounds, and height_bounds set limits on the fit 
+        as described there. The full fit result is stored as peakfit_result,
+        which is None if the fit fails or there is no fit.
+        Set fit=False to use the values as they are.
+        
         If show_plot is True (default), it runs spectrum.plot_showpeakfit()
         and returns the figure and axes handles
         """
+        # only results from fits made in this call
+        self.peakfit_result = None
         self.subtract_baseline()
         if self.abs_nobase_cm is None:
             return
@@ -1021,12 +1072,30 @@ class Spectrum():
         if peak_heights is None:                                           
             self.peak_heights = np.ones_like(self.peakpos)
             for idx, wn in enumerate(self.peakpos):
-                idx_peak = (np.abs(self.base_wn-wn)).argmin()
+                idx_peak = self.index_nearest(wn, base=True)
                 self.peak_heights[idx] = self.abs_nobase_cm[idx_peak]
             print('heights:', self.peak_heights)
         else:
             self.peak_heights = [float(i) for i in peak_heights]
         
+        if fit is True:
+            pos, heights, widths, result = pynams.fit_gaussians(self.base_wn,
+                                                self.abs_nobase_cm,
+                                                self.peakpos, 
+                                                self.peak_heights,
+                                                self.peak_widths,
+                                                max_shift=max_shift,
+                                                width_bounds=width_bounds,
+                                                height_bounds=height_bounds)
+            if pos is None:
+                print('Peak fit failed for', self.fname, 
+                      '- keeping the starting values')
+            else:
+                self.peakpos = pos
+                self.peak_heights = heights
+                self.peak_widths = widths
+                self.peakfit_result = result
+        
         self.numPeaks = len(self.peakpos)
         self.make_peakareas()
         
@@ -1054,11 +1123,23 @@ class Spectrum():
         print('Saved', filename)
 
 
-    def make_peakfit_like(self, spectrum):
+    def make_peakfit_like(self, spectrum, fit=False, **kwargs):
         """
         Takes another spectrum and sets this spectrum's peakfit information
         equal to that of that of the other spectrum. 
+        
+        If fit is True, the other spectrum's peakfit is instead used as the
+        starting point for fitting this spectrum with make_peakfit. Other 
+        keywords are passed on to make_peakfit.
         """
+        if fit is True:
+            kwargs.setdefault('show_plot', False)
+            return self.make_peakfit(peak_positions=spectrum.peakpos,
+                                     peak_heights=spectrum.peak_heights,
+                                     peak_widths=spectrum.peak_widths,
+                                     **kwargs)
+
+        self.peakfit_result = None
         self.subtract_baseline()
         self.peakpos = spectrum.peakpos
         self.peak_heights = spectrum.peak_heights
@@ -1068,7 +1149,7 @@ class Spectrum():
 
 
     def get_peakfit(self, folder=None, delim=',', 
-                    peak_ending='-peakfit.CSV'):
+                    peak_ending='-peakfit.CSV', cache=True):
         """
         Get individual peaks for spectrum from peakfit file, 
         typically fname-peakfit.CSV, but the peak_ending 
@@ -1076,24 +1157,20 @@ class Spectrum():
         
         Data is stored in attributes peak_heights, peak_widths, and
         peak_areas
+        
+        Set cache=False to skip the binary cache (see pynams.filecache)
         """
         if folder is None:
             folder = self.folder
         filename = folder + self.fname + peak_ending
         if os.path.isfile(filename) is True:
-            previous_fit = pd.read_csv(filename)
-            
-            # older version peakfit files don't have headings
-            if len(list(previous_fit)[0]) < 20:
-                previous_fit = pd.read_csv(filename, header=None)
-            
-            headers = list(previous_fit)
-            previous_fit = previous_fit.sort_values(by=[headers[0]])
-            self.peakpos = np.array(previous_fit[headers[0]])
+            previous_fit = filecache.load(filename, read_peakfit_file,
+                                          use_cache=cache)
+            self.peakpos = previous_fit[0]
             self.numPeaks = len(self.peakpos)
-            self.peak_heights = np.array(previous_fit[headers[1]])
-            self.peak_widths = np.array(previous_fit[headers[2]])
-            self.peak_areas = np.array(previous_fit[headers[3]])
+            self.peak_heights = previous_fit[1]
+            self.peak_widths = previous_fit[2]
+            self.peak_areas = previous_fit[3]
             print('Got peak info from', filename)
         else:
             print(' ')            
@@ -1117,19 +1194,16 @@ class Spectrum():
             return False, False
         
         try:
-            peakfitcurves = np.ones([len(peakpos), len(self.base_wn)])
+            base_wn = self.base_wn
         except AttributeError:
             print('Make or get a baseline before getting peakfit')
             return False, False
             
-        summed_spectrum = np.zeros_like(self.base_wn)
-        for k in range(len(self.peakpos)):
-            peakfitcurves[k] = pynams.make_gaussian(x=self.base_wn, 
-                                                pos=self.peakpos[k],
-                                                h=self.peak_heights[k], 
-                                                w=self.peak_widths[k])
-
-            summed_spectrum += peakfitcurves[k]
+        peakfitcurves = pynams.make_gaussians(x=base_wn, pos=peakpos,
+                                              h=self.peak_heights, 
+                                              w=self.peak_widths)
+        peakfitcurves = peakfitcurves.reshape(len(peakpos), len(base_wn))
+        summed_spectrum = np.sum(peakfitcurves, axis=0)
         return peakfitcurves, summed_spectrum
 
 
@@ -1144,10 +1218,7 @@ class Spectrum():
             return
         else:
             dx = self.base_high_wn - self.base_low_wn
-            peak_areas = []
-            for curve in peakfitcurves:
-                peak_areas.append(dx * np.mean(curve))
-            self.peak_areas = peak_areas
+            self.peak_areas = list(dx * np.mean(peakfitcurves, axis=1))
 #            print('# of curves', len(peakfitcurves))
 #            print('# of peaks', len(self.peakpos))
             
@@ -1244,7 +1315,7 @@ class Spectrum():
             if check is False:
                 return False
 
-        idx = (np.abs(self.wn_full-wn)).argmin()
+        idx = self.index_nearest(wn)
                 
         if absorbance == 'thickness normalized':
             if self.abs_full_cm is None:
@@ -1451,6 +1522,516 @@ class Spectrum():
         return fig, ax
 
 
+def stack_absorbances(spectra, raw_data=False):
+    """
+    Takes a list of spectra and returns their shared wavenumbers and a 
+    2D array of their absorbances, one row per spectrum, either raw 
+    (raw_data=True) or thickness-normalized and offset to start at zero.
+    
+    Returns None, None if the spectra do not all have the same
+    wavenumbers or if any thickness-normalized absorbances are missing.
+    """
+    if len(spectra) == 0:
+        return None, None
+    wn_full = spectra[0].wn_full
+    absorbances = []
+    for spec in spectra:
+        if (len(spec.wn_full) != len(wn_full) or 
+            np.allclose(spec.wn_full, wn_full) is False):
+            return None, None
+        if raw_data is True:
+            absorbances.append(spec.abs_raw)
+        else:
+            try:
+                absorbances.append(spec.abs_full_cm)
+            except AttributeError:
+                spec.start_at_zero()
+                try:
+                    absorbances.append(spec.abs_full_cm)
+                except AttributeError:
+                    return None, None
+    return wn_full, np.vstack(absorbances)
+
+
+def stack_baselines(wn_full, absorbances, 
+                    wn_low=3200, 
+                    wn_high=3700, 
+                    wn_mid=3550,
+                    linetype='line', 
+                    curvature=None, 
+                    force_through_wn=None,
+                    polynomial_order=None,
+                    abs_high=None, 
+                    abs_low=None,
+                    abs_smear_high=0, 
+                    abs_smear_low=0):
+    """
+    Makes line or polynomial baselines for a whole stack of spectra
+    that share the same wavenumbers.
+    
+    Takes the shared wavenumbers wn_full and a 2D array of absorbances 
+    with one row per spectrum. The other keywords are the same as for
+    Spectrum.make_baseline (except splines, which are not included).
+    
+    Every spectrum is fit through the same wavenumbers, so there is only
+    one design matrix, and all of the baselines come out of a single
+    least squares solve with one right-hand side per spectrum.
+    
+    Returns the baseline wavenumbers and a 2D array of baselines, one 
+    row per spectrum.
+    """
+    absorbances = np.atleast_2d(absorbances)
+    index_lo = pynams.index_nearest(wn_full, wn_low)
+    index_hi = pynams.index_nearest(wn_full, wn_high)
+    base_wn = wn_full[index_lo:index_hi]
+
+    # Smear start and stop over a range of wavenumbers
+    abs_smear_high = int(abs_smear_high)
+    abs_smear_low = int(abs_smear_low)
+    if abs_high is not None:
+        yhigh = np.ones(len(absorbances)) * abs_high
+    elif abs_smear_high > 0:
+        gulp_hi_x = list(range(index_hi-abs_smear_high, 
+                               index_hi+abs_smear_high))
+        yhigh = np.mean(absorbances[:, gulp_hi_x], axis=1)
+    else:
+        yhigh = absorbances[:, index_hi]
+    if abs_low is not None:
+        ylow = np.ones(len(absorbances)) * abs_low
+    elif abs_smear_low > 0:
+        gulp_lo_x = list(range(index_lo-abs_smear_low, 
+                               index_lo+abs_smear_low))
+        ylow = np.mean(absorbances[:, gulp_lo_x], axis=1)
+    else:
+        ylow = absorbances[:, index_lo]
+
+    # start with a line
+    x = [wn_full[index_hi], wn_full[index_lo]]
+    y = [yhigh, ylow]
+    order = 1
+
+    if curvature is not None or force_through_wn is not None:
+        linetype = 'polynomial'
+
+    if linetype == 'polynomial':
+        # add in extra points to fit through
+        if force_through_wn is not None:
+            force_list = np.atleast_1d(force_through_wn)
+            for forcewn in force_list[::-1]:
+                index_mid = pynams.index_nearest(wn_full, forcewn)
+                x.insert(1, forcewn)
+                y.insert(1, absorbances[:, index_mid])
+        elif curvature is not None:
+            slope = (yhigh - ylow) / (x[0] - x[-1])
+            yline = ylow + slope * (wn_mid - x[-1])
+            x.insert(1, wn_mid)
+            y.insert(1, yline - curvature)
+        if polynomial_order is None:
+            polynomial_order = 2
+        order = polynomial_order
+    elif linetype != 'line':
+        print("linetype must be 'line' or 'polynomial' for stacks")
+        return None, None
+
+    # shift and scale wavenumbers to keep the design matrix well behaved
+    x = np.array(x, dtype=float)
+    center = np.mean(x)
+    width = np.max(np.abs(x - center))
+    if width == 0:
+        width = 1.
+    design = np.vander((x - center) / width, order + 1)
+    coefficients = np.linalg.lstsq(design, np.vstack(y), rcond=None)[0]
+    base_design = np.vander((base_wn - center) / width, order + 1)
+    base_abs = np.dot(base_design, coefficients).T
+    return base_wn, base_abs
+
+
+def make_baselines(spectra, 
+                   raw_data=False, 
+                   wn_low=3200, 
+                   wn_high=3700, 
+                   wn_mid=3550,
+                   linetype='line', 
+                   curvature=None, 
+                   force_through_wn=None,
+                   polynomial_order=None,
+                   abs_high=None, 
+                   abs_low=None,
+                   abs_smear_high=0, 
+                   abs_smear_low=0,
+                   store_baseline=True):
+    """
+    Makes line or polynomial baselines for a list of spectra all at once
+    using stack_baselines. Keywords are the same as for 
+    Spectrum.make_baseline. 
+    
+    If store_baseline is True (default), each spectrum's baseline 
+    attributes are set just as they are by Spectrum.make_baseline.
+    
+    Returns the baseline wavenumbers and a 2D array of baselines, one row
+    per spectrum, or None, None if the spectra could not be handled 
+    together because they have different wavenumbers or no thickness.
+    """
+    wn_full, absorbances = stack_absorbances(spectra, raw_data=raw_data)
+    if absorbances is None:
+        return None, None
+    base_wn, base_abs = stack_baselines(wn_full, absorbances, 
+                                        wn_low=wn_low, wn_high=wn_high,
+                                        wn_mid=wn_mid, linetype=linetype,
+                                        curvature=curvature,
+                                        force_through_wn=force_through_wn,
+                                        polynomial_order=polynomial_order,
+                                        abs_high=abs_high, abs_low=abs_low,
+                                        abs_smear_high=abs_smear_high,
+                                        abs_smear_low=abs_smear_low)
+    if base_abs is None:
+        return None, None
+
+    if store_baseline is True:
+        for spec, bline in zip(spectra, base_abs):
+            spec.base_mid_wn = wn_mid
+            spec.base_high_wn = wn_high
+            spec.base_low_wn = wn_low
+            spec.base_abs = bline
+            spec.base_wn = base_wn
+    return base_wn, base_abs
+
+
+def vstack_baselines(baselines):
+    """
+    Returns a list of baselines as a 2D array with one row per baseline,
+    or None if any of them is missing or they have different lengths.
+    """
+    if (len(baselines) == 0) or any(bline is None for bline in baselines):
+        return None
+    if len(set(len(bline) for bline in baselines)) > 1:
+        return None
+    return np.vstack(baselines)
+
+
+class AreaIntegrator():
+    """
+    Areas under the curve for many baseline-subtracted spectra at once.
+    
+    Takes the wavenumbers wn (usually base_wn) and a 2D array of 
+    baseline-subtracted absorbances with one row per spectrum (a 1D array
+    is treated as a single spectrum). Running sums along each spectrum
+    are made once in a single vectorized pass, so after that the areas of
+    all spectra over any wavenumber range can be found from the 
+    difference between two columns without going back over the data.
+    
+    Use the area method to get the areas, e.g., 
+        integrator = AreaIntegrator(wn, absorbances)
+        bulk_areas = integrator.area()
+        peak_areas = integrator.area(wn_low=3500, wn_high=3550)
+    
+    Simpson's rule assumes evenly spaced wavenumbers, which is normal 
+    for FTIR spectra.
+    """
+    def __init__(self, wn, absorbances):
+        self.wn = np.asarray(wn, dtype=float)
+        self.wn_index = pynams.WavenumberIndex(self.wn)
+        self.absorbances = np.atleast_2d(np.asarray(absorbances, 
+                                                    dtype=float))
+        y = self.absorbances
+        zeros = np.zeros((len(y), 1))
+
+        # sums of absorbances before each index
+        self.sums = np.hstack((zeros, np.cumsum(y, axis=1)))
+        evens = y.copy()
+        evens[:, 1::2] = 0.
+        self.even_sums = np.hstack((zeros, np.cumsum(evens, axis=1)))
+        self.odd_sums = self.sums - self.even_sums
+
+        # trapezoidal areas from the first wavenumber up to each index
+        steps = np.diff(self.wn) * (y[:, 1:] + y[:, :-1]) / 2.
+        self.trapezoids = np.hstack((zeros, np.cumsum(steps, axis=1)))
+
+
+    def get_indices(self, wn_low, wn_high):
+        """
+        Returns arrays of indices into wn closest to wn_low and wn_high,
+        which can be single numbers or one for each spectrum. The
+        defaults (None) are the first and last wavenumbers.
+        """
+        nspectra = len(self.absorbances)
+        if wn_low is None:
+            wn_low = self.wn[0]
+        if wn_high is None:
+            wn_high = self.wn[-1]
+        wn_low = np.ones(nspectra) * wn_low
+        wn_high = np.ones(nspectra) * wn_high
+        idx_low = np.array([self.wn_index(wn) 
+                            for wn in wn_low], dtype=int)
+        idx_high = np.array([self.wn_index(wn) 
+                             for wn in wn_high], dtype=int)
+        return idx_low, idx_high, wn_low, wn_high
+
+
+    def parity_sum(self, start, stop, parity):
+        """
+        Returns sums of absorbances with index from start up to but not
+        including stop that are even (parity=0) or odd (parity=1)
+        """
+        rows = np.arange(len(self.absorbances))
+        evens = (self.even_sums[rows, stop] - self.even_sums[rows, start])
+        odds = (self.odd_sums[rows, stop] - self.odd_sums[rows, start])
+        return np.where(parity == 0, evens, odds)
+
+
+    def simpson(self, idx_a, idx_b):
+        """
+        Returns Simpson's rule areas between indices idx_a and idx_b
+        (idx_a <= idx_b). For an odd number of intervals, the last
+        interval is added using the trapezoidal rule.
+        """
+        rows = np.arange(len(self.absorbances))
+        y = self.absorbances
+        nintervals = idx_b - idx_a
+        idx_c = idx_b - (nintervals % 2)
+        width = (self.wn[idx_c] - self.wn[idx_a]) / np.maximum(idx_c - idx_a, 
+                                                              1)
+        odd_part = self.parity_sum(idx_a + 1, np.maximum(idx_c, idx_a + 1),
+                                   (idx_a + 1) % 2)
+        even_part = self.parity_sum(idx_a + 1, np.maximum(idx_c, idx_a + 1),
+                                    idx_a % 2)
+        areas = (width / 3.) * (y[rows, idx_a] + y[rows, idx_c] + 
+                                4. * odd_part + 2. * even_part)
+        areas = np.where(idx_c > idx_a, areas, 0.)
+        last = (self.trapezoids[rows, idx_b] - self.trapezoids[rows, idx_c])
+        return areas + last
+
+
+    def area(self, wn_low=None, wn_high=None, method='trapezoid'):
+        """
+        Returns an array of the areas under the curve in cm^2 between 
+        wavenumbers wn_low and wn_high for all spectra. wn_low and wn_high
+        can be single numbers or arrays with one for each spectrum.
+        
+        method can be:
+            'trapezoid' (default) for the trapezoidal rule
+            'simpson' for Simpson's rule
+            'mean' for the wavenumber range (wn_high - wn_low) times the 
+                mean absorbance from the index of wn_low up to but not 
+                including the index of wn_high, as in Spectrum.make_area
+        """
+        idx_low, idx_high, wn_low, wn_high = self.get_indices(wn_low, 
+                                                              wn_high)
+        rows = np.arange(len(self.absorbances))
+
+        if method == 'mean':
+            npoints = idx_high - idx_low
+            with np.errstate(invalid='ignore', divide='ignore'):
+                dy = ((self.sums[rows, idx_high] - self.sums[rows, idx_low]) / 
+                      npoints)
+            dy = np.where(npoints > 0, dy, np.nan)
+            return (wn_high - wn_low) * dy
+
+        elif method == 'trapezoid':
+            return (self.trapezoids[rows, idx_high] - 
+                    self.trapezoids[rows, idx_low])
+
+        elif method == 'simpson':
+            idx_a = np.minimum(idx_low, idx_high)
+            idx_b = np.maximum(idx_low, idx_high)
+            sign = np.where(idx_high >= idx_low, 1., -1.)
+            return sign * self.simpson(idx_a, idx_b)
+
+        else:
+            print("method must be 'trapezoid', 'simpson', or 'mean'")
+            return
+
+
+def stack_subtract_baselines(spectra, store_nobase=True):
+    """
+    Subtracts the existing baselines from a list of spectra that all
+    have the same wavenumbers and baseline wavenumbers in one step.
+    Works like Spectrum.subtract_baseline with the default keywords.
+    
+    If store_nobase is True (default), each spectrum's abs_nobase_cm
+    is set to its row of the result.
+    
+    Returns the shared baseline wavenumbers and a 2D array of 
+    baseline-subtracted absorbances, one row per spectrum, or None, None 
+    if the spectra can't be handled together.
+    """
+    if len(spectra) == 0:
+        return None, None
+    try:
+        wn_full = spectra[0].wn_full
+        base_wn = spectra[0].base_wn
+        for spec in spectra:
+            if ((len(spec.wn_full) != len(wn_full)) or 
+                (len(spec.base_wn) != len(base_wn)) or
+                (len(spec.base_abs) != len(base_wn)) or
+                (np.allclose(spec.wn_full, wn_full) is False) or
+                (np.allclose(spec.base_wn, base_wn) is False)):
+                return None, None
+    except AttributeError:
+        return None, None
+    
+    absorbances = np.vstack([spec.absorbance_picker() for spec in spectra])
+    base_abs = np.vstack([spec.base_abs for spec in spectra])
+
+    index_lo = spectra[0].index_nearest(np.max(base_wn))
+    index_hi = spectra[0].index_nearest(min(base_wn))
+    if index_lo < index_hi:
+        humps = absorbances[:, index_lo:index_hi]
+    else:
+        humps = absorbances[:, index_hi:index_lo]
+
+    # lengths sometimes don't match up exactly because of rounding
+    if humps.shape[1] > len(base_wn):
+        humps = humps[:, 0:len(base_wn)]
+    elif humps.shape[1] < len(base_wn):
+        ndif = len(base_wn) - humps.shape[1]
+        humps = np.hstack([humps] + [humps[:, -1:]]*ndif)
+
+    abs_nobase = humps - base_abs
+    if store_nobase is True:
+        for spec, row in zip(spectra, abs_nobase):
+            spec.abs_nobase_cm = row
+    return base_wn, abs_nobase
+
+
+def make_areas(spectra, wn_low=None, wn_high=None, method='mean'):
+    """
+    Makes the areas under the curve for a list of spectra that have
+    baselines and share the same wavenumbers all at once using 
+    stack_subtract_baselines and AreaIntegrator. Keywords are the same 
+    as for Spectrum.make_area, and each spectrum's area attribute is set.
+    
+    Returns an array of the areas and the AreaIntegrator, which can be used 
+    to get areas over other wavenumber ranges, or None, None if the
+    spectra can't be handled together.
+    """
+    base_wn, abs_nobase = stack_subtract_baselines(spectra)
+    if abs_nobase is None:
+        return None, None
+
+    if wn_high is None:
+        wn_high = [spec.base_high_wn for spec in spectra]
+    if wn_low is None:
+        wn_low = [spec.base_low_wn for spec in spectra]
+    
+    integrator = AreaIntegrator(base_wn, abs_nobase)
+    areas = integrator.area(wn_low=wn_low, wn_high=wn_high, method=method)
+    if areas is None:
+        return None, None
+    for spec, area in zip(spectra, areas):
+        spec.area = area
+    return areas, integrator
+
+
+def stack_peaks(spectra):
+    """
+    Takes a list of spectra that all have the same number of peaks and
+    returns 2D arrays (number of spectra x number of peaks) of their peak 
+    positions, heights, and widths, or None, None, None if the 
+    spectra don't have peak information or have different numbers of peaks.
+    """
+    try:
+        peakpos = np.array([spec.peakpos for spec in spectra], dtype=float)
+        heights = np.array([spec.peak_heights for spec in spectra], 
+                           dtype=float)
+        widths = np.array([spec.peak_widths for spec in spectra], 
+                          dtype=float)
+    except (AttributeError, ValueError, TypeError):
+        return None, None, None
+    if peakpos.ndim != 2 or heights.shape != peakpos.shape or (
+        widths.shape != peakpos.shape):
+        return None, None, None
+    return peakpos, heights, widths
+
+
+def make_peakareas(spectra):
+    """
+    Makes the Gaussian peak areas for a list of spectra all at once and
+    stores them in each spectrum's peak_areas, just like 
+    Spectrum.make_peakareas. All of the Gaussian curves are made in 
+    a single call to pynams.make_gaussians, so the spectra must all have 
+    the same baseline wavenumbers and number of peaks. Otherwise the 
+    peak areas are made one spectrum at a time.
+    
+    Returns a 2D array of peak areas (number of spectra x number of peaks)
+    """
+    peakpos, heights, widths = stack_peaks(spectra)
+    shared = peakpos is not None
+    if shared is True:
+        try:
+            base_wn = spectra[0].base_wn
+            for spec in spectra:
+                if ((len(spec.base_wn) != len(base_wn)) or
+                    (np.allclose(spec.base_wn, base_wn) is False)):
+                    shared = False
+                    break
+        except AttributeError:
+            shared = False
+
+    if shared is False:
+        for spec in spectra:
+            spec.make_peakareas()
+        try:
+            return np.array([spec.peak_areas for spec in spectra], 
+                            dtype=float)
+        except (AttributeError, ValueError):
+            return
+
+    curves = pynams.make_gaussians(peakpos, heights, widths, x=base_wn)
+    dx = np.array([spec.base_high_wn - spec.base_low_wn for spec in spectra])
+    peak_areas = dx[:, np.newaxis] * np.mean(curves, axis=2)
+    for spec, areas in zip(spectra, peak_areas):
+        spec.peak_areas = list(areas)
+    return peak_areas
+
+
+def read_spectrum_file(filename):
+    """
+    Reads an FTIR file (.CSV or tab-delimited .txt) and returns a 2 x n 
+    array of wavenumbers, sorted low to high, and raw absorbances.
+    """
+    if filename.endswith('.CSV'):
+        signal = pd.read_csv(filename, header=None).values
+    elif filename.endswith('.txt'):
+        try:
+            signal = np.loadtxt(filename, delimiter='\t', dtype=None) 
+        except ValueError:
+            print('\nProblem reading this file format. Try .CSV')
+            return
+    else:
+        print('For now only CSV and txt files work.')
+        return
+    order = np.argsort(signal[:, 0], kind='mergesort')
+    return np.transpose(signal[order, :2])
+
+
+def read_baseline_file(filename):
+    """
+    Reads a baseline file made by Spectrum.save_baseline and returns a
+    3 x n array of baseline wavenumbers, baseline absorbances, and 
+    baseline-subtracted absorbances.
+    """
+    data = pd.read_csv(filename).values
+    return np.transpose(data[:, :3]).astype(float)
+
+
+def read_peakfit_file(filename):
+    """
+    Reads a peakfit file made by Spectrum.save_peakfit or with peakfit.m
+    in MATLAB and returns a 4 x n array of peak positions, sorted low to 
+    high, peak heights, peak widths, and peak areas.
+    """
+    previous_fit = pd.read_csv(filename)
+    
+    # older version peakfit files don't have headings
+    if len(list(previous_fit)[0]) < 20:
+        previous_fit = pd.read_csv(filename, header=None)
+    
+    data = previous_fit.values[:, :4].astype(float)
+    order = np.argsort(data[:, 0], kind='mergesort')
+    return np.transpose(data[order])
+
+
 def make_filenames(folder, classname=Spectrum, file_ending='.CSV'):
     """ Set filename attribute based on folder and fname attribute
     for all Spectra() with fname but no filename."""
@@ -0,0 +1,288 @@
+"""
+Code for loading and handling *many* FTIR spectra at once.
+
+The central concept is an object class called SpectraStore, which reads
+a whole set of FTIR files into a single 2D array of raw absorbances
+(one row per spectrum) that share one wavenumber axis. Spectrum objects
+made from or attached to a SpectraStore point into rows of that array
+instead of reading in and keeping their own copies, so operations on
+whole profiles and blocks can be done on the array all at once.
+
+@author Elizabeth Ferriss
+"""
+from __future__ import print_function, division, absolute_import
+import numpy as np
+import pandas as pd
+import os
+import io
+from .spectra import Spectrum
+from . import pynams
+
+
+class SpectraStore():
+    """
+    Reads in the FTIR files for a list of fnames in one go and keeps the
+    results in two attributes:
+        wn_full: wavenumbers in cm-1, sorted low to high, shared by all
+        abs_raw: 2D array of raw absorbances, one row for each fname
+
+    The row for each file is in the dictionary index, which is keyed by
+    the full filename (folder + fname + filetype), so files with the same
+    fname in different folders are kept apart, e.g.,
+        store.abs_raw[store.index[folder + 'my_file.CSV']]
+
+    Like Spectrum, the fnames are the filenames without the filetype,
+    which defaults to '.CSV'. All files are assumed to be in folder
+    unless a list of folders, one for each fname, is passed in.
+
+    The text from all of the files is parsed together in a single call
+    to pandas, so loading hundreds of spectra is much faster than making
+    each Spectrum separately. If the spectra do not all have the same
+    wavenumbers, they are interpolated onto the wavenumbers of the first
+    spectrum.
+
+    To make Spectrum objects that use the store, pass the store in when
+    making the Spectrum or Profile:
+        my_spectrum = Spectrum('my_file', folder=folder, store=store)
+        my_profile = Profile(fnames=fnames, folder=folder, store=store)
+    or use store_from_profiles() or store_from_block() to load and attach
+    all of the spectra of existing profiles or blocks.
+    """
+    def __init__(self, fnames=[], folder='', filetype='.CSV', folders=None):
+        self.fnames = []
+        self.folders = []
+        self.folder = folder
+        self.filetype = filetype
+        self.index = {}
+        self.wn_full = None
+        self.wn_index = None
+        self.abs_raw = None
+
+        if folders is None:
+            folders = [folder]*len(fnames)
+        elif len(folders) != len(fnames):
+            print('folders must be a list the same length as fnames')
+            return
+
+        # drop repeats, e.g., from profiles that are their own initial
+        self.filenames = []
+        for fname, fold in zip(fnames, folders):
+            filename = ''.join((fold, fname, filetype))
+            if filename in self.filenames:
+                continue
+            if os.path.isfile(filename) is False:
+                print('There is a problem finding the file.')
+                print('filename =', filename)
+                continue
+            self.fnames.append(fname)
+            self.folders.append(fold)
+            self.filenames.append(filename)
+
+        if len(self.fnames) > 0:
+            self.load()
+
+
+    def __contains__(self, filename):
+        return filename in self.index
+
+
+    def __len__(self):
+        return len(self.fnames)
+
+
+    def read_all(self):
+        """
+        Returns a list of (wavenumber, absorbance) arrays, one for each
+        file, parsed with a single pandas call.
+        """
+        if self.filetype == '.txt':
+            delim = '\t'
+        else:
+            delim = ','
+
+        chunks = []
+        nrows = []
+        for filename in self.filenames:
+            with open(filename, 'rb') as f:
+                text = f.read().strip()
+            chunks.append(text)
+            nrows.append(text.count(b'\n') + 1)
+
+        signal = pd.read_csv(io.BytesIO(b'\n'.join(chunks)), header=None,
+                             sep=delim, usecols=[0, 1]).values
+
+        if len(signal) != sum(nrows):
+            # blank lines or other oddities; read them one at a time
+            signals = []
+            for filename in self.filenames:
+                s = pd.read_csv(filename, header=None, sep=delim,
+                                usecols=[0, 1]).values
+                signals.append(s)
+        else:
+            stops = np.cumsum(nrows)
+            starts = stops - np.array(nrows)
+            signals = [signal[a:b] for a, b in zip(starts, stops)]
+        return signals
+
+
+    def load(self):
+        """
+        (Re)load all of the files into the shared wavenumber array wn_full
+        and 2D raw absorbance array abs_raw.
+        """
+        signals = self.read_all()
+
+        # sort wavenumbers from low to high, as in Spectrum
+        wn_list = []
+        abs_list = []
+        for s in signals:
+            order = np.argsort(s[:, 0], kind='mergesort')
+            wn_list.append(s[order, 0].astype(float))
+            abs_list.append(s[order, 1].astype(float))
+
+        wn_full = wn_list[0]
+        abs_raw = np.empty((len(abs_list), len(wn_full)))
+        for idx, (wn, absorbance) in enumerate(zip(wn_list, abs_list)):
+            if (len(wn) == len(wn_full)) and np.allclose(wn, wn_full):
+                abs_raw[idx] = absorbance
+            else:
+                print('Interpolating', self.fnames[idx],
+                      'onto wavenumbers of', self.fnames[0])
+                abs_raw[idx] = np.interp(wn_full, wn, absorbance)
+
+        self.wn_full = wn_full
+        self.wn_index = pynams.WavenumberIndex(wn_full)
+        self.abs_raw = abs_raw
+        self.index = dict((filename, idx) for idx, filename in
+                          enumerate(self.filenames))
+
+
+    def get_filename(self, spectrum, folder=None):
+        """
+        Returns the full filename used as the key in index for a Spectrum
+        object or for an fname, which is taken to be in folder (default:
+        the store's folder).
+        """
+        try:
+            return spectrum.filename
+        except AttributeError:
+            pass
+        if folder is None:
+            folder = self.folder
+        return ''.join((folder, spectrum, self.filetype))
+
+
+    def get_spectrum_data(self, filename):
+        """
+        Returns the shared wavenumbers and the row of raw absorbances
+        for the full filename. The absorbances are a view into the store, 
+        not a copy.
+        """
+        return self.wn_full, self.abs_raw[self.index[filename]]
+
+
+    def rows(self, spectra):
+        """
+        Returns an array of the rows in the store for a list of Spectrum
+        objects or fnames in the store's folder.
+        """
+        rows = []
+        for spec in spectra:
+            rows.append(self.index[self.get_filename(spec)])
+        return np.array(rows, dtype=int)
+
+
+    def make_spectra(self, fnames=None, folders=None, **kwargs):
+        """
+        Returns a list of Spectrum objects that use the store for all
+        fnames (default: all spectra in the store, each with its own
+        folder). folders is a list with one folder for each fname and
+        defaults to the store's folder. Other keywords are passed on 
+        to Spectrum.
+        """
+        if fnames is None:
+            fnames = self.fnames
+            folders = self.folders
+        elif folders is None:
+            folders = [self.folder]*len(fnames)
+        spectra = []
+        for fname, fold in zip(fnames, folders):
+            spectra.append(Spectrum(fname, folder=fold,
+                                    filetype=self.filetype, store=self,
+                                    **kwargs))
+        return spectra
+
+
+    def attach(self, spectra):
+        """
+        Points the wavenumbers and raw absorbances of a list of existing
+        Spectrum objects at the store for any spectra whose file (folder,
+        fname, and filetype) is in the store.
+        """
+        for spec in spectra:
+            filename = self.get_filename(spec)
+            if filename in self.index:
+                spec.wn_full, spec.abs_raw = self.get_spectrum_data(filename)
+                spec.wn_index = self.wn_index
+
+
+def store_from_folder(folder, filetype='.CSV',
+                      ignore_endings=['-baseline', '-peakfit', '-3baselines',
+                                      '-per-cm']):
+    """
+    Makes and returns a SpectraStore of all of the FTIR files with the
+    given filetype (default '.CSV') in a folder, skipping files such as
+    saved baselines and peakfits that end with any of ignore_endings.
+    """
+    fnames = []
+    for filename in sorted(os.listdir(folder)):
+        if filename.endswith(filetype) is False:
+            continue
+        fname = filename[:-len(filetype)]
+        if any(fname.endswith(ending) for ending in ignore_endings):
+            continue
+        fnames.append(fname)
+    return SpectraStore(fnames=fnames, folder=folder, filetype=filetype)
+
+
+def store_from_profiles(profiles):
+    """
+    Makes a SpectraStore of all spectra in a list of profiles and their
+    initial profiles, attaches all of the spectra to it, and sets
+    the store attribute of each profile. Returns the store.
+    """
+    allprofiles = []
+    for prof in profiles:
+        allprofiles.append(prof)
+        initial = getattr(prof, 'initial_profile', None)
+        if initial is not None and initial is not prof:
+            allprofiles.append(initial)
+
+    fnames = []
+    folders = []
+    for prof in allprofiles:
+        for spec in prof.spectra:
+            fnames.append(spec.fname)
+            folders.append(spec.folder)
+
+    if len(fnames) == 0:
+        print('No spectra in profiles')
+        return
+
+    store = SpectraStore(fnames=fnames, folders=folders,
+                         filetype=allprofiles[0].spectra[0].filetype)
+    for prof in allprofiles:
+        store.attach(prof.spectra)
+        prof.store = store
+    return store
+
+
+def store_from_block(block):
+    """
+    Makes a SpectraStore of all spectra in a Block, including the
+    initial profiles, attaches them, and sets the store attribute of the 
+    block and its profiles. Returns the store.
+    """
+    store = store_from_profiles(block.profiles)
+    block.store = store
+    return store
@@ -0,0 +1,25 @@
+from __future__ import print_function, division, absolute_import
+import numpy as np
+from pynams.diffusion import models
+
+LENGTHS_MICRONS = [1000., 800., 600.]
+LOG10DS = [-12., -12.5, -13.]
+TIME = 18000.
+
+
+def test_matches_separable_solution():
+    points = 51
+    exact, x, y = models.diffusion3Dnpi(LENGTHS_MICRONS, LOG10DS, TIME,
+                                        points=points, show_plot=False)
+    numerical = models.adi3D(np.ones((points, points, points)),
+                             [length * 1e-6 for length in LENGTHS_MICRONS],
+                             [10.**D for D in LOG10DS], TIME, timesteps=200)
+    assert numerical.shape == exact.shape
+    assert np.max(np.abs(numerical - exact)) < 5e-3
+
+
+def test_zero_time_only_sets_faces():
+    initial = np.ones((5, 6, 7))
+    v = models.adi3D(initial, [1e-3] * 3, [1e-12] * 3, 0., boundary=0.5)
+    assert np.all(v[1:-1, 1:-1, 1:-1] == 1.)
+    assert np.all(v[0] == 0.5) and np.all(v[:, :, -1] == 0.5)
@@ -0,0 +1,80 @@
+from __future__ import print_function, division, absolute_import
+import numpy as np
+from scipy import integrate
+from pynams.diffusion import models, diffusivities
+
+TIMES = [0., 600., 4200., 4260.]
+CELSIUS = [25., 1000., 1000., 25.]
+
+
+def central_differences(function, values, steps):
+    values = np.asarray(values, dtype=float)
+    columns = []
+    for idx, step in enumerate(steps):
+        shift = np.zeros_like(values)
+        shift[idx] = step
+        columns.append((function(values + shift) - 
+                        function(values - shift)) / (2. * step))
+    return np.stack(columns, axis=-1)
+
+
+def test_diffusion1D_jacobian():
+    length = 1e-3
+    x = np.linspace(-length / 2., length / 2., 51)
+
+    def model(p):
+        return models.diffusion1D_array(x, length, 10.**p[0], p[1],
+                                        init=p[2], fin=p[3])
+
+    values = [-12., 36000., 0.9, 0.2]
+    analytical = models.diffusion1D_jacobian(x, length, 1e-12, 36000.,
+                                             init=0.9, fin=0.2)
+    numerical = central_differences(model, values, [1e-5, 1., 1e-5, 1e-5])
+    scale = np.max(np.abs(analytical), axis=0)
+    assert np.all(np.max(np.abs(analytical - numerical), axis=0) < 
+                  1e-6 * scale)
+
+
+def test_wholeblock_jacobian():
+    lengths = [1000., 800., 600.]
+    raypaths = ['c', 'c', 'b']
+
+    def model(p, k):
+        return models.wholeblock_array(lengths, list(p[0:3]), p[3], 
+                                       raypaths, init=p[4], fin=p[5])[k]
+
+    values = [-12., -12.5, -13., 18000., 1., 0.2]
+    analytical = models.wholeblock_jacobian(lengths, values[0:3], 18000.,
+                                            raypaths, init=1., fin=0.2)
+    steps = [1e-5, 1e-5, 1e-5, 1., 1e-5, 1e-5]
+    for k in range(3):
+        numerical = central_differences(lambda p: model(p, k), values, steps)
+        scale = np.max(np.abs(analytical[k]), axis=0)
+        assert np.all(np.max(np.abs(analytical[k] - numerical), axis=0) < 
+                      1e-6 * scale)
+
+
+def test_integrate_Dt_matches_quadrature():
+    Ea = 300.
+    D0 = 1e-4
+
+    def D(t):
+        kelvin = np.interp(t, TIMES, CELSIUS) + 273.15
+        return D0 * np.exp(-Ea / (diffusivities.GAS_CONSTANT * kelvin))
+
+    quadrature = sum(integrate.quad(D, TIMES[idx], TIMES[idx+1], 
+                                    epsrel=1e-12)[0] 
+                     for idx in range(len(TIMES) - 1))
+    Dt = diffusivities.integrate_Dt(Ea, D0, TIMES, CELSIUS)
+    assert np.isclose(Dt, quadrature, rtol=1e-8, atol=0.)
+
+
+def test_effective_log10D_slope():
+    Ea = 300.
+    step = 1e-3
+    numerical = (diffusivities.effective_log10D(Ea + step, 1e-4, TIMES, 
+                                                CELSIUS) - 
+                 diffusivities.effective_log10D(Ea - step, 1e-4, TIMES, 
+                                                CELSIUS)) / (2. * step)
+    slope = diffusivities.effective_log10D_slope(Ea, TIMES, CELSIUS)
+    assert np.isclose(slope, numerical, rtol=1e-6, atol=0.)
@@ -0,0 +1,33 @@
+from __future__ import print_function, division, absolute_import
+import numpy as np
+from pynams.diffusion import models
+
+LENGTH = 1e-3
+D = 1e-12
+TIME = 36000.
+POINTS = 201
+
+
+def test_matches_infinite_sum():
+    x = np.linspace(0., LENGTH, POINTS)
+    numerical = models.crank_nicolson1D(np.ones(POINTS), LENGTH, D, TIME,
+                                        timesteps=200)
+    exact = models.infinite_sum1D(x - (LENGTH / 2.), D, TIME, LENGTH,
+                                  infinity=5000)
+    assert np.max(np.abs(numerical - exact)) < 1e-4
+
+
+def test_callable_D_matches_constant_D():
+    initial = np.ones(POINTS)
+    constant = models.crank_nicolson1D(initial, LENGTH, D, TIME)
+    callable_D = models.crank_nicolson1D(initial, LENGTH,
+                                         lambda concentration: D, TIME)
+    assert np.allclose(constant, callable_D, rtol=0., atol=1e-12)
+
+
+def test_closed_edges_conserve_mass():
+    x = np.linspace(0., LENGTH, POINTS)
+    initial = np.exp(-((x - (LENGTH / 3.)) / (LENGTH / 10.))**2)
+    final = models.crank_nicolson1D(initial, LENGTH, D, TIME,
+                                    left=None, right=None)
+    assert np.isclose(np.trapz(final, x), np.trapz(initial, x), rtol=1e-6)
@@ -0,0 +1,45 @@
+from __future__ import print_function, division, absolute_import
+import os
+import numpy as np
+from pynams import Spectrum
+from pynams.spectrastore import SpectraStore
+
+
+def write_spectrum(folder, fname, absorbance):
+    wn = np.linspace(3000., 4000., 11)
+    with open(os.path.join(folder, fname + '.CSV'), 'w') as f:
+        for w in wn:
+            f.write('{},{}\n'.format(w, absorbance))
+
+
+def test_same_fname_in_two_folders(tmp_path):
+    folder_a = str(tmp_path / 'a') + os.sep
+    folder_b = str(tmp_path / 'b') + os.sep
+    os.mkdir(folder_a)
+    os.mkdir(folder_b)
+    write_spectrum(folder_a, 's1', 1.)
+    write_spectrum(folder_b, 's1', 2.)
+
+    store = SpectraStore(['s1', 's1'], folders=[folder_a, folder_b])
+    assert len(store) == 2
+
+    spec_a = Spectrum('s1', folder=folder_a, store=store)
+    spec_b = Spectrum('s1', folder=folder_b, store=store)
+    assert np.all(spec_a.abs_raw == 1.)
+    assert np.all(spec_b.abs_raw == 2.)
+    assert list(store.rows([spec_a, spec_b])) == [0, 1]
+
+    spec_b.abs_raw = None
+    store.attach([spec_b])
+    assert np.all(spec_b.abs_raw == 2.)
+
+    made = store.make_spectra()
+    assert [spec.folder for spec in made] == [folder_a, folder_b]
+    assert np.all(made[1].abs_raw == 2.)
+
+
+def test_repeats_dropped(tmp_path):
+    folder = str(tmp_path) + os.sep
+    write_spectrum(folder, 's1', 1.)
+    store = SpectraStore(['s1', 's1'], folder=folder)
+    assert len(store) == 1